@@ -0,0 +1,76 @@
+"""
+backend benchmark: the same database is built and queried on every backend, so that the cost of sending the data and
+the clusters to the workers can be weighed against the parallelism of the kernels.
+
+    python -m brainex.benchmarks.backends data.csv [--backends multiprocess thread spark] [--rows n] [--loi a b]
+"""
+import argparse
+import multiprocessing
+import statistics
+import time
+
+BACKENDS = ['multiprocess', 'thread', 'spark']
+
+
+def benchmark_backend(data, backend: str, num_worker: int, st: float, loi, rows=None, num_query: int = 10,
+                      best_k: int = 5, feature_num: int = 0):
+    """
+    :return: {'build': seconds, 'query': median seconds per query, 'range_query': median seconds per range query}
+    """
+    from brainex.utils import gxe_utils as gutils
+
+    db = gutils.from_csv(data, feature_num=feature_num, num_worker=num_worker, use_spark=backend == 'spark',
+                         backend=backend, _rows_to_consider=rows)
+    try:
+        t = time.perf_counter()
+        db.build(st=st, loi=loi, verbose=0)
+        build_time = time.perf_counter() - t
+
+        query_times, range_times = [], []
+        for seed in range(num_query):
+            query = db.get_random_seq_of_len(sequence_len=(loi[0] + loi[1]) // 2, seed=seed)
+            t = time.perf_counter()
+            db.query(query, best_k=best_k)
+            query_times.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            list(db.range_query(query, st / 2))
+            range_times.append(time.perf_counter() - t)
+    finally:
+        db.stop()
+    return {'build': build_time, 'query': statistics.median(query_times),
+            'range_query': statistics.median(range_times)}
+
+
+def benchmark_backends(data, backends=BACKENDS, num_worker: int = None, st: float = 0.1, loi=(20, 24), **kwargs):
+    """
+    :return: backend -> result of benchmark_backend, or the error if the backend is not available
+    """
+    num_worker = multiprocessing.cpu_count() if num_worker is None else num_worker
+    rtn = dict()
+    for backend in backends:
+        try:
+            rtn[backend] = benchmark_backend(data, backend, num_worker, st, loi, **kwargs)
+        except Exception as e:  # Spark is an optional backend
+            rtn[backend] = e
+    return rtn
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build and query the same database on every backend')
+    parser.add_argument('data', help='csv file of the time series')
+    parser.add_argument('--backends', nargs='*', default=BACKENDS)
+    parser.add_argument('--feature-num', type=int, default=0)
+    parser.add_argument('--rows', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--st', type=float, default=0.1)
+    parser.add_argument('--loi', type=int, nargs=2, default=[20, 24])
+    parser.add_argument('--queries', type=int, default=10)
+    args = parser.parse_args()
+    results = benchmark_backends(args.data, args.backends, args.workers, args.st, tuple(args.loi), rows=args.rows,
+                                 num_query=args.queries, feature_num=args.feature_num)
+    for backend, result in results.items():
+        if isinstance(result, Exception):
+            print('%-12s unavailable: %s' % (backend, str(result).split('\n')[0]))
+        else:
+            print('%-12s build %.3fs  query %.3fs  range query %.3fs' % (backend, result['build'], result['query'],
+                                                                        result['range_query']))
@@ -0,0 +1,57 @@
+"""
+import time benchmark: every module is imported in a fresh interpreter, as a short-lived job would, so that the
+dependencies already loaded by the benchmark itself do not hide the cost.
+
+    python -m brainex.benchmarks.import_time [module ...] [--repeat n]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HEAVY_DEPENDENCIES = ['pyspark', 'tslearn', 'scipy', 'sklearn', 'pandas']
+
+_PROBE = """
+import json, sys, time
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+print(json.dumps({{'seconds': t, 'loaded': [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+
+def import_profile(module: str):
+    """
+    import module in a fresh interpreter, that finds the modules the way this one does
+    :return: (seconds taken by the import, the HEAVY_DEPENDENCIES it loaded)
+    """
+    probe = _PROBE.format(module=module, heavy=repr(HEAVY_DEPENDENCIES))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+    out = subprocess.run([sys.executable, '-c', probe], check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                         env=env)
+    rtn = json.loads(out.stdout.strip().split('\n')[-1])
+    return rtn['seconds'], rtn['loaded']
+
+
+def benchmark_import(modules, repeat: int = 5):
+    """
+    :return: module -> {'median': seconds, 'min': seconds, 'loaded': heavy dependencies loaded by the import}
+    """
+    rtn = dict()
+    for module in modules:
+        profiles = [import_profile(module) for _ in range(repeat)]
+        times = [t for t, _ in profiles]
+        rtn[module] = {'median': statistics.median(times), 'min': min(times), 'loaded': profiles[0][1]}
+    return rtn
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='time the import of brainex modules in fresh interpreters')
+    parser.add_argument('modules', nargs='*', default=['brainex', 'brainex.utils.gxe_utils'])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    for module, result in benchmark_import(args.modules, args.repeat).items():
+        print('%-32s median %.3fs  min %.3fs  loaded: %s' % (module, result['median'], result['min'],
+                                                               ', '.join(result['loaded']) or '-'))
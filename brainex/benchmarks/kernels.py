@@ -0,0 +1,184 @@
+"""
+micro-benchmarks of the kernels the build and the query spend their time in, on synthetic inputs of several lengths
+and counts. Every case reports the time per call in nanoseconds and the peak memory a call allocates, and the results
+can be compared against a baseline the same way as brainex.benchmarks.ucr, to check that a rewrite of a kernel is
+faster.
+
+    python -m brainex.benchmarks.kernels [--kernels sim_between_array ...] [--lengths 16 64 256] [--counts 10 100]
+                                         [--out results.json] [--baseline baseline.json] [--save-baseline file]
+"""
+import argparse
+import datetime
+import json
+import platform
+import sys
+import timeit
+import tracemalloc
+import warnings
+
+import numpy as np
+
+LENGTHS = [16, 64, 256]
+COUNTS = [10, 100]
+
+# the metrics compared against the baseline
+LOWER_IS_BETTER = ['ns_per_op', 'alloc_peak_bytes']
+
+
+def _series(length: int, count: int, seed: int = 0):
+    """
+    :return: count random walks of the given length, as the (id, data) list of data_normalized
+    """
+    rng = np.random.RandomState(seed)
+    return [(('ts', i), np.cumsum(rng.randn(length))) for i in range(count)]
+
+
+def _case_sim_between_array(length, count):
+    from brainex.op.query_op import sim_between_array
+    (_, a), (_, b) = _series(length, 2)
+    return lambda: sim_between_array(a, b, 2)
+
+
+def _case_lb_kim_sequence(length, count):
+    from brainex.utils.ts_utils import lb_kim_sequence
+    (_, a), (_, b) = _series(length, 2)
+    return lambda: lb_kim_sequence(a, b)
+
+
+def _case_lb_keogh_sequence(length, count):
+    from brainex.utils.ts_utils import lb_keogh_sequence
+    (_, a), (_, b) = _series(length, 2)
+    return lambda: lb_keogh_sequence(a, b)
+
+
+def _case_paa_compress(length, count):
+    from brainex.utils.ts_utils import paa_compress
+    _, a = _series(length, 1)[0]
+    _, paa = paa_compress(a, 8)
+    return lambda: paa_compress(a, 8, paa)
+
+
+def _case_sax_compress(length, count):
+    from brainex.utils.ts_utils import sax_compress
+    _, a = _series(length, 1)[0]
+    _, sax = sax_compress(a, 4)
+    return lambda: sax_compress(a, 4, sax)
+
+
+def _case_fetch_data(length, count):
+    from brainex.classes.Sequence import Sequence
+    data = _series(length, count)
+    seq = Sequence(data[-1][0], length // 4, length // 2)
+    return lambda: seq.fetch_data(data)
+
+
+def _case_cluster_group_dist(length, count):
+    from brainex.classes.Sequence import Sequence
+    from brainex.database.genexengine import eu_norm
+    from brainex.op.cluster_op import cluster_group_dist
+    data = _series(length, 10)
+    seq_len = max(2, length // 4)
+    group = [Sequence(ts_id, s, s + seq_len - 1) for s in range(length - seq_len + 1) for ts_id, _ in data][:count]
+    return lambda: cluster_group_dist(list(group), 0.1, seq_len, eu_norm, data, preformed_c=dict())
+
+
+def _case_group_time_series(length, count):
+    from brainex.utils.process_utils import _group_time_series
+    data = _series(length, count)
+    return lambda: _group_time_series(data, max(2, length - 4), length)
+
+
+def _case_calculate_overlap(length, count):
+    from brainex.classes.Sequence import Sequence
+    from brainex.database.genexengine import _calculate_overlap
+    a, b = Sequence(('ts', 0), 0, length - 1), Sequence(('ts', 0), length // 2, length + length // 2 - 1)
+    return lambda: _calculate_overlap(a, b)
+
+
+# kernel -> (function of (length, count) giving the call to measure, whether the call depends on count). count is the
+# number of time series, but for cluster_group_dist where it is the number of subsequences clustered
+KERNELS = {'sim_between_array': (_case_sim_between_array, False),
+           'lb_kim_sequence': (_case_lb_kim_sequence, False),
+           'lb_keogh_sequence': (_case_lb_keogh_sequence, False),
+           'paa_compress': (_case_paa_compress, False),
+           'sax_compress': (_case_sax_compress, False),
+           'fetch_data': (_case_fetch_data, True),
+           'cluster_group_dist': (_case_cluster_group_dist, True),
+           'group_time_series': (_case_group_time_series, True),
+           'calculate_overlap': (_case_calculate_overlap, False)}
+
+
+def measure(call, repeat: int = 5):
+    """
+    :return: {'ns_per_op': the best time per call over repeat runs of about 0.2 second, 'alloc_peak_bytes': the peak
+    memory allocated by one call}
+    """
+    timer = timeit.Timer(call)
+    number, _ = timer.autorange()
+    ns_per_op = min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+    call()  # the allocations made once, by the imports and the caches, are not counted
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'ns_per_op': ns_per_op, 'alloc_peak_bytes': peak - base}
+
+
+def benchmark_kernels(kernels=tuple(KERNELS.keys()), lengths=LENGTHS, counts=COUNTS, repeat: int = 5):
+    """
+    :return: {'meta': environment of the run, 'results': 'kernel/length=l/count=n' -> result of measure, or
+    {'error': message} if the kernel is not available}. The kernels that do not depend on the count are measured
+    once per length
+    """
+    results = dict()
+    for kernel in kernels:
+        case, uses_count = KERNELS[kernel]
+        for length in lengths:
+            for count in (counts if uses_count else counts[:1]):
+                name = '%s/length=%d' % (kernel, length) + ('/count=%d' % count if uses_count else '')
+                try:
+                    with warnings.catch_warnings():  # tslearn warns on every call
+                        warnings.simplefilter('ignore')
+                        results[name] = measure(case(length, count), repeat)
+                except Exception as e:  # the piecewise kernels need tslearn
+                    results[name] = {'error': str(e).split('\n')[0]}
+    meta = {'date': datetime.datetime.now().isoformat(), 'python': sys.version.split()[0],
+            'platform': platform.platform(), 'numpy': np.__version__}
+    return {'meta': meta, 'results': results}
+
+
+if __name__ == '__main__':
+    from brainex.benchmarks.ucr import compare, print_changes
+
+    parser = argparse.ArgumentParser(description='micro-benchmark the kernels of build and query')
+    parser.add_argument('--kernels', nargs='*', default=list(KERNELS.keys()), choices=list(KERNELS.keys()))
+    parser.add_argument('--lengths', type=int, nargs='*', default=LENGTHS)
+    parser.add_argument('--counts', type=int, nargs='*', default=COUNTS)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--out', default=None, help='file to write the results to as JSON')
+    parser.add_argument('--baseline', default=None, help='results of a previous run to compare against')
+    parser.add_argument('--save-baseline', default=None, help='file to write the results to as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    suite = benchmark_kernels(args.kernels, args.lengths, args.counts, args.repeat)
+    for path in [args.out, args.save_baseline]:
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(suite, f, indent=2)
+    for name, result in suite['results'].items():
+        if 'error' in result:
+            print('%-48s unavailable: %s' % (name, result['error']))
+        else:
+            print('%-48s %14.0f ns/op  %10d B allocated' % (name, result['ns_per_op'], result['alloc_peak_bytes']))
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            changes = compare(suite, json.load(f), args.tolerance, lower_is_better=LOWER_IS_BETTER,
+                              higher_is_better=[])
+        print_changes(changes)
+        sys.exit(1 if any(c['regression'] for c in changes) else 0)
@@ -0,0 +1,190 @@
+"""
+benchmark suite over the UCR datasets in brainex/experiments/data: every dataset is built and queried on every backend
+with every option set, measuring the build time and memory, the latency of query against query_brute_force and the
+accuracy of query taking query_brute_force as the truth. The results are written as JSON and compared against a
+baseline, written by a previous run with --save-baseline.
+
+    python -m brainex.benchmarks.ucr [--datasets ItalyPower ...] [--backends multiprocess thread] [--options default]
+                                     [--out results.json] [--baseline baseline.json] [--save-baseline baseline.json]
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import sys
+
+import numpy as np
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'experiments', 'data')
+
+# name -> (file in DATA_DIR, rows built, loi); the queries are taken from the rows after the ones built
+DATASETS = {'ItalyPower': ('ItalyPower.csv', 40, (18, 22)),
+            'ECGFiveDays': ('ECGFiveDays.csv', 10, (40, 42)),
+            'Gun_Point': ('Gun_Point_TRAIN.csv', 10, (40, 42)),
+            'synthetic_control': ('synthetic_control_TRAIN.csv', 10, (30, 32))}
+
+# name -> keyword arguments of build. The st of every option makes it cluster about as much as the others: the
+# distances of z-normalized subsequences are several times those of the data scaled to [0, 1], at an st of 0.1 their
+# clusters would be single subsequences and the query a brute force scan
+OPTIONS = {'default': {'st': 0.1},
+           'partition_by_length': {'st': 0.1, 'partition_by_length': True},
+           'subsequence_normalize': {'st': 0.6, 'normalize': 'subsequence'}}
+
+BACKENDS = ['multiprocess', 'thread']
+
+# the metrics compared against the baseline, by the direction in which they improve
+LOWER_IS_BETTER = ['build_time', 'peak_rss_driver', 'peak_rss_workers', 'query_p50', 'query_p90', 'query_p99']
+HIGHER_IS_BETTER = ['recall']
+
+
+def _queries(path: str, rows: int, num_query: int, q_len: int, seed: int = 0):
+    """
+    :return: num_query windows of length q_len from the rows after the first rows of the csv at path, not built
+    """
+    import pandas as pd
+
+    df = pd.read_csv(path)
+    rng = np.random.RandomState(seed)
+    rtn = []
+    for r in range(rows, min(rows + num_query, len(df))):
+        ts = df.iloc[r].values.astype(np.float64)
+        ts = ts[~np.isnan(ts)]
+        start = rng.randint(0, len(ts) - q_len + 1)
+        rtn.append(ts[start:start + q_len])
+    return rtn
+
+
+def _percentiles(times: list, prefix: str):
+    return dict((prefix + '_p%d' % q, float(np.percentile(times, q))) for q in (50, 90, 99))
+
+
+def benchmark_run(dataset: str, backend: str, option: str, num_worker: int, num_query: int = 5, best_k: int = 5,
+                  data_dir: str = DATA_DIR):
+    """
+    build dataset on backend with the build options OPTIONS[option] and query it with num_query queries
+    :return: dict of the metrics of the run, see LOWER_IS_BETTER and HIGHER_IS_BETTER
+    """
+    import time
+    from brainex.utils import gxe_utils as gutils
+
+    file, rows, loi = DATASETS[dataset]
+    path = os.path.join(data_dir, file)
+    db = gutils.from_csv(path, feature_num=0, num_worker=num_worker, use_spark=backend == 'spark', backend=backend,
+                         _rows_to_consider=rows)
+    try:
+        db.build(loi=loi, verbose=0, **OPTIONS[option])
+        build_metrics = db.get_metrics()['build']
+        rtn = {'build_time': build_metrics['wall_time'],
+               'peak_rss_driver': build_metrics['peak_rss'].get('driver'),
+               'peak_rss_workers': build_metrics['peak_rss'].get('workers'),
+               'num_subsequences': db.get_num_subsequences(), 'num_clusters': db.get_num_clusters()}
+
+        query_times, bf_times, recalls, dist_ratios = [], [], [], []
+        for q in _queries(path, rows, num_query, (loi[0] + loi[1]) // 2):
+            q = db.normalize(q)
+            t = time.perf_counter()
+            result = db.query(q, best_k=best_k)
+            query_times.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            truth = db.query_brute_force(q, best_k=best_k, _use_cache=False)
+            bf_times.append(time.perf_counter() - t)
+
+            recalls.append(len(set(s for _, s in result) & set(s for _, s in truth)) / len(truth))
+            truth_dist = sum(d for d, _ in truth)
+            if truth_dist > 0:
+                dist_ratios.append(sum(d for d, _ in result) / truth_dist)
+        rtn.update(_percentiles(query_times, 'query'))
+        rtn.update(_percentiles(bf_times, 'brute_force'))
+        rtn['recall'] = float(np.mean(recalls))
+        rtn['dist_ratio'] = float(np.mean(dist_ratios)) if dist_ratios else None
+    finally:
+        db.stop()
+    return rtn
+
+
+def benchmark_suite(datasets=tuple(DATASETS.keys()), backends=BACKENDS, options=tuple(OPTIONS.keys()),
+                    num_worker: int = None, **kwargs):
+    """
+    :return: {'meta': environment of the run, 'results': 'dataset/backend/option' -> result of benchmark_run, or
+    {'error': message} if the run failed}
+    """
+    num_worker = multiprocessing.cpu_count() if num_worker is None else num_worker
+    results = dict()
+    for dataset in datasets:
+        for backend in backends:
+            for option in options:
+                try:
+                    results['/'.join([dataset, backend, option])] = \
+                        benchmark_run(dataset, backend, option, num_worker, **kwargs)
+                except Exception as e:  # Spark is an optional backend
+                    results['/'.join([dataset, backend, option])] = {'error': str(e).split('\n')[0]}
+    meta = {'date': datetime.datetime.now().isoformat(), 'python': sys.version.split()[0],
+            'platform': platform.platform(), 'cpu_count': multiprocessing.cpu_count(), 'num_worker': num_worker}
+    return {'meta': meta, 'results': results}
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2, lower_is_better=LOWER_IS_BETTER,
+            higher_is_better=HIGHER_IS_BETTER):
+    """
+    compare the runs of results against the same runs of baseline, both as returned by benchmark_suite
+    :param tolerance: relative change below which a metric is considered unchanged
+    :param lower_is_better: the metrics compared that improve as they decrease
+    :param higher_is_better: the metrics compared that improve as they increase
+    :return: list of {'run', 'metric', 'baseline', 'value', 'change', 'regression'}, for the metrics that changed,
+    change is relative to the baseline
+    """
+    rtn = []
+    for run, result in results['results'].items():
+        base = baseline['results'].get(run)
+        if base is None or 'error' in result or 'error' in base:
+            continue
+        for metric in list(lower_is_better) + list(higher_is_better):
+            if result.get(metric) is None or not base.get(metric):
+                continue
+            change = (result[metric] - base[metric]) / base[metric]
+            if abs(change) > tolerance:
+                rtn.append({'run': run, 'metric': metric, 'baseline': base[metric], 'value': result[metric],
+                            'change': change, 'regression': change > 0 if metric in lower_is_better else change < 0})
+    return rtn
+
+
+def print_changes(changes: list):
+    for c in changes:
+        print('%-8s %-48s %-18s %.4g -> %.4g (%+.0f%%)' % ('WORSE' if c['regression'] else 'better', c['run'],
+                                                         c['metric'], c['baseline'], c['value'], c['change'] * 100))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark build and query over the bundled UCR datasets')
+    parser.add_argument('--datasets', nargs='*', default=list(DATASETS.keys()), choices=list(DATASETS.keys()))
+    parser.add_argument('--backends', nargs='*', default=BACKENDS)
+    parser.add_argument('--options', nargs='*', default=list(OPTIONS.keys()), choices=list(OPTIONS.keys()))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--queries', type=int, default=5)
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--out', default=None, help='file to write the results to as JSON')
+    parser.add_argument('--baseline', default=None, help='results of a previous run to compare against')
+    parser.add_argument('--save-baseline', default=None, help='file to write the results to as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    suite = benchmark_suite(args.datasets, args.backends, args.options, args.workers, num_query=args.queries,
+                            data_dir=args.data_dir)
+    for path in [args.out, args.save_baseline]:
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(suite, f, indent=2)
+    for run, result in suite['results'].items():
+        if 'error' in result:
+            print('%-48s unavailable: %s' % (run, result['error']))
+        else:
+            print('%-48s build %.3fs  query p50 %.3fs p99 %.3fs  brute force p50 %.3fs  recall %.2f' % (
+                run, result['build_time'], result['query_p50'], result['query_p99'], result['brute_force_p50'],
+                result['recall']))
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            changes = compare(suite, json.load(f), args.tolerance)
+        print_changes(changes)
+        sys.exit(1 if any(c['regression'] for c in changes) else 0)
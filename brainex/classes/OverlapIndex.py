@@ -0,0 +1,57 @@
+import bisect
+
+from brainex.classes.Sequence import Sequence
+from brainex.utils.utils import _isOverlap
+
+
+class OverlapIndex:
+    """
+    collection of sequences that answers whether a sequence overlaps any of them, with the semantic of
+    brainex.utils.utils._isOverlap.
+    The sequences are kept sorted by start for every seq_id, and a check only compares the sequences starting in a
+    window found by bisection: the overlap is the intersection over the span of the two, so with overlap > 0 the
+    sequences that overlap seq intersect it and are at most len(seq) / overlap long, they start at most that far
+    before it. With overlap == 0, the sequences that touch seq count too, they start at most the longest sequence
+    added before it.
+
+    add takes O(log n) to find the place of the sequence and O(n) to insert it in the lists of its seq_id, a memory
+    move that is fast for the few hundred matches of a query. is_overlapping takes O(log n + m), m being the number
+    of sequences of the same seq_id starting in the window. The window does not depend on the other sequences added
+    when overlap > 0; a negative overlap, that lets disjoint sequences overlap, compares all the sequences of the
+    seq_id.
+    """
+
+    def __init__(self, overlap: float):
+        self.overlap = overlap
+        self._starts = dict()  # seq_id -> sorted list of starts
+        self._seqs = dict()  # seq_id -> list of sequences, in the same order as _starts
+        self._max_len = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, seq: Sequence):
+        starts = self._starts.setdefault(seq.seq_id, [])
+        i = bisect.bisect_right(starts, seq.start)
+        starts.insert(i, seq.start)
+        self._seqs.setdefault(seq.seq_id, []).insert(i, seq)
+        self._max_len = max(self._max_len, len(seq))
+        self._size += 1
+
+    def is_overlapping(self, seq: Sequence) -> bool:
+        """
+        :return: whether any(_isOverlap(seq, s, overlap) for s in the added sequences)
+        """
+        if seq.seq_id not in self._starts:
+            return False
+        starts, seqs = self._starts[seq.seq_id], self._seqs[seq.seq_id]
+        if self.overlap < 0:  # disjoint sequences have a negative overlap, they can all pass the test
+            return any(_isOverlap(seq, s, self.overlap) for s in seqs)
+        if self.overlap > 0:  # the shorter of two overlapping sequences is at least overlap times the longer
+            lo = bisect.bisect_left(starts, seq.start - min(self._max_len, int(len(seq) / self.overlap) + 1) + 1)
+            hi = bisect.bisect_right(starts, seq.end)
+        else:  # a sequence that ends right before seq or starts right after has an overlap of 0
+            lo = bisect.bisect_left(starts, seq.start - self._max_len)
+            hi = bisect.bisect_right(starts, seq.end + 1)
+        return any(_isOverlap(seq, seqs[i], self.overlap) for i in range(lo, hi))
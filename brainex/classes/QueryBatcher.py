@@ -0,0 +1,77 @@
+import asyncio
+import concurrent.futures
+
+
+class QueryBatcher:
+    """
+    gathers the queries submitted at about the same time into batches. The first query of a batch waits window_ms for
+    others with the same arguments; the batch is then run by a batch function of the engine (query_on_batch,
+    query_bf_on_batch), that searches the partitions once for all its queries. The batches run one at a time in a
+    thread, so the event loop is never blocked and the engine is never used by two batches at once.
+    At most max_in_flight queries are waiting or running, the next ones wait for a place before being batched.
+    """
+
+    def __init__(self, engine, window_ms: float = 5, max_batch: int = 32, max_in_flight: int = 256):
+        self.engine = engine
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.max_in_flight = max_in_flight
+        self._executor = None
+        self._loop = None
+        self._in_flight = None
+        self._pending = dict()  # batch key -> (batch function, best_k, kwargs, list of (query, future))
+        self._timers = dict()  # batch key -> handle of the flush of the batch
+
+    def _bind(self):
+        """
+        the semaphore and the batches belong to the running event loop, they are renewed if the loop changes
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+            self._pending, self._timers = dict(), dict()
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return loop
+
+    async def submit(self, batch_func, query, best_k: int, **kwargs):
+        """
+        :param batch_func: function of (queries, best_k, **kwargs) returning the result of every query, in order
+        :return: the result of query
+        """
+        loop = self._bind()
+        async with self._in_flight:
+            future = loop.create_future()
+            key = (batch_func, best_k, repr(sorted(kwargs.items())))
+            batch = self._pending.setdefault(key, (batch_func, best_k, kwargs, []))[3]
+            batch.append((query, future))
+            if len(batch) >= self.max_batch:
+                self._flush(key)
+            elif len(batch) == 1:
+                self._timers[key] = loop.call_later(self.window, self._flush, key)
+            return await future
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch_func, best_k, kwargs, batch = self._pending.pop(key)
+        queries = [query for query, _ in batch]
+        job = self._loop.run_in_executor(self._executor, lambda: batch_func(queries, best_k, **kwargs))
+        job.add_done_callback(lambda j: _set_results(j, [future for _, future in batch]))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def _set_results(job, futures):
+    for i, future in enumerate(futures):
+        if future.done():  # cancelled by its caller
+            continue
+        if job.exception() is not None:
+            future.set_exception(job.exception())
+        else:
+            future.set_result(job.result()[i])
@@ -0,0 +1,15 @@
+class TreeCluster(dict):
+    """
+    the clusters of one length, representative -> list of (distance, member), with the tree of their representatives:
+    the representatives are clustered again at twice the similarity threshold, and the representatives of those
+    clusters again, until few are left at the top, see brainex.op.cluster_op.build_repr_tree. A query descends the
+    tree best first instead of ranking every representative, see brainex.op.query_op.expand_rtree.
+
+    tree: list of the top nodes. A node is (representative, radius, child nodes): the radius bounds the distance from
+    the representative to any member of the clusters under it. The leaves are the representatives of the clusters,
+    with the radius of their cluster and None for children.
+    """
+
+    def __init__(self, clusters=(), tree: list = None):
+        super().__init__(clusters)
+        self.tree = tree
@@ -1,47 +1,57 @@
+import copy
 import heapq
 import json
 import math
+import multiprocessing.pool
 import os
 import pickle
 import random
 import statistics
+import time
 from statistics import mode
 from logging import warning
 
 import numpy as np
 import shutil
 
-from pyspark.rdd import RDD
-from scipy.spatial.distance import cityblock
-from scipy.spatial.distance import euclidean
-from scipy.spatial.distance import chebyshev
-
+from brainex.classes.OverlapIndex import OverlapIndex
+from brainex.classes.QueryBatcher import QueryBatcher
 from brainex.classes.Sequence import Sequence
-from brainex.op.query_op import _query_partition, sim_between_array
-from brainex.utils.spark_utils import _cluster_with_spark, _query_bf_spark, _broadcast_kwargs, _destory_kwarg_bc, \
-    _build_piecewise_spark, _query_paa_spark, _query_sax_spark, _query_piecewise_spark
+from brainex.op.query_op import _query_partition, sim_between_array, _range_query_partition, _is_exhausted
 from brainex.utils.utils import _validate_gxdb_build_arguments, _process_loi, _validate_gxe_query_arguments, _isOverlap, \
     flatten, process_loi_query, _min_max_normalize_single, \
-    _inverse_min_max_normalize_single
-from brainex.utils.context_utils import _multiprocess_backend
+    _inverse_min_max_normalize_single, length_directory, plan_query_lengths, reduce_by_key
+from brainex.utils.context_utils import _multiprocess_backend, _spark_backend
+from brainex.utils.process_utils import length_range_bounds
+
+from brainex.utils.mutiprocess_utils import _cluster_multi_process, _query_bf_mp, _query_mp, _matrix_profile_top_k_mp, \
+    _discords_mp, _range_query_mp, _join_mp, _query_bf_budget_mp, _partition_length_directory_mp, \
+    _partition_by_length_mp, _query_batch_mp, _query_bf_batch_mp, _subsequences_of_clusters, _cluster_levels_mp, \
+    _repr_trees_mp
+from brainex.utils.memory_utils import estimate_build, fit_budget, parse_size
+from brainex.utils.metrics_utils import timed, add_counts, length_counts, format_report, peak_rss, \
+    children_peak_rss
+from brainex.utils.ts_utils import eu_znorm, ma_znorm, ch_znorm, running_sums, z_normalize_window
 
-from brainex.utils.mutiprocess_utils import _cluster_multi_process, _query_bf_mp, _query_mp
+# version of the saved clusters, in build_conf: 2 since the members of a cluster are (distance to the representative,
+# member) instead of the bare member. from_db refuses older databases, their clusters have to be built again
+CLUSTER_FORMAT = 2
 
 
 def eu_norm(x, y):
-    return euclidean(x, y) / np.sqrt(len(x))
+    return np.linalg.norm(np.subtract(x, y)) / np.sqrt(len(x))
 
 
 def ma_norm(x, y):
-    return cityblock(x, y) / len(x)
+    return np.sum(np.abs(np.subtract(x, y))) / len(x)
 
 
 def ch_norm(x, y):
-    return chebyshev(x, y)
+    return np.max(np.abs(np.subtract(x, y)))
 
 
 def min_norm(x, y):
-    return chebyshev(x, y)
+    return np.max(np.abs(np.subtract(x, y)))
 
 
 dt_func_dict = {'eu': eu_norm,
@@ -49,6 +59,12 @@ dt_func_dict = {'eu': eu_norm,
                 'ch': ch_norm,
                 'min': min_norm
                 }
+# distance functions used when the subsequences are z-normalized one by one, see GenexEngine.build(normalize=...)
+dt_znorm_func_dict = {'eu': eu_znorm,
+                      'ma': ma_znorm,
+                      'ch': ch_znorm,
+                      'min': ch_znorm
+                      }
 dt_pnorm_dict = {'eu': 2,
                  'ma': 1,
                  'ch': math.inf,
@@ -75,6 +91,7 @@ class GenexEngine:
         self.data_normalized = kwargs['data_normalized']
         self.mp_context = kwargs['mp_context']
         self.clusters = None
+        self.cluster_levels = None
         self.subsequences = None
         self.subsequences_paa = None
         self.subsequences_sax = None
@@ -91,6 +108,12 @@ class GenexEngine:
         self.bf_query_buffer = dict()
 
         self._data_normalized_bc = None
+        self._window_stats = None
+        self._window_stats_bc = None
+        self._length_directory = None
+        self._partition_length_directory = None
+        self._query_batcher = None
+        self.metrics = {'build': None, 'query': None}
         self.feature_num = len(self.data_normalized[0][0])
 
     def __del__(self):
@@ -102,6 +125,7 @@ class GenexEngine:
 
     def _set_clusters(self, clusters):
         self.clusters = clusters
+        self._partition_length_directory = None
 
     def get_mp_context(self):
         return self.mp_context
@@ -133,55 +157,247 @@ class GenexEngine:
             raise Exception(
                 'Error checking dimension, expected: (' + str(self.conf['seq_dim']) + ',n), got ' + str(seq_shape))
 
-    def build(self, st: float, dist_type: str = 'eu', loi=None, verbose: int = 1, _group_only=False, _use_dss=True,
-              _use_dynamic=False):
+    def build(self, st: float, dist_type: str = 'eu', loi=None, verbose: int = 1, normalize: str = None,
+              partition_by_length: bool = False, length_step: int = 1, memory_budget=None, over_budget: str = 'raise',
+              st_levels=None, repr_fanout: int = None, _group_only=False, _use_dss=True, _use_dynamic=False):
         """
         Groups and clusters the time series set
 
         if the number of time series is less than the number of works, the spark version will use sdg to speed up
         grouping
+        :param normalize: None to compare the subsequences as they are in data_normalized, or 'subsequence' to
+        z-normalize every subsequence on its own (shape-based matching). The window statistics are derived from
+        running sums of the time series and folded into the distance kernel, and queries made against this build are
+        z-normalized the same way.
+        :param partition_by_length: whether to co-locate the clusters by ranges of length once they are built. By
+        default every partition holds clusters of every length and a query searches every partition, with this option
+        a query only schedules the partitions holding the lengths around the query length.
+        :param length_step: cluster only every length_step-th length of the loi, from its start, which divides the
+        time and the size of the build by about length_step. A query of a length left out searches the nearest lengths
+        built, see the length_policy of query.
+        :param memory_budget: the memory the build may take, in bytes or as a string like '16G'. The memory of the build
+        is estimated before it runs (see estimate_build), and the estimate is in get_metrics()['build']['estimate'].
+        :param over_budget: what to do if the estimate is over memory_budget: 'raise' to refuse to build, giving the
+        estimate, or 'adapt' to first drop the flat list of subsequences, that query_brute_force then derives from the
+        clusters (with Spark, it is kept on disk and the clusters spill to disk), and then if needed cluster only every
+        s-th length of the loi, with the smallest s from length_step that fits. The build_conf records the length_step
+        and whether the subsequences are kept.
+        :param st_levels: coarser similarity thresholds to cluster at in the same build, on top of st. Every level is
+        made of the clusters of the next finer one, whose representatives are clustered again, so that the clusters
+        of a level are unions of those of the finer levels (see brainex.op.cluster_op.coarsen_cluster). A member of a
+        level is within the sum of st / 2 over the thresholds up to that of the level from its representative, not
+        st / 2 as in a build at that st. A query picks the level to search with its st, and the coarser levels serve
+        as its first stage: it ranks their representatives first and only compares q with the representatives of the
+        level in the best coarse clusters (see brainex.op.cluster_op.ladder_tree). The clusters of every level are
+        held in memory, the number of clusters of every level is in get_metrics()['build']['levels'].
+        :param repr_fanout: if given, the representatives of every length are clustered again at twice st, and so on,
+        into a tree of super-representatives with at most about repr_fanout of them at the top (see
+        brainex.op.cluster_op.build_repr_tree). With st_levels, this is done for the coarsest level only, the top of
+        the tree of the coarser levels. query then descends the tree best first instead of ranking every
+        representative, which pays off when a small st gives many representatives per length. The tree is ignored by
+        _lb_opt.
         :param _use_dss:
         :param _group_only:
         :param st: The upper bound of the similarity value between two time series (Value must be
                                       between 0 and 1)
         :param dist_type: Distance type used for similarity calculation between sequences
         :param loi: default value is none, otherwise using slice notation [start, stop: step]
-        :param verbose: Print logs when grouping and clustering the data_original
+        :param verbose: Print logs when grouping and clustering the data_original, and the timing report of the
+        build, see get_metrics
         :param batch_size:
         :param _is_cluster: Decide whether time series data_original is clustered or not
 
         """
         _validate_gxdb_build_arguments(locals())
+        st_levels = [st] + sorted(st_levels) if st_levels else [st]
+        build_start = time.perf_counter()
+        metrics = {'backend': self.conf.get('backend'), 'bytes_shipped': 0}
         start, end = _process_loi(loi, max_len=self.get_max_seq_len())
+        keep_subsequences = True
+        if memory_budget is not None:
+            keep_subsequences, length_step, metrics['estimate'] = \
+                fit_budget(self.data_normalized, start, end, parse_size(memory_budget), normalize,
+                           adapt=over_budget == 'adapt', length_step=length_step, num_levels=len(st_levels),
+                           repr_fanout=repr_fanout)
+            if verbose >= 1 and not keep_subsequences:
+                print('build: over the memory budget, building with length_step=%d and keep_subsequences=%s' %
+                      (length_step, keep_subsequences))
         # update build configuration
         self.build_conf = {'similarity_threshold': st,
                            'dist_type': dist_type,
                            'loi': (start, end),
-                           'piecewise': tuple()}
+                           'piecewise': tuple(),
+                           'normalize': normalize,
+                           'partition_by_length': partition_by_length,
+                           'length_step': length_step,
+                           'keep_subsequences': keep_subsequences,
+                           'st_levels': st_levels,
+                           'repr_fanout': repr_fanout,
+                           'cluster_format': CLUSTER_FORMAT}
 
         # determine the distance calculation function
         try:
-            dist_func = dt_func_dict[dist_type]
+            dist_func = dt_func_dict[dist_type] if normalize is None else dt_znorm_func_dict[dist_type]
             pnorm = dt_pnorm_dict[dist_type]
         except KeyError:
             raise Exception('Unknown distance type: ' + str(dist_type))
+        self._set_window_stats()
 
         if self.is_using_spark():  # If using Spark backend
             self._data_normalized_bc = self.mp_context.broadcast(self.data_normalized)
             dn = self._data_normalized_bc
             self.subsequences, self.clusters, self.cluster_meta_dict = \
-                _cluster_with_spark(self.mp_context,
-                                    self.data_normalized,
-                                    dn,
-                                    start, end, st, dist_func, pnorm,
-                                    verbose, _group_only, _use_dss, _use_dynamic)
+                _spark_backend()._cluster_with_spark(self.mp_context,
+                                                     self.data_normalized,
+                                                     dn,
+                                                     start, end, st, dist_func, pnorm,
+                                                     verbose, _group_only, _use_dss, _use_dynamic,
+                                                     window_stats=self._window_stats, metrics=metrics,
+                                                     length_step=length_step, spill=not keep_subsequences)
         else:
             self.subsequences, self.clusters, self.cluster_meta_dict = \
                 _cluster_multi_process(self.mp_context,
                                        self.data_normalized,
                                        start, end, st, dist_func,
                                        pnorm,
-                                       verbose, _use_dynamic)
+                                       verbose, _use_dynamic,
+                                       window_stats=self._window_stats, metrics=metrics,
+                                       length_step=length_step, keep_subsequences=keep_subsequences)
+        if partition_by_length and self.clusters is not None:
+            with timed(metrics, 'partitioning'):
+                self._partition_by_length()
+        if repr_fanout is not None and self.clusters is not None and len(st_levels) == 1:  # else on the coarsest level
+            with timed(metrics, 'repr_tree'):
+                self._build_repr_trees(st, repr_fanout, dist_func, metrics)
+        self.cluster_levels = None
+        if len(st_levels) > 1 and self.clusters is not None:
+            with timed(metrics, 'levels'):
+                self._build_levels(st_levels, dist_func, pnorm, metrics, repr_fanout)
+        self._length_directory = None
+        self._partition_length_directory = None
+
+        metrics['wall_time'] = time.perf_counter() - build_start
+        metrics['lengths'] = length_counts(self.cluster_meta_dict) if self.cluster_meta_dict else dict()
+        metrics['peak_rss'] = self._peak_rss()
+        self.metrics['build'] = metrics
+        if verbose >= 1:
+            print(format_report(metrics))
+
+    def _build_repr_trees(self, st: float, repr_fanout: int, dist_func, metrics: dict):
+        """
+        give the clusters the trees of their representatives, see brainex.classes.TreeCluster
+        """
+        if self.is_using_spark():
+            trees = _spark_backend()._repr_trees_spark(self.mp_context, self.clusters, st, repr_fanout, dist_func,
+                                                       self.data_normalized, self._window_stats, metrics)
+            self.clusters.unpersist()
+            self._set_clusters(trees)
+        else:
+            self._set_clusters(_repr_trees_mp(self.mp_context, self.clusters, st, repr_fanout, dist_func,
+                                              self.data_normalized, self._window_stats, metrics))
+
+    def _build_levels(self, st_levels: list, dist_func, pnorm, metrics: dict, repr_fanout: int = None):
+        """
+        cluster the levels of st_levels from the clusters of st_levels[0], the clusters are then the finest level of
+        cluster_levels
+        :param repr_fanout: if given, the coarser levels are given the trees of their representatives
+        """
+        if self.is_using_spark():
+            self.cluster_levels = _spark_backend()._cluster_levels_spark(
+                self.mp_context, self.clusters, st_levels, dist_func, self.data_normalized, pnorm,
+                self._window_stats, metrics, repr_fanout)
+            self.clusters.unpersist()
+            sizes = self.cluster_levels.flatMap(lambda x: [(st, len(c)) for st, c in x[1].items()]). \
+                reduceByKey(lambda x, y: x + y).collect()
+        else:
+            self.cluster_levels = _cluster_levels_mp(self.mp_context, self.clusters, st_levels, dist_func,
+                                                     self.data_normalized, pnorm, self._window_stats, metrics,
+                                                     repr_fanout)
+            sizes = reduce_by_key(lambda x, y: x + y, [(st, len(c)) for _, levels in flatten(self.cluster_levels)
+                                                       for st, c in levels.items()])
+        self._set_clusters(self._level_clusters(st_levels[0]))  # the finest level is not held twice
+        metrics['levels'] = dict(sorted(sizes))
+
+    def _get_level(self, st: float = None) -> float:
+        """
+        :return: the similarity threshold of the level a query with st searches: the coarsest level built at or below
+        st, the build st if st is None or below every level
+        """
+        st_levels = self.build_conf.get('st_levels') or [self.build_conf.get('similarity_threshold')]
+        below = [x for x in st_levels if st is not None and x <= st]
+        return max(below) if below else st_levels[0]
+
+    def _get_clusters(self, st: float = None):
+        """
+        :return: the clusters of the level of st, see _get_level, in the form of clusters
+        """
+        level = self._get_level(st)
+        if self.cluster_levels is None or level == self._get_level():
+            return self.clusters
+        return self._level_clusters(level)
+
+    def _level_clusters(self, level: float):
+        """
+        :return: the clusters of the level of cluster_levels clustered at level, with the partitions of cluster_levels
+        """
+        if self.is_using_spark():
+            return self.cluster_levels.map(lambda x: (x[0], x[1][level]))
+        return [[(seq_len, levels[level]) for seq_len, levels in c] for c in self.cluster_levels]
+
+    def estimate_build(self, loi=None, normalize: str = None, length_step: int = 1, st_levels=None,
+                       repr_fanout: int = None) -> dict:
+        """
+        estimate the memory a build with the given loi and normalize would take, without building
+        :param length_step: estimate for clustering only every length_step-th length of the loi
+        :param st_levels: the st_levels of the build, their clusters are counted too
+        :param repr_fanout: the repr_fanout of the build, the trees of the representatives are counted too
+        :return: see brainex.utils.memory_utils.estimate_build, the sizes are in bytes
+        """
+        start, end = _process_loi(loi, max_len=self.get_max_seq_len())
+        return estimate_build(self.data_normalized, start, end, length_step, normalize,
+                              num_levels=1 + len(st_levels or []), repr_fanout=repr_fanout)
+
+    def _partition_by_length(self):
+        """
+        regroup the clusters by ranges of length holding about the same number of subsequences, keeping the number
+        of partitions
+        """
+        length_counts = dict([(seq_len, n) for seq_len, (_, n) in length_directory(self.cluster_meta_dict).items()])
+        if self.is_using_spark():
+            bounds = length_range_bounds(length_counts, self.clusters.getNumPartitions())
+            self.clusters = _spark_backend()._partition_by_length_spark(self.clusters, bounds)
+        else:
+            bounds = length_range_bounds(length_counts, len(self.clusters))
+            self.clusters = _partition_by_length_mp(self.clusters, bounds)
+
+    def _set_window_stats(self):
+        """
+        compute the running sums needed by normalize='subsequence' builds, or drop them for other builds
+        """
+        if self.build_conf.get('normalize') == 'subsequence':
+            self._window_stats = running_sums(self.data_normalized)
+            if self.is_using_spark():
+                self._window_stats_bc = self.mp_context.broadcast(self._window_stats)
+        else:
+            self._window_stats = None
+            self._window_stats_bc = None
+
+    def _get_window_stats(self):
+        """
+        :return: the running sums in the form the backend expects (broadcast for Spark), None if the build does not
+        z-normalize subsequences
+        """
+        return self._window_stats_bc if self.is_using_spark() else self._window_stats
+
+    def _normalize_query(self, query: Sequence):
+        """
+        z-normalize the query when the database is built with normalize='subsequence', the given query is not modified
+        """
+        if self.build_conf.get('normalize') != 'subsequence':
+            return query
+        data = np.asarray(query.data, dtype=np.float64)
+        return Sequence(seq_id=query.seq_id, start=query.start, end=query.end,
+                        data=z_normalize_window(data, np.mean(data), np.std(data)))
 
     def get_cluster(self, rprs: Sequence):
         length = None
@@ -204,9 +420,14 @@ class GenexEngine:
             assert self.clusters is not None
         except AssertionError:
             raise Exception('get_num_subsequences: the database must be build before calling this function')
-        return self.subsequences.count() if self.is_using_spark() else len(self.subsequences)
+        if self.is_using_spark():
+            return self.subsequences.count()
+        if self.subsequences is None:  # not kept by the build, every subsequence is in a cluster
+            return sum(sum(reprs.values()) for reprs in self.cluster_meta_dict.values())
+        return len(self.subsequences)
 
-    def query_brute_force(self, query: Sequence, best_k: int, _use_cache: bool = True, _piecewise: str = None, _use_built_piecewise: bool=True):
+    def query_brute_force(self, query: Sequence, best_k: int, _use_cache: bool = True, _piecewise: str = None, _use_built_piecewise: bool=True,
+                          time_budget_ms: float = None, callback=None):
         """
         Retrieve best k matches for query sequence using Brute force method
 
@@ -214,12 +435,26 @@ class GenexEngine:
         :param query: Sequence being queried
         :param best_k: Number of best matches to retrieve for the given query
         :param _piecewise: number of segments of time series reduction while applying piecewise aggregation approximation representative
+        :param time_budget_ms: if given, the query returns what it has found once this many milliseconds have passed.
+        The subsequences are compared in increasing order of their lb_kim to the query.
+        :param callback: function called with the best k matches so far every time a slice of the subsequences is
+        searched
 
-        :return: a list containing best k matches for given query sequence
+        :return: a list containing best k matches for given query sequence. With time_budget_ms, a tuple of this list
+        and whether it is final: True if every subsequence was compared, the matches are then exact
         """
         query = self._process_query(query)
         dist_type = self.build_conf.get('dist_type')
         dt_index = dt_pnorm_dict[dist_type]
+        if _piecewise and self.build_conf.get('normalize') == 'subsequence':
+            raise Exception('query_brute_force: piecewise query is not supported with normalize=\'subsequence\'')
+        if _piecewise and (time_budget_ms is not None or callback is not None):
+            raise Exception('query_brute_force: piecewise query is not supported with time_budget_ms or callback')
+        query = self._normalize_query(query)
+
+        if time_budget_ms is not None or callback is not None:
+            rtn, is_final = self._qbf_budget(query, dt_index, best_k, _use_cache, time_budget_ms, callback)
+            return rtn if time_budget_ms is None else (rtn, is_final)
 
         candidate_list = self._qbf(query, dt_index, best_k, _use_cache, _piecewise, _use_built_piecewise)
         rtn = candidate_list[:best_k]
@@ -239,32 +474,35 @@ class GenexEngine:
                 if query_data is None:
                     query_data = self.get_seq_data(query)
                 if not piecewise:
-                    candidate_list = _query_bf_spark(query, self.subsequences, dt_index, data_list=dn)
+                    candidate_list = _spark_backend()._query_bf_spark(query, self.subsequences, dt_index, data_list=dn,
+                                                                      window_stats=self._get_window_stats())
                 elif piecewise == 'paa':
                     if _use_built_piecewise:
                         try:
                             assert 'paa' in self.build_conf['piecewise']
                         except AssertionError:
                             raise Exception('genexengine: must build_piece with the mode paa before querying with it')
-                        candidate_list = _query_paa_spark(query, self.subsequences_paa, dt_index,
-                                                          self.build_conf['n_segment'])
+                        candidate_list = _spark_backend()._query_paa_spark(query, self.subsequences_paa, dt_index,
+                                                                           self.build_conf['n_segment'])
                     else:
-                        candidate_list = _query_piecewise_spark(query_data, self.subsequences, dt_index,  data_list=dn,
-                                                                piecewise=piecewise, n_segment=self.build_conf['n_segment'])
+                        candidate_list = _spark_backend()._query_piecewise_spark(
+                            query_data, self.subsequences, dt_index, data_list=dn, piecewise=piecewise,
+                            n_segment=self.build_conf['n_segment'])
                 elif piecewise == 'sax':
                     if _use_built_piecewise:
                         try:
                             assert 'sax' in self.build_conf['piecewise']
                         except AssertionError:
                             raise Exception('genexengine: must build_piece with the mode sax before querying with it')
-                        candidate_list = _query_sax_spark(query, self.subsequences_sax, dt_index,
-                                                          self.build_conf['n_segment'])
+                        candidate_list = _spark_backend()._query_sax_spark(query, self.subsequences_sax, dt_index,
+                                                                           self.build_conf['n_segment'])
                     else:
-                        candidate_list = _query_piecewise_spark(query_data, self.subsequences, dt_index,  data_list=dn,
-                                                                piecewise=piecewise, n_segment=self.build_conf['n_segment'])
+                        candidate_list = _spark_backend()._query_piecewise_spark(
+                            query_data, self.subsequences, dt_index, data_list=dn, piecewise=piecewise,
+                            n_segment=self.build_conf['n_segment'])
             else:
-                candidate_list = _query_bf_mp(query, self.mp_context, self.subsequences, dt_index, piecewise,
-                                              data_list=dn)
+                candidate_list = _query_bf_mp(query, self.mp_context, self._get_subsequences(), dt_index, piecewise,
+                                              data_list=dn, window_stats=self._get_window_stats())
         else:
             print('bf_query: using buffered bf results')
         if use_cache:
@@ -273,6 +511,33 @@ class GenexEngine:
         candidate_list.sort(key=lambda x: x[0])
         return candidate_list
 
+    def _qbf_budget(self, query, dt_index, best_k, use_cache, time_budget_ms, callback):
+        """
+        brute force query with a time budget and progressive results, the partial results are not cached
+        :return: (best k matches, whether every subsequence was compared)
+        """
+        candidate_list = self.check_bf_query_cache(query, best_k=best_k) if use_cache else None
+        if candidate_list:
+            candidate_list.sort(key=lambda x: x[0])
+            return candidate_list[:best_k], True
+
+        deadline = None if time_budget_ms is None else time.time() + time_budget_ms / 1000
+        if self.is_using_spark():
+            results = _spark_backend()._query_bf_budget_spark(query, self.subsequences, dt_index,
+                                                              self._data_normalized_bc, best_k,
+                                                              self._get_window_stats(), deadline,
+                                                              stream=callback is not None)
+        else:
+            results = _query_bf_budget_mp(query, self.mp_context, self._get_subsequences(), dt_index,
+                                          self.data_normalized, best_k, self._get_window_stats(), deadline)
+        best_matches, is_final = [], True
+        for matches, is_complete in results:
+            best_matches = heapq.nsmallest(best_k, best_matches + matches, key=lambda x: x[0])
+            is_final = is_final and is_complete
+            if callback is not None:
+                callback(best_matches)
+        return best_matches, is_final
+
     def check_bf_query_cache(self, query, best_k):
         key = query
         try:
@@ -283,9 +548,9 @@ class GenexEngine:
     def set_piecewise_segment(self, n_segment: int):
         self.build_conf['n_segment'] = n_segment
 
-    def reset_mp(self, use_spark, **kwargs):
+    def reset_mp(self, use_spark, backend: str = None, **kwargs):
         self.stop()
-        self.mp_context = _multiprocess_backend(use_spark, **kwargs)
+        self.mp_context = _multiprocess_backend(use_spark, backend, **kwargs)
 
     def build_piecewise(self, mode: str, n_segment: int = 3, _dummy_slicing: bool = False):
         """
@@ -294,15 +559,18 @@ class GenexEngine:
         creates PAA compressed version of all the subsequences
         :param resize_by:
         """
-        if self.subsequences is None:  # must be run after building
+        if self.clusters is None:  # must be run after building
             raise Exception \
                 ('GenexEngine: engine not build, GenexEngine.build(...) must be called prior to this function')
         if self.is_using_spark():
             dn = self._data_normalized_bc if self.is_using_spark() else self.data_normalized
             start, end = self.build_conf.get('loi')
-            piecewise_kv_rdd = _build_piecewise_spark(self.subsequences, mode, n_segment, data_list=dn,
-                                                      _dummy_slicing=_dummy_slicing, _sc=self.mp_context, _start=start,
-                                                      _end=end)
+            with timed(self.metrics['build'], 'piecewise'):
+                piecewise_kv_rdd = _spark_backend()._build_piecewise_spark(self.subsequences, mode, n_segment,
+                                                                           data_list=dn,
+                                                                           _dummy_slicing=_dummy_slicing,
+                                                                           _sc=self.mp_context, _start=start,
+                                                                           _end=end)
 
         else:
             # _build_paa(self.mp_context)
@@ -363,7 +631,16 @@ class GenexEngine:
         return rtn
 
     def get_subsequences(self):
-        return self.subsequences.collect() if self.is_using_spark() else self.subsequences
+        return self.subsequences.collect() if self.is_using_spark() else self._get_subsequences()
+
+    def _get_subsequences(self):
+        """
+        :return: the flat list of subsequences on the multiprocess and thread backends, taken from the clusters if the
+        build did not keep it
+        """
+        if self.subsequences is None and self.clusters is not None:
+            return _subsequences_of_clusters(self.clusters)
+        return self.subsequences
 
     def get_norm_ts_list(self):
         return [Sequence(seq_id=x[0], start=0, end=len(x[1]) - 1, data=x[1]) for x in self.data_normalized]
@@ -415,17 +692,30 @@ class GenexEngine:
         if self.is_using_spark():
             self.clusters.saveAsPickleFile(os.path.join(path, 'clusters.gxe'))
             self.subsequences.saveAsPickleFile(os.path.join(path, 'subsequences.gxe'))
+            if self.cluster_levels is not None:
+                self.cluster_levels.saveAsPickleFile(os.path.join(path, 'cluster_levels.gxe'))
         else:
             pickle.dump(self.clusters, open(os.path.join(path, 'clusters.gxe'), 'wb'))
             pickle.dump(self.subsequences, open(os.path.join(path, 'subsequences.gxe'), 'wb'))
+            if self.cluster_levels is not None:
+                pickle.dump(self.cluster_levels, open(os.path.join(path, 'cluster_levels.gxe'), 'wb'))
 
     def load_cluster(self, path):
+        self.cluster_levels = None
         if self.is_using_spark():
             self._set_clusters(self.get_mp_context().pickleFile(os.path.join(path, 'clusters.gxe/*')))
             self._set_subsequences(self.get_mp_context().pickleFile(os.path.join(path, 'subsequences.gxe/*')))
+            if os.path.exists(os.path.join(path, 'cluster_levels.gxe')):
+                self.cluster_levels = self.get_mp_context().pickleFile(os.path.join(path, 'cluster_levels.gxe/*'))
+                finest = min(self.cluster_levels.first()[1].keys())
         else:
             self._set_clusters(pickle.load(open(os.path.join(path, 'clusters.gxe'), 'rb')))
             self._set_subsequences(pickle.load(open(os.path.join(path, 'subsequences.gxe'), 'rb')))
+            if os.path.exists(os.path.join(path, 'cluster_levels.gxe')):
+                self.cluster_levels = pickle.load(open(os.path.join(path, 'cluster_levels.gxe'), 'rb'))
+                finest = min(flatten(self.cluster_levels)[0][1].keys())
+        if self.cluster_levels is not None:  # the levels are searched with the partitions of the clusters
+            self._set_clusters(self._level_clusters(finest))
 
     def is_id_exists(self, sequence: Sequence):
         return sequence.seq_id in dict(self.data_original).keys()
@@ -452,7 +742,9 @@ class GenexEngine:
     def query(self, query, best_k: int,
               id_filter=None, filter_mode=None, loi=None,
               exclude_same_id: bool = False, overlap: float = 1.0,
-              _lb_opt: bool = False, _ke=None, _radius: int = 1, _ke_factor: int = 1):
+              _lb_opt: bool = False, _ke=None, _radius: int = 1, _ke_factor: int = 1,
+              time_budget_ms: float = None, callback=None, explain: bool = False, length_policy: str = 'nearest',
+              st: float = None):
         """
         Find best k matches for given query sequence using Distributed Genex method
 
@@ -469,18 +761,86 @@ class GenexEngine:
         :param exclude_same_id: Whether to exclude query sequence in the retrieved matches
         :param overlap: Value for overlapping parameter (Must be between 0 and 1 inclusive), this is to say any pair in
         the query result will no overlap more than <overlap> percent
-
-        :return: a list containing k best matches for given query sequence
+        :param time_budget_ms: if given, the query returns what it has found once this many milliseconds have passed.
+        The clusters are visited best first so the partial answer is made of the closest clusters searched.
+        :param callback: function called with the best k matches so far every time a partition returns
+        :param explain: whether to give the trace of the query after the result: the metrics of the query (see
+        get_metrics) with 'lengths_visited' and, in 'partitions', the search of every partition in every round: its
+        'time', its 'counts' (distances computed, candidates pruned by each lower bound, see
+        brainex.utils.metrics_utils), and for every length visited the representatives scored and the clusters
+        expanded. A query needs more than one round when the matches found overlap each other
+        :param length_policy: how the query is compared with the subsequences of the other lengths, as those of a
+        build with a length_step when the query length is not built: 'nearest' compares the query as it is, with DTW,
+        'scale' compares its uniform scaling to their length (linear interpolation), the distances of the matches are
+        then to the scaled query. Not supported with _lb_opt
+        :param st: the similarity threshold of the clusters to search, for a build with st_levels: the coarsest level
+        built at or below st is searched, the level of the build st if st is None or below every level. The levels
+        coarser than the one searched filter its representatives: theirs are ranked first, and only the
+        representatives of the level in the best coarse clusters are compared with q
+
+        :return: a list containing k best matches for given query sequence. With time_budget_ms, a tuple of this list
+        and whether it is final: True if the search finished within the budget, that is it is the same answer as
+        without time_budget_ms. With explain, the trace is added: (list, trace) or (list, is final, trace)
         """
         _validate_gxe_query_arguments(locals())
+        query_start = time.perf_counter()
+        metrics = {'rounds': 0, 'partitions_searched': 0}
+        query_args, plans = self._prepare_query(query, best_k, id_filter, filter_mode, loi, exclude_same_id, overlap,
+                                                _lb_opt, _ke, _radius, _ke_factor, explain, length_policy, st)
+        deadline = None if time_budget_ms is None else time.time() + time_budget_ms / 1000
+        best_matches = []
+        is_final = True
+        cursors = dict()  # partition -> where its search stopped, so that the next round does not start over
+        while len(best_matches) < best_k:
+            if deadline is not None and time.time() >= deadline:
+                is_final = False
+                break
+            candidates = []
+            metrics['rounds'] += 1
+            for i, matches, cursor in self._query_round(query_args, best_matches, cursors, deadline,
+                                                        stream=callback is not None, plans=plans):
+                cursors[i] = cursor
+                candidates += matches
+                metrics['partitions_searched'] += 1
+                add_counts(metrics, cursor['counts'])
+                if explain:
+                    metrics.setdefault('partitions', []).append(
+                        dict(cursor['trace'], round=metrics['rounds'], partition=i, time=cursor['time'],
+                             counts=cursor['counts']))
+                is_final = is_final and not cursor.get('timed_out')
+                if callback is not None:
+                    callback(_accept_matches(best_matches, candidates, best_k, overlap))
+            if len(candidates) == 0:  # every remaining subsequence overlaps the matches so far
+                break
+            best_matches = _accept_matches(best_matches, candidates, best_k, overlap)
+            if not is_final:
+                break
+        if self.is_using_spark():
+            query_args['q'].destroy()
+        metrics['wall_time'] = time.perf_counter() - query_start
+        self.metrics['query'] = metrics
+        rtn = (best_matches,) if time_budget_ms is None else (best_matches, is_final)
+        if explain:
+            metrics['lengths_visited'] = sorted(set(seq_len for p in metrics.get('partitions', [])
+                                                    for seq_len in p['lengths']))
+            rtn += (metrics,)
+        return rtn[0] if len(rtn) == 1 else rtn
+
+    def _prepare_query(self, query, best_k, id_filter, filter_mode, loi, exclude_same_id, overlap, _lb_opt, _ke,
+                       _radius, _ke_factor, explain=False, length_policy='nearest', st=None):
+        """
+        :return: (keyword arguments of brainex.op.query_op._query_partition for the query but the ones that change
+        from round to round, partition index -> plan of the partition or None). With Spark, the query in the arguments
+        is broadcast and must be destroyed by the caller
+        """
         if loi:
             start, end = process_loi_query(loi, self.build_conf.get('loi'))
             loi = (start, end)
             pass
-        query = self._process_query(query)
+        query = self._normalize_query(self._process_query(query))
 
         _ke = self._process_ke(_ke_factor, best_k)
-        st = self.build_conf.get('similarity_threshold')
+        st = self._get_level(st)
         dist_type = self.build_conf.get('dist_type')
 
         dn = self._data_normalized_bc if self.is_using_spark() else self.data_normalized
@@ -490,61 +850,254 @@ class GenexEngine:
         query_args = {'q': q, 'k': best_k, 'ke': _ke, 'data_normalized': dn, 'pnorm': dt_pnorm_dict[dist_type],
                       'lb_opt': _lb_opt, 'exclude_same_id': exclude_same_id, 'radius': _radius,
                       'st': st, 'overlap': overlap,
-                      'id_filter': id_filter, 'filter_mode': filter_mode, 'loi': loi
+                      'id_filter': id_filter, 'filter_mode': filter_mode, 'loi': loi,
+                      'window_stats': self._get_window_stats(), 'explain': explain, 'length_policy': length_policy
                       }
-        best_matches = []
-        while len(best_matches) < best_k:
-            if self.is_using_spark():  # The only place in query where it checks if is using Spark
-                query_rdd: RDD = self.clusters.mapPartitions(
-                    lambda c: _query_partition(**query_args, cluster=c, prev_matches=best_matches))
-                candidates = query_rdd.collect()
-            else:
-                candidates = _query_mp(self.mp_context, self.clusters, **query_args)
-            #### testing distribute query vs. one-core query
-            # result_distributed = query_rdd.collect()
-            # result_distributed.sort(key=lambda x: x[0])
-            # result_distributed = result_distributed[:10]
-            # result_one_core = a
-            # result_one_core.sort(key=lambda x: x[0])
-            # result_one_core = result_one_core[:10]
-            # is_same = np.equal(result_distributed, result_one_core)
-
-            # apply overlap
-            # note that we are using k here
-            # while len(c_dist_list) > 0 and len(query_result) < k:
-            #     c_dist = heapq.heappop(c_dist_list)
-            #     if overlap == 1.0 or exclude_same_id:
-            #         query_result.append(c_dist)
-            #     else:
-            #         if not any(_isOverlap(c_dist[1], prev_match[1], overlap) for prev_match in
-            #                    query_result):  # check for overlap against all the matches so far
-            #             query_result.append(c_dist)
-            # return query_result
-            heapq.heapify(candidates)
-            while len(candidates) > 0:
-                if len(best_matches) >= best_k:
-                    break
-                this_c = heapq.heappop(candidates)
-                if overlap == 1.0:  # needless to consider overlap if same if as already been excluded
-                    best_matches.append(this_c)
-                else:  # if consider overlap
-                    if not any(_isOverlap(this_c[1], prev_match[1], overlap) for prev_match in best_matches):
-                        best_matches.append(this_c)
-                pass
+        # the lengths each partition searches first, counting the candidates of all the partitions toward ke
+        plans = None if _lb_opt else plan_query_lengths(self._get_partition_length_directory(), len(query.data),
+                                                        _radius, best_k, _ke, loi)
+        return query_args, plans
+
+    def _round_partitions(self, cursors, plans):
+        """
+        :return: (the partitions to search in the next round of a query, their plans or None)
+        """
+        if len(cursors) == 0 and plans is not None:  # first round, only the partitions with planned lengths
+            return [i for i, plan in plans.items() if len(plan['lens']) > 0], plans
+        # the partitions not searched yet widen the radius on their own
+        return [i for i in self._get_partition_length_directory().keys() if not _is_exhausted(cursors.get(i))], None
+
+    def _query_round(self, query_args, prev_matches, cursors, deadline, stream, plans=None):
+        """
+        one round of query over all the partitions, see brainex.op.query_op._query_partition
+        :param stream: whether to give the results of the partitions as they come
+        :param plans: partition index -> plan of the partition, or None to let the partitions widen the radius alone
+        :return: iterable of (partition index, matches, cursor)
+        """
+        partitions, plans = self._round_partitions(cursors, plans)
+        if self.is_using_spark():  # The only place in query where it checks if is using Spark
+            selected = set(partitions)
+            query_rdd = self._get_clusters(query_args['st']).mapPartitionsWithIndex(
+                lambda i, c: [(i,) + x for x in _query_partition(**query_args, cluster=c, prev_matches=prev_matches,
+                                                                 cursor=cursors.get(i), deadline=deadline,
+                                                                 plan=plans.get(i) if plans else None)]
+                if i in selected else [])
+            if stream:  # the partitions left out return right away
+                return query_rdd.toLocalIterator(prefetchPartitions=True)
+            return self.mp_context.runJob(query_rdd, lambda x: x, partitions=partitions)
+        else:
+            return _query_mp(self.mp_context, self._get_clusters(query_args['st']), cursors, deadline, stream, plans,
+                             partitions, **query_args, prev_matches=prev_matches)
+
+    def range_query(self, query, eps: float, loi=None, exact_dist: bool = False):
+        """
+        find every subsequence within eps of the query. Unlike query, the distance is the one the database is built
+        with (see dt_func_dict) so that whole clusters can be included or excluded by their radius; the query is
+        linearly resampled to the lengths other than its own.
+
+        :param query: Sequence or iterable of numbers
+        :param eps: distance threshold, inclusive
+        :param loi: length of interest, defaults to the length of the query
+        :param exact_dist: whether to compute the distance of the subsequences included by the cluster bounds without
+        being compared, otherwise their distance is None
+        :return: a generator of (distance, Sequence), in no particular order
+        """
+        try:
+            assert self.clusters is not None
+        except AssertionError:
+            raise Exception('range_query: the engine must be built before querying')
+        query = self._normalize_query(self._process_query(query))
+        start, end = process_loi_query(loi if loi else (len(query), len(query)), self.build_conf.get('loi'))
+
+        dn = self._data_normalized_bc if self.is_using_spark() else self.data_normalized
+        # order of this kwargs MUST be perserved in accordance to genex.op.query_op._range_query_partition
+        query_args = {'q': query, 'eps': eps, 'data_normalized': dn,
+                      'pnorm': dt_pnorm_dict[self.build_conf.get('dist_type')], 'loi': (start, end),
+                      'exact_dist': exact_dist, 'window_stats': self._get_window_stats()}
         if self.is_using_spark():
-            q.destroy()
-            query_rdd.unpersist()
-        return best_matches
+            return self.clusters.mapPartitions(lambda c: _range_query_partition(c, **query_args)).toLocalIterator()
+        else:
+            return _range_query_mp(self.mp_context, self.clusters, **query_args)
+
+    def similarity_join(self, other=None, eps: float = None, loi=None):
+        """
+        find every pair of subsequences (a, b) of the same length within eps of each other, a from this engine and b
+        from other, in one job. The clusters are matched against each other before any member is compared, so both
+        engines must be built with the same dist_type and normalize. Like range_query, the distance is the one the
+        database is built with.
+
+        :param other: the engine to join with, joins this engine with itself if None; the trivial matches are then
+        excluded and every pair is given once. The data of other is compared on the scale of this engine, both must be
+        loaded with the same _is_z_normalize
+        :param eps: distance threshold, inclusive, defaults to the similarity threshold of this engine
+        :param loi: length of interest, defaults to the build loi
+        :return: list of (distance, a (Sequence), b (Sequence)), sorted by distance
+        """
+        self_join = other is None or other is self
+        other = self if self_join else other
+        try:
+            assert self.clusters is not None and other.clusters is not None
+        except AssertionError:
+            raise Exception('similarity_join: both engines must be built before joining')
+        for key in ['dist_type', 'normalize']:
+            if self.build_conf.get(key) != other.build_conf.get(key):
+                raise Exception('similarity_join: both engines must be built with the same ' + key)
+        eps = self.build_conf.get('similarity_threshold') if eps is None else eps
+        start, end = process_loi_query(loi, self.build_conf.get('loi')) if loi else self.build_conf.get('loi')
+        pnorm = dt_pnorm_dict[self.build_conf.get('dist_type')]
+
+        if self_join or self.build_conf.get('normalize') == 'subsequence':  # z-normalized windows do not depend on scale
+            data_b, scale_b = other.data_normalized, 1.
+        else:
+            data_b = [(seq_id, self.normalize(other.inverse_normalize(ts))) for seq_id, ts in other.data_normalized]
+            scale_b = (other.conf['global_max'] - other.conf['global_min']) / \
+                      (self.conf['global_max'] - self.conf['global_min'])
+
+        if self.is_using_spark():
+            data_b_bc = self._data_normalized_bc if self_join else self.mp_context.broadcast(data_b)
+            rtn = _spark_backend()._join_spark(self.clusters, other.clusters, start, end, eps,
+                                               self._data_normalized_bc, data_b_bc, pnorm, scale_b,
+                                               self._window_stats_bc, other._window_stats_bc, self_join)
+            if not self_join:
+                data_b_bc.destroy()
+        else:
+            rtn = _join_mp(self.mp_context, self.clusters, other.clusters, start, end, eps, self.data_normalized,
+                           data_b, pnorm, scale_b, self._window_stats, other._window_stats, self_join)
+        rtn.sort(key=lambda x: x[0])
+        return rtn
+
+    def get_metrics(self):
+        """
+        :return: {'build': metrics of the last build, 'query': metrics of the last query}, None for the ones not run
+        yet. The build metrics hold the wall time of the phases (grouping, clustering, meta_reduction, partitioning,
+        piecewise), the number of subsequences and clusters of every length, the counters of the kernels (dist_calls,
+        lb_pruned), the bytes sent to the workers (an estimate, the clusters and subsequences sent are counted rather
+        than pickled again, the data sent with every task is pickled once, in object_bytes) and the peak resident set
+        size of the driver and the workers. The
+        query metrics hold the rounds, the partitions searched and the counters of the kernels
+        """
+        return copy.deepcopy(self.metrics)
+
+    def export_metrics(self, path: str):
+        """
+        write get_metrics to path as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump(self.get_metrics(), f, indent=2, default=str)
+
+    def _peak_rss(self):
+        """
+        :return: {'driver': peak RSS of this process, 'workers': peak RSS of the largest worker process}, in bytes.
+        The workers of Spark are not measured
+        """
+        rtn = {'driver': peak_rss()}
+        if not self.is_using_spark() and not isinstance(self.mp_context, multiprocessing.pool.ThreadPool):
+            rtn['workers'] = children_peak_rss([w.pid for w in self.mp_context._pool])
+        return rtn
 
     def get_num_clusters(self):
         return len(flatten(self.cluster_meta_dict.values()))
 
-    def query_on_batch(self, query: Sequence, best_k: int, exclude_same_id: bool = False, overlap: float = 1.0,
-                       _lb_opt: bool = False, _ke=None, _radius: int = 1):
-        pass
+    def query_on_batch(self, queries: list, best_k: int,
+                       id_filter=None, filter_mode=None, loi=None,
+                       exclude_same_id: bool = False, overlap: float = 1.0,
+                       _lb_opt: bool = False, _ke=None, _radius: int = 1, _ke_factor: int = 1,
+                       length_policy: str = 'nearest', st: float = None):
+        """
+        query for every sequence of queries with the same arguments, see query. Every round searches the partitions
+        needed by all the queries in one job, each partition running the queries that need it, so the partitions are
+        sent to the workers once per round rather than once per query.
 
-    def query_bf_on_batch(self):
-        pass
+        :return: a list with the result of query for every sequence of queries
+        """
+        _validate_gxe_query_arguments(locals())
+        prepared = [self._prepare_query(q, best_k, id_filter, filter_mode, loi, exclude_same_id, overlap, _lb_opt,
+                                        _ke, _radius, _ke_factor, length_policy=length_policy, st=st) for q in queries]
+        best_matches = [[] for _ in queries]
+        cursors = [dict() for _ in queries]
+        active = set(range(len(queries)))
+        while len(active) > 0:
+            batches = dict()  # partition -> list of (query index, keyword arguments of _query_partition)
+            for j in active:
+                query_args, plans = prepared[j]
+                partitions, plans = self._round_partitions(cursors[j], plans)
+                for i in partitions:
+                    batches.setdefault(i, []).append(
+                        (j, dict(query_args, prev_matches=best_matches[j], cursor=cursors[j].get(i),
+                                 plan=plans.get(i) if plans else None)))
+            candidates = [[] for _ in queries]
+            for i, j, matches, cursor in self._query_batch_round(batches, st):
+                cursors[j][i] = cursor
+                candidates[j] += matches
+            for j in list(active):
+                if len(candidates[j]) == 0:  # every remaining subsequence overlaps the matches so far
+                    active.remove(j)
+                    continue
+                best_matches[j] = _accept_matches(best_matches[j], candidates[j], best_k, overlap)
+                if len(best_matches[j]) >= best_k:
+                    active.remove(j)
+        if self.is_using_spark():
+            for query_args, _ in prepared:
+                query_args['q'].destroy()
+        return best_matches
+
+    def _query_batch_round(self, batches: dict, st: float = None):
+        """
+        :param batches: partition index -> batch of the partition, see brainex.op.query_op._query_partition_batch
+        :param st: the st of the queries, the level searched is given by _get_level
+        :return: list of (partition index, query index, matches, cursor)
+        """
+        if len(batches) == 0:
+            return []
+        if self.is_using_spark():
+            return _spark_backend()._query_batch_spark(self.mp_context, self._get_clusters(st), batches)
+        return _query_batch_mp(self.mp_context, self._get_clusters(st), batches)
+
+    def query_bf_on_batch(self, queries: list, best_k: int):
+        """
+        query_brute_force for every sequence of queries in one job: the subsequences are fetched once for all the
+        queries. The results are not cached.
+
+        :return: a list with the best_k matches of every sequence of queries
+        """
+        queries = [self._normalize_query(self._process_query(q)) for q in queries]
+        dt_index = dt_pnorm_dict[self.build_conf.get('dist_type')]
+        if self.is_using_spark():
+            queries_bc = self.mp_context.broadcast(queries)
+            results = _spark_backend()._query_bf_batch_spark(queries_bc, self.subsequences, dt_index,
+                                                             self._data_normalized_bc, best_k,
+                                                             self._get_window_stats())
+            queries_bc.destroy()
+        else:
+            results = _query_bf_batch_mp(queries, self.mp_context, self._get_subsequences(), dt_index,
+                                         self.data_normalized, best_k, self._get_window_stats())
+        rtn = [[] for _ in queries]
+        for j, matches in results:
+            rtn[j] = heapq.nsmallest(best_k, rtn[j] + matches, key=lambda x: x[0])
+        return rtn
+
+    def get_query_batcher(self, window_ms: float = 5, max_batch: int = 32, max_in_flight: int = 256):
+        """
+        the QueryBatcher behind aquery, aquery_brute_force and apredict_label_knn, created with the given arguments on
+        the first call
+        """
+        if self._query_batcher is None:
+            self._query_batcher = QueryBatcher(self, window_ms=window_ms, max_batch=max_batch,
+                                               max_in_flight=max_in_flight)
+        return self._query_batcher
+
+    async def aquery(self, query, best_k: int, **kwargs):
+        """
+        asynchronous query: the queries awaited at the same time are gathered into batches run by query_on_batch,
+        see QueryBatcher. kwargs are the keyword arguments of query_on_batch
+        """
+        return await self.get_query_batcher().submit(self.query_on_batch, query, best_k, **kwargs)
+
+    async def aquery_brute_force(self, query, best_k: int):
+        """
+        asynchronous query_brute_force, batched the same way as aquery with query_bf_on_batch
+        """
+        return await self.get_query_batcher().submit(self.query_bf_on_batch, query, best_k)
 
     def _process_query(self, query):
         if type(query) is Sequence:
@@ -568,6 +1121,29 @@ class GenexEngine:
 
     def set_cluster_meta_dict(self, cluster_meta_dict):
         self.cluster_meta_dict = cluster_meta_dict
+        self._length_directory = None
+
+    def get_length_directory(self):
+        """
+        :return: seq_len -> (number of clusters, number of represented sequences), derived from cluster_meta_dict
+        """
+        try:
+            assert self.cluster_meta_dict is not None
+        except AssertionError:
+            raise Exception('get_length_directory: the database must be build before calling this function')
+        if self._length_directory is None:
+            self._length_directory = length_directory(self.cluster_meta_dict)
+        return self._length_directory
+
+    def _get_partition_length_directory(self):
+        """
+        :return: partition index -> seq_len -> (number of clusters, number of represented sequences), this is
+        get_length_directory broken down by partition
+        """
+        if self._partition_length_directory is None:
+            self._partition_length_directory = _spark_backend()._partition_length_directory_spark(self.clusters) \
+                if self.is_using_spark() else _partition_length_directory_mp(self.clusters)
+        return self._partition_length_directory
 
     def get_max_seq_len(self):
         return max([len(x[1]) for x in self.data_normalized])
@@ -576,6 +1152,8 @@ class GenexEngine:
         """
         Must be called before removing a gxe object
         """
+        if self._query_batcher is not None:
+            self._query_batcher.close()
         if self.is_using_spark():
             self.mp_context.stop()
         else:
@@ -616,14 +1194,84 @@ class GenexEngine:
             return pattern_list[:k]
         else:
             rtn = []
+            rtn_index = OverlapIndex(overlap)
             while len(pattern_list) > 0 and len(rtn) < k:
                 cur = pattern_list.pop(0)
-                truth = [_isOverlap(cur[0], x[0], overlap) for x in rtn]
-                if not any(_isOverlap(cur[0], x[0], overlap) for x in
-                           rtn):  # check for overlap against all the matches so far
+                if not rtn_index.is_overlapping(cur[0]):  # check for overlap against all the matches so far
                     rtn.append(cur)
+                    rtn_index.add(cur[0])
             return rtn
 
+    def motif_matrix_profile(self, k, loi=None, overlap: float = 0.5, _exclusion: float = 0.25):
+        """
+        find the top k motifs with the matrix profile (STOMP) of the normalized data: the subsequences whose nearest
+        neighbour in the database is the closest. Unlike motif, this does not need the database to be built.
+        The distance is the z-normalized euclidean distance divided by sqrt(length), so that motifs of different
+        lengths can be ranked together.
+
+        :param k: number of motifs
+        :param loi: length of interest, an iterable of one or two integers as in build. Defaults to the build loi.
+        :param overlap: the motifs will not overlap more than this, pairwise
+        :param _exclusion: fraction of the length around a subsequence where matches in its own time series are
+        considered trivial
+        :return list of tuples: [distance to the nearest neighbour, motif (Sequence), nearest neighbour (Sequence)]
+        """
+        return self._matrix_profile_top_k(k, loi, overlap, _exclusion, discord=False)
+
+    def discord_matrix_profile(self, k, loi=None, overlap: float = 0.5, _exclusion: float = 0.25):
+        """
+        find the top k discords with the matrix profile (STOMP) of the normalized data: the subsequences that are
+        the farthest from their nearest neighbour. Takes the same arguments as motif_matrix_profile.
+
+        :return list of tuples: [distance to the nearest neighbour, discord (Sequence), nearest neighbour (Sequence)]
+        """
+        return self._matrix_profile_top_k(k, loi, overlap, _exclusion, discord=True)
+
+    def _matrix_profile_top_k(self, k, loi, overlap, exclusion, discord):
+        if loi is None:
+            try:
+                assert self.build_conf is not None
+            except AssertionError:
+                raise Exception('matrix profile: must give a loi if the engine is not built')
+            start, end = self.build_conf.get('loi')
+        else:
+            start, end = _process_loi(loi, max_len=self.get_max_seq_len())
+        lengths = list(range(max(start, 2), end + 1))  # a window of length one can not be z-normalized
+
+        if self.is_using_spark():
+            if self._data_normalized_bc is None:
+                self._data_normalized_bc = self.mp_context.broadcast(self.data_normalized)
+            return _spark_backend()._matrix_profile_top_k_spark(self.mp_context, self._data_normalized_bc, lengths,
+                                                                k, overlap, exclusion, discord)
+        else:
+            return _matrix_profile_top_k_mp(self.mp_context, self.data_normalized, lengths, k, overlap, exclusion,
+                                            discord)
+
+    def discords(self, k, loi=None, overlap: float = 0.5):
+        """
+        find the top k discords of the built database: the subsequences that are the farthest from their nearest
+        (non-overlapping) neighbour of the same length. The clusters bound the nearest neighbour distances, so only
+        a fraction of the subsequences are compared against the others.
+
+        :param k: number of discords
+        :param loi: length of interest, defaults to the build loi
+        :param overlap: the discords will not overlap more than this, pairwise
+        :return list of tuples: [distance to the nearest neighbour, discord (Sequence), nearest neighbour (Sequence)]
+        """
+        try:
+            assert self.clusters is not None
+        except AssertionError:
+            raise Exception('discords: the engine must be built before searching for discords')
+        start, end = process_loi_query(loi, self.build_conf.get('loi')) if loi else self.build_conf.get('loi')
+        pnorm = dt_pnorm_dict[self.build_conf.get('dist_type')]
+
+        if self.is_using_spark():
+            return _spark_backend()._discords_spark(self.clusters, start, end, k, overlap,
+                                                    self._data_normalized_bc, pnorm, self._window_stats_bc)
+        else:
+            return _discords_mp(self.mp_context, self.clusters, start, end, k, overlap, self.data_normalized, pnorm,
+                                self._window_stats)
+
     def predice_label_knn(self, query, k, label_index, verbose=0):
         """
         will return None if the voting result result in a tie
@@ -635,8 +1283,23 @@ class GenexEngine:
             assert label_index < self.feature_num - 1
         except AssertionError as e:
             raise Exception('Given label index is out of bound of the number of features in the dataset')
+        return self._vote_label(self.query(query, k, exclude_same_id=True), label_index, verbose)
+
+    async def apredict_label_knn(self, query, k, label_index, verbose=0):
+        """
+        asynchronous predice_label_knn, the neighbours are found with aquery
+        """
+        try:
+            assert label_index < self.feature_num - 1
+        except AssertionError as e:
+            raise Exception('Given label index is out of bound of the number of features in the dataset')
+        return self._vote_label(await self.aquery(query, k, exclude_same_id=True), label_index, verbose)
+
+    def _vote_label(self, kn, label_index, verbose=0):
+        """
+        :return: the label the most common among the neighbours kn, None if there is a tie
+        """
         label_index = label_index + 1 if self.conf['has_uuid'] else label_index
-        kn = self.query(query, k, exclude_same_id=True)
         kn_labels = [n[1].seq_id[label_index] for n in kn]
         try:
             res = mode(kn_labels)
@@ -660,6 +1323,26 @@ class GenexEngine:
         return _inverse_min_max_normalize_single(array, global_max=self.conf['global_max'], global_min=self.conf['global_min'])
 
 
+def _accept_matches(best_matches: list, candidates: list, best_k: int, overlap: float):
+    """
+    :return: best_matches completed by the best candidates up to best_k, leaving out the ones that overlap a match
+    """
+    rtn = list(best_matches)
+    match_index = OverlapIndex(overlap)  # the matches so far, indexed for the overlap check
+    for m in rtn:
+        match_index.add(m[1])
+    candidates = list(candidates)
+    heapq.heapify(candidates)
+    while len(candidates) > 0 and len(rtn) < best_k:
+        this_c = heapq.heappop(candidates)
+        if overlap == 1.0:  # needless to consider overlap if same if as already been excluded
+            rtn.append(this_c)
+        elif not match_index.is_overlapping(this_c[1]):  # if consider overlap
+            rtn.append(this_c)
+            match_index.add(this_c[1])
+    return rtn
+
+
 def _is_overlap(seq1: Sequence, seq2: Sequence, overlap: float) -> bool:
     """
      Check for overlapping between two time series sequences
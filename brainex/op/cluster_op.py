@@ -6,7 +6,11 @@ import numpy as np
 import math
 
 from brainex.classes.Sequence import Sequence
-from brainex.utils.ts_utils import lb_kim_sequence
+from brainex.classes.TreeCluster import TreeCluster
+from brainex.utils.ts_utils import lb_kim_sequence, window_mean_std, z_endpoints, z_normalize_window
+from brainex.utils.metrics_utils import count, DIST, DIST_DERIVED, LB_PRUNED, LB_KIM_PRUNED
+
+MAX_TREE_ST = 1.  # build_repr_tree doubles the threshold up to this, the data being scaled to [0, 1]
 
 
 def _randomize(arr, seed=42):
@@ -31,109 +35,339 @@ def _randomize(arr, seed=42):
 
 def _build_clusters_dynamic(groups: list, st: float, dist_func, data_list, log_level: int, pnorm) -> list:
     """
-    the dynamic programming implementation of the clustering algorithm
-    :param groups:
-    :param st:
-    :param dist_func:
-    :param data_list:
-    :param log_level:
+    the dynamic programming implementation of the clustering algorithm: the lengths are clustered from the longest,
+    and the clusters of a length are seeded by the clusters of the next longer length. Trimming the representatives of
+    the longer length by the same points on the same side gives the representatives of this length, unless they come
+    closer than st / 2 to one another (see coalease_repr), and trimming their members gives members whose distance to
+    the trimmed representative is derived from the distance stored in the longer cluster, see _trimmed_dist. The
+    subsequences left, either too far from their trimmed representative or not in a longer cluster, are clustered as in
+    cluster_group_dist.
+    The distances between the representatives are kept from one length to the next the same way: only those of the new
+    representatives are computed, see pairwise_dist.
+    :param groups: iterable of (length, subsequences of that length)
+    :param pnorm: the p of the p-norm dist_func is based on, see brainex.database.genexengine.dt_pnorm_dict
+    :return: list of (length, cluster) as _build_clusters
     """
     group_dict = dict(groups)
-    subseq_lengths = list(group_dict.keys())
-    subseq_lengths.reverse()  # use reversed to start from longer
-    clusters = {}  # seq_len -> center_seq -> list of represented seq
-    for length in subseq_lengths:
-        preformed_c = dict()
+    data_dict = dict(data_list)
+    clusters = {}  # seq_len -> center_seq -> list of (distance, represented seq)
+    up_len, up_mt = None, None  # the length clustered before, the next longer one, and its representative distances
+    for length in sorted(group_dict.keys(), reverse=True):  # start from the longest
         group_target = group_dict[length]
-        if length + 1 not in clusters.keys():  # check if there is a cluster of current length + 1
-            cl, preformed_c = cluster_group_dist(group_target, st, length, dist_func=dist_func, data_list=data_list, preformed_c=preformed_c)
-            clusters[cl] = preformed_c
-        else:  # if the cluster of length 1+n exists, we use it as heuristics
-            reprs_up = np.array(list(clusters[length + 1].keys()), dtype=Sequence)
-            reprs_head_off = np.array([x.S(slice(1, None, None)) for x in reprs_up], dtype=Sequence)
-            reprs_tail_off = np.array([x.S(slice(None, -1, None)) for x in reprs_up], dtype=Sequence)
-            # TODO use the representative dist mt from length +1 to save calculation
-            stay_mask_head = coalease_repr(reprs_head_off, diameter=st, dist_func=dist_func, data_list=data_list)
-            stay_mask_tail = coalease_repr(reprs_tail_off, diameter=st, dist_func=dist_func, data_list=data_list)
-            # we keep the larger list of representatives
-            is_head_off = np.sum(stay_mask_head) > np.sum(stay_mask_tail)
-            reprs_preformed, stay_mask = (reprs_head_off, stay_mask_head) if is_head_off else (reprs_tail_off, stay_mask_tail)
-
-
-            # [x.fetch_and_set_data(data_list) for x in reprs_up]
-            # [x.fetch_and_set_data(data_list) for x in reprs_preformed]
-
-
-            r_trim_list = np.array([x.fetch_data(data_list)[0] for x in reprs_up], dtype=Sequence) \
-                if is_head_off else np.array([x.fetch_data(data_list)[-1] for x in reprs_up], dtype=Sequence)
-            # add to the new cluster
-            # now onto validating the represented sequences
-            # r is the centers from the masked (preformed) centers' list
-            # count = 0
-            # ori_len = len(group_target)
-            for r_up, r_trim, r in zip(reprs_up[stay_mask], r_trim_list[stay_mask], reprs_preformed[stay_mask]):  # repr_up is the representative from length+1 clusters
-                preformed_c[r] = []
-                for seq_up_dist_to_r, seq_up in clusters[length + 1][r_up]:
-                    seq_up_data = seq_up.fetch_data(data_list)
-                    seq_this = seq_up.S(slice(1, None, None)) if is_head_off else seq_up.S(slice(None, -1, None))
-                    seq_trim = seq_up_data[0] if is_head_off else seq_up_data[-1]
-
-                    if coalease_seq(r, seq_this, r_trim, seq_trim, seq_up_dist_to_r, st, dist_func, pnorm, data_list):
-                        if seq_this in group_target:
-                            # count += 1
-                            group_target.remove(seq_this)
-                            preformed_c[r].append(seq_this)
-
-            # print(str(count) + ' out of ' + str(ori_len) + ' subsequences pre-clustered')
-            cl, c = cluster_group_dist(group_target, st, length, dist_func=dist_func, data_list=data_list, preformed_c=preformed_c)
-            clusters[cl] = c
-
+        preformed_c, kept_mt = dict(), np.zeros((0, 0))
+        if up_len is not None:
+            preformed_c, kept_mt = _trim_clusters(clusters[up_len], up_mt, up_len - length, set(group_target), st,
+                                                  dist_func, data_list, data_dict, pnorm)
+            preformed = set(seq for members in preformed_c.values() for _, seq in members)
+            group_target = [x for x in group_target if x not in preformed]
+        clusters[length] = cluster_group_dist(group_target, st, length, dist_func=dist_func, data_list=data_list,
+                                              preformed_c=preformed_c)[1]
+        # the representatives kept come first in the cluster, the new ones after them
+        up_len, up_mt = length, _extend_dist_mt(kept_mt, list(clusters[length].keys()), data_dict, pnorm)
     return list(clusters.items())
 
 
-def coalease_seq(r, s, r_trm, s_trm, s_dist_to_r, st, dist_func, pnorm, data_list):
-    if pnorm == math.inf:  # if using chebyshev distance
-        dist_cal = 1
-    else:
-        dist_cal = s_dist_to_r ** pnorm - (r_trm - s_trm) ** pnorm
-    dist = dist_func(r.fetch_data(data_list), s.fetch_data(data_list))
+def _trim_clusters(cluster_up: dict, dist_mt_up: np.ndarray, n_trim: int, group: set, st: float, dist_func, data_list,
+                   data_dict: dict, pnorm):
+    """
+    seed the clusters of a length from the clusters cluster_up of the length n_trim points longer, trimming the
+    representatives and their members by n_trim points from the side that keeps the most representatives
+    :param dist_mt_up: the distances between the representatives of cluster_up, in its order
+    :param group: the subsequences of the length to cluster, the trimmed subsequences not in it are left out
+    :return: (the preformed clusters, representative -> list of (distance, member) with the members within st / 2, the
+    distances between their representatives)
+    """
+    reprs_up = list(cluster_up.keys())
+    trims = {'head': [x.S(slice(n_trim, None, None)) for x in reprs_up],
+             'tail': [x.S(slice(None, -n_trim, None)) for x in reprs_up]}
+    dist_mts, masks = dict(), dict()
+    for side, reprs in trims.items():
+        r_trim = np.array([_trimmed_points(r, n_trim, side, data_dict) for r in reprs_up])
+        dist_mts[side] = _trimmed_dist_mt(dist_mt_up, len(reprs_up[0]) if reprs_up else 0, r_trim,
+                                          [_seq_data(r, data_dict) for r in reprs], pnorm)
+        masks[side] = coalease_repr(dist_mts[side], diameter=st, candidates=[r in group for r in reprs])
+    side = 'head' if np.sum(masks['head']) > np.sum(masks['tail']) else 'tail'  # keep the most representatives
+
+    rtn = dict()
+    derived, computed = 0, 0
+    for r_up, r, stay in zip(reprs_up, trims[side], masks[side]):
+        if not stay:
+            continue
+        r_trim = _trimmed_points(r_up, n_trim, side, data_dict)
+        rtn[r] = []
+        for dist_up, s_up in cluster_up[r_up]:
+            s = s_up.S(slice(n_trim, None, None)) if side == 'head' else s_up.S(slice(None, -n_trim, None))
+            if s not in group:
+                continue
+            dist = _trimmed_dist(dist_up, len(s_up), r_trim, _trimmed_points(s_up, n_trim, side, data_dict), pnorm)
+            if dist is None:  # the bound is inconclusive
+                dist = dist_func(r.fetch_data(data_list), s.fetch_data(data_list))
+                computed += 1
+            else:
+                derived += 1
+            if dist <= st / 2.0:
+                rtn[r].append((dist, s))
+    count(DIST, computed)
+    count(DIST_DERIVED, derived)
+    return rtn, dist_mts[side][masks[side]][:, masks[side]]
+
+
+def _seq_data(seq: Sequence, data_dict: dict):
+    return data_dict[seq.seq_id][seq.start:seq.end + 1]
+
+
+def _trimmed_points(seq: Sequence, n_trim: int, side: str, data_dict: dict):
+    """
+    :return: the n_trim points trimmed from the head or the tail of seq
+    """
+    seq_data = data_dict[seq.seq_id]
+    return seq_data[seq.start:seq.start + n_trim] if side == 'head' else seq_data[seq.end - n_trim + 1:seq.end + 1]
+
 
-    assert dist_cal == dist
-    return dist < st / 2.0
+def _trimmed_dist(dist_up: float, len_up: int, r_trim, s_trim, pnorm):
+    """
+    the distance between two subsequences trimmed by the same points, from their distance before the trim. The
+    distances are normalized by the length as in brainex.database.genexengine.dt_func_dict
+    :param dist_up: the distance before the trim, between subsequences of length len_up
+    :param r_trim: the points trimmed from the first subsequence
+    :param s_trim: the points trimmed from the second subsequence, at the same positions
+    :return: the distance after the trim, or None if it cannot be derived: with the Chebyshev distance, when a trimmed
+    point may be where the maximum was
+    """
+    diff = np.abs(np.subtract(r_trim, s_trim))
+    length = len_up - len(diff)
+    if pnorm == math.inf:
+        return dist_up if np.max(diff) < dist_up else None
+    # the sum of the pointwise terms over the subsequences before the trim, less the terms of the points trimmed
+    residue = max(dist_up ** pnorm * len_up - np.sum(diff ** pnorm), 0.)
+    return (residue / length) ** (1. / pnorm)
 
 
-def coalease_repr(seqs: list, diameter, dist_func, data_list):
+def _trimmed_dist_mt(dist_mt_up: np.ndarray, len_up: int, r_trim: np.ndarray, r_data: list, pnorm) -> np.ndarray:
+    """
+    _trimmed_dist between every pair of representatives at once
+    :param r_trim: the points trimmed from every representative, of shape (n, n_trim) or (n, n_trim, dim)
+    :param r_data: the data of every representative once trimmed, for the distances that cannot be derived
+    :return: the distances between the trimmed representatives
+    """
+    n = len(dist_mt_up)
+    if n == 0:
+        return np.zeros((0, 0))
+    diff = np.abs(r_trim[:, None] - r_trim[None]).reshape(n, n, -1)
+    if pnorm == math.inf:
+        dist_mt = np.where(np.max(diff, axis=2) < dist_mt_up, dist_mt_up, np.nan)
+        inconclusive = np.argwhere(np.triu(np.isnan(dist_mt), k=1))
+        if len(inconclusive) > 0:
+            r_data = np.asarray(r_data, dtype=np.float64).reshape(n, -1)
+            dists = np.max(np.abs(r_data[inconclusive[:, 0]] - r_data[inconclusive[:, 1]]), axis=1)
+            dist_mt[inconclusive[:, 0], inconclusive[:, 1]] = dists
+            dist_mt[inconclusive[:, 1], inconclusive[:, 0]] = dists
+        np.fill_diagonal(dist_mt, 0.)
+        count(DIST, len(inconclusive))
+        count(DIST_DERIVED, n * (n - 1) // 2 - len(inconclusive))
+        return dist_mt
+    length = len_up - r_trim.shape[1]
+    residue = np.maximum(dist_mt_up ** pnorm * len_up - np.sum(diff ** pnorm, axis=2), 0.)
+    count(DIST_DERIVED, n * (n - 1) // 2)
+    return (residue / length) ** (1. / pnorm)
+
+
+def pairwise_dist(a, b, pnorm) -> np.ndarray:
+    """
+    the distances between every subsequence of a and every subsequence of b, the same as
+    brainex.database.genexengine.dt_func_dict gives one pair at a time, in one cdist
+    :param a: array of shape (n, length) or (n, length, dim)
+    :param b: array of shape (m, length) or (m, length, dim)
+    :return: array of shape (n, m)
+    """
+    from scipy.spatial.distance import cdist
+
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)))
+    length = a.shape[1]
+    a, b = a.reshape(len(a), -1), b.reshape(len(b), -1)
+    count(DIST, len(a) * len(b))
+    if pnorm == math.inf:
+        return cdist(a, b, 'chebyshev')
+    if pnorm == 1:
+        return cdist(a, b, 'cityblock') / length
+    return cdist(a, b, 'minkowski', p=pnorm) / length ** (1. / pnorm)
+
+
+def _extend_dist_mt(dist_mt: np.ndarray, reprs: list, data_dict: dict, pnorm) -> np.ndarray:
+    """
+    :param dist_mt: the distances between the first representatives of reprs
+    :return: the distances between all of reprs, computing only those of the representatives not in dist_mt
     """
-    calculate the distances between the seqs and return a mask of that says which sequences should be ruled out
-    are all greater than the half the diameter
-    the current implementation rule out sequences in a row-wise fashion, in the future, this should be improved to
-    rule out the sequences with the most negative values, thus to achieve more remaining sequences
+    k, n = len(dist_mt), len(reprs)
+    rtn = np.zeros((n, n))
+    rtn[:k, :k] = dist_mt
+    if n > k:
+        r_data = [_seq_data(r, data_dict) for r in reprs]
+        new_dist = pairwise_dist(r_data[k:], r_data, pnorm)
+        rtn[k:, :] = new_dist
+        rtn[:, k:] = new_dist.T
+    return rtn
+
+
+def coalease_repr(dist_mt: np.ndarray, diameter, candidates=None):
+    """
+    return a mask of that says which sequences are kept as representatives: every sequence farther than half the
+    diameter from the sequences kept before it
+    :param dist_mt: the distances between the sequences, see pairwise_dist
     :param diameter:
-    :param seqs:
-    """
-    dist_mt = np.full((len(seqs), len(seqs)), math.inf)
-    for i in range(len(seqs)):  # TODO use DP to derive this matrix from length + 1 iteration
-        for j in range(i + 1):
-            dist_mt[i, j] = dist_func(seqs[j].fetch_data(data_list), seqs[i].fetch_data(data_list)) if i != j else math.inf
-    stay_mask = dist_mt > diameter / 2.0
-    stay_mask = np.all(stay_mask, axis=1)
+    :param candidates: mask of the sequences that may be kept, all of them by default
+    """
+    stay_mask = np.ones(len(dist_mt), dtype=bool) if candidates is None else np.array(candidates, dtype=bool)
+    for i in range(len(dist_mt)):
+        if stay_mask[i]:
+            stay_mask[i] = np.all(dist_mt[i, :i][stay_mask[:i]] > diameter / 2.0)
     return stay_mask
 
 
-def _build_clusters(groups: list, st: float, dist_func, data_list, log_level: int = 1) -> list:
+def _build_clusters(groups: list, st: float, dist_func, data_list, log_level: int = 1, window_stats=None) -> list:
+    """
+    :param window_stats: running sums of data_list, given only when clustering z-normalized subsequences, in which
+    case dist_func must take the (mean, std) of both windows, see brainex.utils.ts_utils.eu_znorm
+    """
     result = []
     for seq_len, grp in groups:
-        result.append(cluster_group(grp, st, seq_len, dist_func=dist_func, data_list=data_list, preformed_c=dict()))
+        # keep the distance of every member to its representative, the cluster radii are used by discord search
+        result.append(cluster_group_dist(grp, st, seq_len, dist_func=dist_func, data_list=data_list,
+                                         preformed_c=dict(), window_stats=window_stats))
+    return result
+
+
+def _cluster_levels(clusters: list, st_levels: list, dist_func, data_list, pnorm, window_stats=None,
+                    repr_fanout: int = None) -> list:
+    """
+    the clusters of every level of a multi-threshold build, each level made of the clusters of the next finer one, see
+    coarsen_cluster. Every level but the coarsest is given the tree of the coarser levels, see ladder_tree, so that
+    they filter the representatives of the level a query searches
+    :param clusters: iterable of (length, cluster) clustered at st_levels[0]
+    :param st_levels: the similarity thresholds of the levels in increasing order, the first being the one of clusters
+    :param repr_fanout: if given, the coarsest level is given a tree of its representatives, see build_repr_tree, on
+    top of which the trees of the finer levels are
+    :return: list of (length, similarity threshold -> TreeCluster), a dict for the coarsest level without repr_fanout
+    """
+    data_dict = dict(data_list)
+    result = []
+    for seq_len, cluster in clusters:
+        levels = {st_levels[0]: cluster}
+        for st_from, st_to in zip(st_levels[:-1], st_levels[1:]):
+            cluster = coarsen_cluster(cluster, st_from, st_to, seq_len, dist_func, data_list, data_dict, pnorm,
+                                      window_stats)
+            levels[st_to] = cluster
+        if repr_fanout is not None:
+            levels[st_levels[-1]] = build_repr_tree(levels[st_levels[-1]], st_levels[-1], repr_fanout, seq_len,
+                                                    dist_func, data_list, window_stats)
+        for i, st in enumerate(st_levels[:-1]):
+            levels[st] = TreeCluster(levels[st], tree=ladder_tree(levels, st_levels[i:]))
+        result.append((seq_len, levels))
     return result
 
 
+def ladder_tree(levels: dict, st_levels: list) -> list:
+    """
+    the tree of the representatives of the finest of st_levels made of the coarser levels, that are nested in one
+    another: a node is a representative of a level with its cluster radius, its children are the nodes of the finer
+    level whose representatives are members of its cluster, and the leaves are the representatives of the finest
+    level. The top nodes are those of the coarsest level, or the tree of its representatives if it has one
+    :param levels: similarity threshold -> cluster
+    :param st_levels: the thresholds of the levels of the tree, in increasing order
+    :return: the top nodes, see brainex.classes.TreeCluster
+    """
+    nodes = None  # representative -> node, of the level below
+    for st in st_levels:
+        nodes = dict((r, (r, max(d for d, _ in members),
+                          None if nodes is None else [nodes[s] for _, s in members if s in nodes]))
+                     for r, members in levels[st].items())
+    tree = getattr(levels[st_levels[-1]], 'tree', None)
+    return list(nodes.values()) if tree is None else _graft(tree, nodes)
+
+
+def _graft(tree: list, nodes: dict) -> list:
+    """
+    :return: tree with its leaves replaced by the nodes of the same representatives
+    """
+    return [nodes[r] if children is None else (r, radius, _graft(children, nodes)) for r, radius, children in tree]
+
+
+def _build_repr_trees(clusters: list, st: float, repr_fanout: int, dist_func, data_list, window_stats=None) -> list:
+    """
+    :param clusters: iterable of (length, cluster) clustered at st
+    :return: list of (length, TreeCluster), see build_repr_tree
+    """
+    return [(seq_len, build_repr_tree(cluster, st, repr_fanout, seq_len, dist_func, data_list, window_stats))
+            for seq_len, cluster in clusters]
+
+
+def build_repr_tree(cluster: dict, st: float, repr_fanout: int, seq_len: int, dist_func, data_list,
+                    window_stats=None) -> TreeCluster:
+    """
+    cluster the representatives of cluster at twice st, then the representatives so found at twice that, and so on
+    until at most repr_fanout of them are left or the threshold reaches MAX_TREE_ST. A threshold that merges nothing
+    adds no level to the tree. The radius of a node is the largest distance to one of its children plus the radius of
+    that child, so it bounds the distance from its representative to the members under it
+    :param cluster: representative -> list of (distance, member) clustered at st
+    :return: the clusters with the tree of their representatives
+    """
+    nodes = [(r, max(d for d, _ in members), None) for r, members in cluster.items()]
+    threshold = st
+    while len(nodes) > repr_fanout and threshold < MAX_TREE_ST:
+        threshold *= 2
+        _, coarse = cluster_group_dist([node[0] for node in nodes], threshold, seq_len, dist_func=dist_func,
+                                       data_list=data_list, preformed_c=dict(), window_stats=window_stats)
+        if len(coarse) == len(nodes):
+            continue
+        node_dict = dict((node[0], node) for node in nodes)
+        nodes = [(r, max(d + node_dict[child][1] for d, child in children), [node_dict[child] for _, child in children])
+                 for r, children in coarse.items()]
+    return TreeCluster(cluster, tree=nodes)
+
+
+def coarsen_cluster(cluster: dict, st_from: float, st_to: float, seq_len: int, dist_func, data_list, data_dict: dict,
+                    pnorm, window_stats=None) -> dict:
+    """
+    the clusters of the coarser threshold st_to made of the clusters of st_from: their representatives are clustered
+    at st_to and every coarse cluster takes the members of the clusters whose representatives it holds, so the clusters
+    of st_from are nested in those of st_to. The representatives are as far apart as in a build at st_to. A member is
+    within the bound of the st_from level of its representative, itself within st_to / 2 of the coarse one, so the
+    bounds add up level by level: the members of a level are within the sum of st / 2 over the thresholds of that
+    level and the finer ones, e.g. 0.025 + 0.05 + 0.1 + 0.2 = 0.375 for the 0.4 level of the ladder 0.05, 0.1, 0.2,
+    0.4. Only the first coarsening has the bound (st_from + st_to) / 2
+    :param cluster: representative -> list of (distance, member) clustered at st_from
+    :return: representative -> list of (distance, member) clustered at st_to, the distances are computed again
+    """
+    _, coarse = cluster_group_dist(list(cluster.keys()), st_to, seq_len, dist_func=dist_func,
+                                   data_list=data_list, preformed_c=dict(), window_stats=window_stats)
+    rtn = dict()
+    for r, children in coarse.items():
+        members = [s for _, child in children for _, s in cluster[child]]
+        dists = pairwise_dist(_windows([r], data_dict, window_stats), _windows(members, data_dict, window_stats),
+                              pnorm)[0]
+        rtn[r] = [(0.0 if s == r else d, s) for d, s in zip(dists, members)]
+    return rtn
+
+
+def _windows(seqs: list, data_dict: dict, window_stats=None) -> np.ndarray:
+    """
+    :return: the data of seqs, z-normalized window by window if window_stats is given
+    """
+    if window_stats is None:
+        return np.array([_seq_data(s, data_dict) for s in seqs])
+    return np.array([z_normalize_window(_seq_data(s, data_dict), *window_mean_std(s, window_stats)) for s in seqs])
+
+
 def cluster_group(group: list, st: float, sequence_len: int, dist_func, data_list, preformed_c: dict,
-                  log_level: int = 1):
+                  log_level: int = 1, window_stats=None):
     """
     all subsequence in 'group' must be of the same length
     For example:
     [[1,4,2],[6,1,4],[1,2,3],[3,2,1]] is a valid 'sub-sequences'
 
+    :param window_stats: running sums of data_list; if given, the subsequences are compared z-normalized
     :param preformed_c:
     :param cluster:
     :param data_list:
@@ -151,6 +385,7 @@ def cluster_group(group: list, st: float, sequence_len: int, dist_func, data_lis
     :return a dictionary of clusters
     """
     cluster = preformed_c
+    r_stats = dict()  # repr -> (mean, std), only used with window_stats
     # randomize the sequence in the group to remove clusters-related bias
     group = _randomize(group)
 
@@ -159,18 +394,8 @@ def cluster_group(group: list, st: float, sequence_len: int, dist_func, data_lis
             cluster[s] = [(s)]
         else:
             # find the closest representative
-            min_dist = math.inf
-            min_representative = None
-
-            for r in list(cluster.keys()):
-                r_data = r.fetch_data(data_list)
-                s_data = s.fetch_data(data_list)
-                if lb_kim_sequence(r_data, s_data) > min_dist:  # compute the lb_kim
-                    continue
-                dist = dist_func(r_data, s_data)
-                if dist < min_dist:
-                    min_dist = dist
-                    min_representative = r
+            min_dist, min_representative = _closest_representative(s, cluster, dist_func, data_list, window_stats,
+                                                                   r_stats)
 
             if min_dist <= st / 2.0:  # if the calculated min similarity is smaller than the
                 # similarity threshold, put subsequence in the similarity cluster keyed by the min representative
@@ -186,12 +411,13 @@ def cluster_group(group: list, st: float, sequence_len: int, dist_func, data_lis
 
 
 def cluster_group_dist(group: list, st: float, sequence_len: int, dist_func, data_list, preformed_c,
-                       log_level: int = 1):
+                       log_level: int = 1, window_stats=None):
     """
     all subsequence in 'group' must be of the same length
     For example:
     [[1,4,2],[6,1,4],[1,2,3],[3,2,1]] is a valid 'sub-sequences'
 
+    :param window_stats: running sums of data_list; if given, the subsequences are compared z-normalized
     :param preformed_c:
     :param data_list:
     :param del_data:
@@ -208,6 +434,7 @@ def cluster_group_dist(group: list, st: float, sequence_len: int, dist_func, dat
     :return a dictionary of clusters
     """
     cluster = preformed_c
+    r_stats = dict()  # repr -> (mean, std), only used with window_stats
 
     # randomize the sequence in the group to remove clusters-related bias
     group = _randomize(group)
@@ -217,18 +444,8 @@ def cluster_group_dist(group: list, st: float, sequence_len: int, dist_func, dat
             cluster[s] = [(0.0, s)]  # put the distances and the sequence
         else:
             # find the closest representative
-            min_dist = math.inf
-            min_representative = None
-
-            for r in list(cluster.keys()):
-                r_data = r.fetch_data(data_list)
-                s_data = s.fetch_data(data_list)
-                if lb_kim_sequence(r_data, s_data) > min_dist:  # compute the lb_kim
-                    continue
-                dist = dist_func(r_data, s_data)
-                if dist < min_dist:
-                    min_dist = dist
-                    min_representative = r
+            min_dist, min_representative = _closest_representative(s, cluster, dist_func, data_list, window_stats,
+                                                                   r_stats)
 
             if min_dist <= st / 2.0:  # if the calculated min similarity is smaller than the
                 # similarity threshold, put subsequence in the similarity cluster keyed by the min representative
@@ -243,6 +460,45 @@ def cluster_group_dist(group: list, st: float, sequence_len: int, dist_func, dat
     return sequence_len, cluster
 
 
+def _closest_representative(s: Sequence, cluster: dict, dist_func, data_list, window_stats, r_stats: dict):
+    """
+    find the representative in cluster that is closest to s, using lb_kim to skip the ones that cannot be closer
+    :param window_stats: running sums of data_list, if given the windows are compared z-normalized; the normalization
+    is folded into dist_func so no normalized copy of the windows is made
+    :param r_stats: cache of the representatives' (mean, std), filled as representatives are visited
+    :return: (min distance, closest representative)
+    """
+    min_dist = math.inf
+    min_representative = None
+    s_data = s.fetch_data(data_list)
+    if window_stats is not None:
+        s_stat = window_mean_std(s, window_stats)
+        s_ends = z_endpoints(s_data, s_stat)
+
+    pruned = 0
+    for r in list(cluster.keys()):
+        r_data = r.fetch_data(data_list)
+        if window_stats is None:
+            if lb_kim_sequence(r_data, s_data) > min_dist:  # compute the lb_kim
+                pruned += 1
+                continue
+            dist = dist_func(r_data, s_data)
+        else:
+            if r not in r_stats:
+                r_stats[r] = window_mean_std(r, window_stats)
+            if lb_kim_sequence(z_endpoints(r_data, r_stats[r]), s_ends) > min_dist:
+                pruned += 1
+                continue
+            dist = dist_func(r_data, s_data, r_stats[r], s_stat)
+        if dist < min_dist:
+            min_dist = dist
+            min_representative = r
+    count(LB_PRUNED, pruned)
+    count(LB_KIM_PRUNED, pruned)
+    count(DIST, len(cluster) - pruned)
+    return min_dist, min_representative
+
+
 def _cluster_to_meta(cluster):
     return cluster[0], {rprs: len(slist) for (rprs, slist) in cluster[1].items()}
 
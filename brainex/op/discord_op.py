@@ -0,0 +1,105 @@
+import math
+
+import numpy as np
+
+from brainex.classes.Sequence import Sequence
+from brainex.op.query_op import _fetch_data
+from brainex.utils.ts_utils import dist_to_many
+from brainex.utils.utils import _isOverlap
+
+
+def _is_trivial_match(seq1: Sequence, seq2: Sequence) -> bool:
+    """
+    a subsequence is never compared to the subsequences it intersects, they are trivially similar
+    """
+    return seq1.seq_id == seq2.seq_id and seq1.start <= seq2.end and seq2.start <= seq1.end
+
+
+def _discords_of_length(seq_len: int, cluster: dict, k: int, overlap: float, data_list, pnorm,
+                        window_stats=None):
+    """
+    find the top k discords among the subsequences of one length, that is the subsequences whose nearest
+    (non-trivial) neighbour is the farthest.
+
+    The clusters are used in three ways:
+    1. a member c of a cluster with representative r has a neighbour within d(c, r) + d(s, r) for any other member s,
+    so its nearest neighbour distance is bounded from above without touching any data. Candidates are visited by
+    decreasing upper bound, singletons first, and the search stops once the bound falls under the k-th best discord.
+    2. while searching the nearest neighbour of a candidate, a cluster with radius rad can not contain anything closer
+    than d(c, r) - rad, so the clusters are scanned from the closest and the scan stops at the first one that is too far.
+    3. the scan of a candidate is abandoned as soon as a neighbour closer than the k-th best discord is found.
+
+    :param cluster: representative -> list of (distance to representative, member) of all the clusters of seq_len
+    :param window_stats: running sums of data_list, given with normalize='subsequence' builds
+    :return: list of (nearest neighbour distance, discord, nearest neighbour)
+    """
+    reprs = list(cluster.keys())
+    if len(reprs) == 0:
+        return []
+    members = dict([(r, sorted(cluster[r], key=lambda x: x[0])) for r in reprs])
+    radii = np.array([members[r][-1][0] for r in reprs])
+    r_mat = np.array([_fetch_data(r, data_list, window_stats) for r in reprs])
+    member_mat = dict()  # repr -> (member data matrix, members), filled as the clusters are scanned
+
+    # upper bound of the nearest neighbour distance of every candidate
+    candidates = []
+    for r in reprs:
+        for d_c, c in members[r]:
+            ub, ub_nn = math.inf, None
+            for d_s, s in members[r]:
+                if d_c + d_s >= ub:
+                    break
+                if not _is_trivial_match(c, s):
+                    ub, ub_nn = d_c + d_s, s
+            candidates.append((ub, c, ub_nn))
+    candidates.sort(key=lambda x: -x[0])
+
+    discords = []  # (nearest neighbour distance, discord, nearest neighbour), kept sorted by decreasing distance
+    for ub, c, ub_nn in candidates:
+        threshold = discords[k - 1][0] if len(discords) >= k else -math.inf
+        if ub <= threshold:  # no candidate left can beat the k-th discord
+            break
+        if any(_isOverlap(c, x[1], overlap) for x in discords if x[0] >= ub):
+            continue  # a better discord overlapping this one is already found
+        c_data = _fetch_data(c, data_list, window_stats)
+        r_dists = dist_to_many(c_data, r_mat, pnorm)
+        nn_dist, nn = math.inf, ub_nn
+        if ub_nn is not None:  # the bound is only an estimate, start from the true distance to that member
+            nn_dist = dist_to_many(c_data, np.array([_fetch_data(ub_nn, data_list, window_stats)]), pnorm)[0]
+        for rj in np.argsort(r_dists - radii):
+            if r_dists[rj] - radii[rj] >= nn_dist or nn_dist <= threshold:
+                break
+            r = reprs[rj]
+            if r not in member_mat:
+                member_mat[r] = (np.array([_fetch_data(s, data_list, window_stats) for _, s in members[r]]),
+                                 [s for _, s in members[r]])
+            mat, seqs = member_mat[r]
+            dists = dist_to_many(c_data, mat, pnorm)
+            for si in np.argsort(dists):
+                if dists[si] >= nn_dist:
+                    break
+                if not _is_trivial_match(c, seqs[si]):
+                    nn_dist, nn = dists[si], seqs[si]
+                    break
+        if nn_dist <= threshold or nn is None:
+            continue  # abandoned, or only trivial matches exist
+        discords = [x for x in discords if not (_isOverlap(c, x[1], overlap) and x[0] < nn_dist)]
+        if not any(_isOverlap(c, x[1], overlap) for x in discords):
+            discords.append((float(nn_dist), c, nn))
+            discords.sort(key=lambda x: -x[0])
+    return discords[:k]
+
+
+def _merge_discords(results, k: int, overlap: float):
+    """
+    merge the per-length results of _discords_of_length, the discords of different lengths must not overlap either
+    """
+    merged = [x for r in results for x in r]
+    merged.sort(key=lambda x: -x[0])
+    rtn = []
+    for x in merged:
+        if len(rtn) >= k:
+            break
+        if not any(_isOverlap(x[1], y[1], overlap) for y in rtn):
+            rtn.append(x)
+    return rtn
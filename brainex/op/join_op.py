@@ -0,0 +1,58 @@
+import numpy as np
+
+from brainex.op.discord_op import _is_trivial_match
+from brainex.op.query_op import _fetch_data
+from brainex.utils.ts_utils import dist_to_many
+
+
+def _join_length(seq_len: int, cluster_a: dict, cluster_b: dict, eps: float, data_a, data_b, pnorm,
+                 scale_b: float = 1., window_stats_a=None, window_stats_b=None, self_join: bool = False):
+    """
+    similarity join of the subsequences of one length: every pair (a, b) with a from cluster_a and b from cluster_b
+    that are within eps of each other.
+    The representatives are compared first, a pair of clusters is expanded only if their representatives are within
+    eps plus the two radii. Within an expanded pair, the members are filtered with the triangle inequality on their
+    distances to the representatives before being compared.
+
+    :param cluster_a: representative -> list of (distance to representative, member) of the left side
+    :param cluster_b: same as cluster_a, for the right side
+    :param data_b: data of the right side, in the scale of data_a
+    :param scale_b: factor from the distances stored in cluster_b to the scale of data_a
+    :param self_join: whether cluster_a and cluster_b are the same, the trivial matches are then excluded and every
+    pair is given once
+    :return: list of (distance, a, b)
+    """
+    reprs_a, reprs_b = list(cluster_a.keys()), list(cluster_b.keys())
+    if len(reprs_a) == 0 or len(reprs_b) == 0:
+        return []
+    radii_a = np.array([max(d for d, _ in cluster_a[r]) for r in reprs_a])
+    radii_b = np.array([max(d for d, _ in cluster_b[r]) for r in reprs_b]) * scale_b
+    r_mat_b = np.array([_fetch_data(r, data_b, window_stats_b) for r in reprs_b])
+
+    rtn = []
+    member_b = dict()  # repr -> (distances to repr, member data matrix, members), filled as the clusters are expanded
+    for ra, rad_a in zip(reprs_a, radii_a):
+        rr_dists = dist_to_many(_fetch_data(ra, data_a, window_stats_a), r_mat_b, pnorm)
+        to_expand = [j for j in np.flatnonzero(rr_dists <= eps + rad_a + radii_b)]
+        if len(to_expand) == 0:
+            continue
+        a_members = [(d, s, _fetch_data(s, data_a, window_stats_a)) for d, s in cluster_a[ra]]
+        for j in to_expand:
+            rb = reprs_b[j]
+            if rb not in member_b:
+                member_b[rb] = (np.array([d for d, _ in cluster_b[rb]]) * scale_b,
+                                np.array([_fetch_data(s, data_b, window_stats_b) for _, s in cluster_b[rb]]),
+                                [s for _, s in cluster_b[rb]])
+            d_b, mat_b, seqs_b = member_b[rb]
+            for d_a, a, a_data in a_members:
+                mask = rr_dists[j] - d_a - d_b <= eps  # d(ra, rb) - d(a, ra) - d(b, rb) lower bounds d(a, b)
+                if not np.any(mask):
+                    continue
+                dists = dist_to_many(a_data, mat_b[mask], pnorm)
+                for d, b in zip(dists, [s for s, keep in zip(seqs_b, mask) if keep]):
+                    if d > eps:
+                        continue
+                    if self_join and (_is_trivial_match(a, b) or (a.seq_id, a.start) >= (b.seq_id, b.start)):
+                        continue
+                    rtn.append((float(d), a, b))
+    return rtn
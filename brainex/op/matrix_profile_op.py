@@ -0,0 +1,162 @@
+import math
+
+import numpy as np
+
+from brainex.classes.Sequence import Sequence
+from brainex.utils.ts_utils import sliding_mean_std, Z_NORM_EPS
+from brainex.utils.utils import _isOverlap
+
+
+def sliding_dot_product(q: np.ndarray, t: np.ndarray):
+    """
+    dot product between q and every window of t of length len(q), computed with a single FFT convolution
+    :param q: the query window
+    :param t: the time series to slide over, must not be shorter than q
+    :return: array of length len(t) - len(q) + 1
+    """
+    m, n = len(q), len(t)
+    size = 1 << (n + m - 1).bit_length()  # pad to a power of two for a faster FFT
+    prod = np.fft.irfft(np.fft.rfft(t, size) * np.fft.rfft(q[::-1], size), size)
+    return prod[m - 1:n]
+
+
+def stomp(a: np.ndarray, b: np.ndarray, m: int, exclusion: int = None, b_valid: np.ndarray = None, offset: int = 0):
+    """
+    the STOMP matrix profile of a joined against b: for every window of a, the distance to, and the index of, its
+    nearest window in b. Each row of the distance matrix is derived from the previous one in O(len(b)), only the
+    first row and column need FFT sliding dot products. The distance is the z-normalized euclidean distance divided by
+    sqrt(m) like eu_norm, since it decreases with the correlation only the best correlation of each row is turned
+    into a distance.
+    :param a:
+    :param b:
+    :param m: window length
+    :param exclusion: if given, a is b[offset:offset + len(a)] and matches with |i - j| < exclusion are trivial
+    :param b_valid: boolean mask over the windows of b, windows that are False are never matched; used when b is
+    several time series concatenated and some windows cross from one series into the next
+    :param offset: position of a in b, only used with exclusion
+    :return: (profile, profile index), both of length len(a) - m + 1
+    """
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    na, nb = len(a) - m + 1, len(b) - m + 1
+    profile = np.full(max(na, 0), math.inf)
+    profile_index = np.full(max(na, 0), -1, dtype=np.int64)
+    if na < 1 or nb < 1:
+        return profile, profile_index
+
+    a_mean, a_std = sliding_mean_std(a, m)
+    b_mean, b_std = sliding_mean_std(b, m)
+    b_flat = b_std < Z_NORM_EPS
+    b_valid = np.ones(nb, dtype=bool) if b_valid is None else b_valid
+    # a flat window is all zeros once z-normalized, its distance to any other window is 1, that is a correlation of
+    # 0.5, see brainex.utils.ts_utils.eu_znorm; invalid windows get a correlation of -inf
+    corr_offset = np.where(b_valid, np.where(b_flat, .5, 0.), -math.inf)
+    b_scale = np.where(b_flat, 0., 1. / (m * np.where(b_flat, 1., b_std)))
+    mb_mean = m * b_mean
+
+    first_col = sliding_dot_product(b[:m], a)  # a_i . b_0 for every i
+    qt = sliding_dot_product(a[:m], b)  # a_0 . b_j for every j
+    corr = np.empty(nb)
+    for i in range(na):
+        if i > 0:
+            qt[1:] = qt[:-1] - a[i - 1] * b[:nb - 1] + a[i + m - 1] * b[m:m + nb - 1]
+            qt[0] = first_col[i]
+        if a_std[i] < Z_NORM_EPS:  # flat window: distance 0 to the other flat windows and 1 to the rest
+            np.copyto(corr, np.where(b_flat, 1., .5) + np.where(b_valid, 0., -math.inf))
+        else:
+            np.multiply(mb_mean, a_mean[i], out=corr)
+            np.subtract(qt, corr, out=corr)
+            corr *= b_scale
+            corr /= a_std[i]
+            corr += corr_offset
+        if exclusion is not None:
+            corr[max(0, offset + i - exclusion + 1):offset + i + exclusion] = -math.inf
+        j = int(np.argmax(corr))
+        if corr[j] > -math.inf:
+            profile[i], profile_index[i] = math.sqrt(max(2. * (1. - corr[j]), 0.)), j
+    return profile, profile_index
+
+
+def _concat_database(data_list, m: int):
+    """
+    concatenate all the time series so that a window of length m can be joined against the whole database in one
+    vectorized pass
+    :return: (concatenated data, valid window mask, start offset of each time series)
+    """
+    concat = np.concatenate([np.asarray(ts, dtype=np.float64) for _, ts in data_list])
+    offsets = np.cumsum([0] + [len(ts) for _, ts in data_list])
+    valid = np.zeros(max(len(concat) - m + 1, 0), dtype=bool)
+    for o_start, o_end in zip(offsets[:-1], offsets[1:]):
+        valid[o_start:max(o_start, o_end - m + 1)] = True  # windows that do not cross into the next time series
+    return concat, valid, offsets
+
+
+def _series_matrix_profile(ts_index: int, data_list, m: int, exclusion: float, concat=None):
+    """
+    matrix profile of one time series against the whole database: the nearest neighbour of each window is searched
+    in every time series, including its own (outside the exclusion zone)
+    :param concat: the result of _concat_database for m, reused across the time series when given
+    :return: (profile, nearest neighbour's time series index, nearest neighbour's start)
+    """
+    a = data_list[ts_index][1]
+    concat, valid, offsets = concat if concat is not None else _concat_database(data_list, m)
+    ex = max(1, int(math.ceil(m * exclusion)))
+    profile, profile_index = stomp(a, concat, m, exclusion=ex, b_valid=valid, offset=offsets[ts_index])
+    nn_ts = np.searchsorted(offsets, profile_index, side='right') - 1
+    nn_start = profile_index - offsets[nn_ts]
+    return profile, nn_ts, nn_start
+
+
+def _mp_series_top_k(ts_indices, data_list, lengths, k: int, overlap: float, exclusion: float, discord: bool):
+    """
+    the worker function of the matrix profile motif and discord search. For each of the given time series, it
+    computes the matrix profile for every given length and greedily takes the best windows that do not overlap each
+    other. Overlap only matters between windows of the same time series, so merging the per-series results and taking
+    the k best again gives the same answer as a greedy search over the whole database.
+    :param ts_indices: indices in data_list of the time series handled by this worker
+    :param discord: take the windows farthest from their nearest neighbours instead of the closest ones
+    :return: list of (distance, Sequence, nearest neighbour Sequence)
+    """
+    ts_indices = list(ts_indices)
+    # a motif pair is found from both of its ends, keep enough per series for _merge_top_k to drop the mirrored pairs
+    keep = k if discord else 2 * k
+    candidates = dict([(i, []) for i in ts_indices])
+    for m in lengths:
+        concat = _concat_database(data_list, m)
+        for ts_index in ts_indices:
+            if len(data_list[ts_index][1]) < m:
+                continue
+            profile, nn_ts, nn_start = _series_matrix_profile(ts_index, data_list, m, exclusion, concat=concat)
+            valid = np.flatnonzero(np.isfinite(profile))
+            candidates[ts_index] += [(profile[i], i, m, nn_ts[i], nn_start[i]) for i in valid]
+
+    rtn = []
+    for ts_index, ts_candidates in candidates.items():
+        ts_candidates.sort(key=lambda x: (-x[0] if discord else x[0], x[1], x[2]))
+        ts_rtn = []
+        for dist, start, m, nn_i, nn_s in ts_candidates:
+            if len(ts_rtn) >= keep:
+                break
+            seq = Sequence(seq_id=data_list[ts_index][0], start=int(start), end=int(start + m - 1))
+            if any(_isOverlap(seq, x[1], overlap) for x in ts_rtn):
+                continue
+            nn = Sequence(seq_id=data_list[nn_i][0], start=int(nn_s), end=int(nn_s + m - 1))
+            ts_rtn.append((float(dist), seq, nn))
+        rtn += ts_rtn
+    return rtn
+
+
+def _merge_top_k(results, k: int, discord: bool):
+    """
+    merge the per-worker results of _mp_series_top_k, a motif pair is only reported from one of its ends
+    """
+    merged = [x for r in results for x in r]
+    merged.sort(key=lambda x: -x[0] if discord else x[0])
+    rtn = []
+    for x in merged:
+        if len(rtn) >= k:
+            break
+        if not discord and any(x[1] == y[2] and x[2] == y[1] for y in rtn):
+            continue
+        rtn.append(x)
+    return rtn
@@ -1,13 +1,18 @@
+import functools
 import heapq
 import math
+import time
 
 import numpy as np
-from pyspark.broadcast import Broadcast
 
+from brainex.classes.OverlapIndex import OverlapIndex
 from brainex.classes.Sequence import Sequence
 from brainex.misc import merge_dict, fd_workaround
-from brainex.utils.ts_utils import lb_kim_sequence, lb_keogh_sequence, paa_compress, sax_compress
-from brainex.utils.utils import get_trgt_len_within_r, get_sequences_represented, _isOverlap, reduce_by_key
+from brainex.utils.ts_utils import lb_kim_sequence, lb_keogh_sequence, paa_compress, sax_compress, window_mean_std, \
+    z_normalize_window, dist_to_many, lb_endpoints_to_many
+from brainex.utils.utils import get_trgt_len_within_r, get_sequences_represented, reduce_by_key, unbroadcast
+from brainex.utils.metrics_utils import count, counted, DIST, LB_PRUNED, LB_KIM_PRUNED, LB_KEOGH_PRUNED, \
+    LB_KEOGH_REV_PRUNED
 
 try:
     from fastdtw import fastdtw
@@ -32,6 +37,7 @@ def sim_between_array(a1: np.ndarray, a2: np.ndarray, pnorm: int, use_fast=True)
     #                    'ch': 2,
     #                    'min': 2}
 
+    count(DIST)
     dist = fastdtw(a1, a2, dist=pnorm)[0] if use_fast else dtw(a1, a2, dist=pnorm)[0]
     if pnorm == 2:
         return np.sqrt(dist / (len(a1) + len(a2)))
@@ -74,7 +80,7 @@ def sim_between_array_piecewise(a1: np.ndarray, a2: np.ndarray, pnorm: int, piec
         raise Exception('Unsupported dist type in array, this should never happen!')
 
 
-def _get_dist_sequence(seq1: Sequence, seq2: Sequence, dt_index, data_list):
+def _get_dist_sequence(seq1: Sequence, seq2: Sequence, dt_index, data_list, window_stats=None):
     """
     the use of paa
     :param seq1:
@@ -82,9 +88,64 @@ def _get_dist_sequence(seq1: Sequence, seq2: Sequence, dt_index, data_list):
     :param dt_index:
     :param paa:
     :param data_list:
+    :param window_stats: running sums of data_list, if given seq2 is z-normalized before the comparison
     :return:
     """
-    return sim_between_array(seq1.get_data(), seq2.fetch_data(data_list), pnorm=dt_index), seq2
+    return sim_between_array(seq1.get_data(), _fetch_data(seq2, data_list, window_stats), pnorm=dt_index), seq2
+
+
+def _query_bf_partition(q: Sequence, subsequences, dt_index, data_list, k: int, window_stats=None,
+                        deadline: float = None):
+    """
+    brute force the k best matches among subsequences, until deadline. The subsequences are compared in increasing
+    order of lb_kim_sequence so that the best matches are likely to be found first
+    :return: a list of one (k best matches so far, whether every subsequence was compared)
+    """
+    q = unbroadcast(q)
+    data_list = unbroadcast(data_list)
+    window_stats = unbroadcast(window_stats)
+    c_data = [(_fetch_data(x, data_list, window_stats), x) for x in subsequences]
+    c_data.sort(key=lambda x: lb_kim_sequence(x[0], q.data))
+    result = []  # max heap on the negative distance
+    is_complete = True
+    for i, (cd, c) in enumerate(c_data):
+        if _is_expired(deadline):
+            is_complete = False
+            break
+        dist = sim_between_array(q.get_data(), cd, dt_index)
+        if len(result) < k:
+            heapq.heappush(result, (-dist, i, c))
+        elif -dist > result[0][0]:
+            heapq.heapreplace(result, (-dist, i, c))
+    return [(sorted([(-d, c) for d, _, c in result], key=lambda x: x[0]), is_complete)]
+
+
+def _query_bf_partition_batch(queries: list, subsequences, dt_index, data_list, k: int, window_stats=None):
+    """
+    brute force the k best matches of every query among subsequences, the data of the subsequences is fetched once for
+    all the queries
+    :return: a list of (query index, k best matches)
+    """
+    queries = unbroadcast(queries)
+    data_list = unbroadcast(data_list)
+    window_stats = unbroadcast(window_stats)
+    c_data = [(_fetch_data(x, data_list, window_stats), x) for x in subsequences]
+    rtn = []
+    for j, q in enumerate(queries):
+        dists = [(sim_between_array(q.get_data(), cd, dt_index), c) for cd, c in c_data]
+        rtn.append((j, heapq.nsmallest(k, dists, key=lambda x: x[0])))
+    return rtn
+
+
+def _fetch_data(seq: Sequence, data_list, window_stats=None):
+    """
+    fetch the data of seq, z-normalized with the statistics derived from window_stats if window_stats is given
+    :param window_stats: running sums of data_list as returned by brainex.utils.ts_utils.running_sums
+    """
+    data = seq.fetch_data(data_list)
+    if window_stats is None:
+        return data
+    return z_normalize_window(data, *window_mean_std(seq, window_stats))
 
 
 def _get_dist_sequence_piecewise(query_com, candidate: Sequence, dt_index, data_list, piecewise, n_segment, fitter):
@@ -113,77 +174,250 @@ def _get_dist_array(a1: np.ndarray, a2: np.ndarray, dt_index):
     return sim_between_array(a1, a2, pnorm=dt_index)
 
 
+def _with_counts(search):
+    """
+    run search, a partition search returning [(matches, cursor)], and give the counts of its kernels in
+    cursor['counts'], see brainex.utils.metrics_utils, and its wall time in cursor['time']. The cursor is
+    {'counts': counts, 'time': seconds} if search gives None
+    """
+
+    @functools.wraps(search)
+    def wrapper(*args, **kwargs):
+        t = time.perf_counter()
+        rtn, counts = counted(search, *args, **kwargs)
+        t = time.perf_counter() - t
+        for i, (matches, cursor) in enumerate(rtn):
+            if cursor is None:
+                rtn[i] = (matches, {'counts': counts, 'time': t})
+            else:
+                cursor['counts'], cursor['time'] = counts, t
+        return rtn
+
+    return wrapper
+
+
+@_with_counts
 def _query_partition(cluster, q, k: int, ke: int, data_normalized, pnorm: int,
                      lb_opt: bool, exclude_same_id: bool, radius: int, st: float,
-                     overlap: float, id_filter, filter_mode, loi,
-                     prev_matches: list = []):
+                     overlap: float, id_filter, filter_mode, loi, window_stats=None,
+                     prev_matches: list = [], cursor: dict = None, deadline: float = None, plan: dict = None,
+                     explain: bool = False, length_policy: str = 'nearest'):
     """
     This function finds k best matches for given query sequence on the worker node
 
+    The search is resumable: the representatives ranked but not yet expanded and the candidates compared but not yet
+    returned are kept in the returned cursor. Given back in the next round, the partition carries on from there
+    instead of ranking every representative again.
+
     :param cluster: cluster being queried
     :param q: Query sequence
     :param k: number of best matches to retrieve
     :param data_normalized:
     :param exclude_same_id: whether to exclude the query sequence when finding best matches
     :param overlap: Overlapping parameter( must be between 0 and 1 inclusive)
-
-    :return: a list containing retrieved matches for given query sequence on that worker node
+    :param window_stats: running sums of data_normalized, given when the database is built with
+    normalize='subsequence'; the candidates are then z-normalized window by window and q must be z-normalized already
+    :param prev_matches: the matches accepted in the previous rounds, the subsequences overlapping them are skipped
+    :param cursor: the cursor returned by the previous round on this partition, None to start the search
+    :param deadline: time.time() after which the partition stops ranking and comparing and returns what it has. The
+    representatives are ranked and the candidates compared best first, so the partial result is the best found so far
+    and cursor['timed_out'] is set. Ignored if lb_opt is set
+    :param plan: {'lens': lengths, 'radius': radius} the lengths to search in the first round, as planned by the driver
+    with brainex.utils.utils.plan_query_lengths, and the radius to carry on from in the next rounds. Without a plan,
+    the partition widens the radius around the query length until it has ke candidates on its own
+    :param explain: whether to give the trace of the round in cursor['trace']: length -> {'reprs_scored',
+    'clusters_expanded'} in 'lengths' and the number of candidates compared in 'candidates_scored'
+    :param length_policy: how q is compared with the subsequences of another length: 'nearest' to compare it as it is
+    with DTW, 'scale' to compare its uniform scaling to their length, see scale_query. Ignored if lb_opt is set
+
+    The lengths whose clusters have a tree of their representatives (see brainex.classes.TreeCluster) are searched
+    by descending the tree best first, see expand_rtree, unless lb_opt is set.
+
+    :return: a list of one (retrieved matches for given query sequence on that worker node, cursor). The cursor
+    only holds the counts, the time and the trace if lb_opt is set, the search is then not resumable and the next
+    round starts over
     """
     """We automatically use Traditional DTW if optimization is set to True"""
 
-    if isinstance(q, Broadcast):
-        q = q.value
-    if isinstance(data_normalized, Broadcast):
-        data_normalized = data_normalized.value
+    q = unbroadcast(q)
+    data_normalized = unbroadcast(data_normalized)
+    window_stats = unbroadcast(window_stats)
 
+    cluster = list(cluster)
     cluster_dict = dict(list(reduce_by_key(lambda x, y: merge_dict([x, y]), cluster)))
-    q_length = len(q.data)
-    candidates = []
     if loi:  # filter by LOI
         cluster_dict = dict([(c_len, c) for c_len, c in cluster_dict.items() if loi[0] <= c_len <= loi[1]])
 
-    # cluster_filtered = [x for x in cluster if x[0] in range(loi.start, loi.stop)] if loi is not None else cluster
-    # cluster_dict = dict(list(reduce_by_key(lambda x, y: merge_dict([x, y]), cluster_filtered)))
-    # try:
-    #     assert cluster_filtered
-    # except AssertionError as ve:
-    #     print('Given loi is ' + str(loi))
-    #     print('sequence length in the database: ' + str(list(cluster_dict.keys())))
-    #     raise Exception('cluster does not have the given query loi!')
+    trace = {'lengths': dict(), 'candidates_scored': 0} if explain else None
+    if lb_opt:
+        return [(_query_partition_lb_opt(cluster_dict, q, k, ke, data_normalized, pnorm, lb_opt, exclude_same_id,
+                                         radius, st, id_filter, filter_mode, window_stats, trace),
+                 None if trace is None else {'trace': trace})]
+
+    prev_index = None
+    if overlap != 1.0:
+        prev_index = OverlapIndex(overlap)
+        for pv_c in prev_matches:
+            prev_index.add(pv_c[1])
+
+    is_first_round = cursor is None
+    if is_first_round:
+        # rspace: seq_len -> heap of the representatives not expanded yet, pool: heap of the candidates not returned
+        # pushed: the number of nodes pushed onto the heaps of the trees, the tie breaker of the next one
+        cursor = {'radius': radius, 'lens': list(cluster_dict.keys()), 'rspace': dict(), 'pool': [],
+                  'timed_out': False, 'pushed': 0}
+    elif prev_index is not None:
+        cursor['pool'] = [x for x in cursor['pool'] if not prev_index.is_overlapping(x[1])]
+        heapq.heapify(cursor['pool'])
+
+    candidates = []
+    ranked = []  # the representatives ranked in this round, they are subsequences too
+    q_scaled = dict()  # seq_len -> data of q compared with the subsequences of that length
+    trees = _repr_trees(cluster)
+    scored = dict()  # representative -> its distance to q, a representative is also a node of the levels above it
+
+    def _q_data(seq_len):
+        if length_policy != 'scale':
+            return q.get_data()
+        if seq_len not in q_scaled:
+            q_scaled[seq_len] = scale_query(q.get_data(), seq_len, window_stats)
+        return q_scaled[seq_len]
+
+    def _score_nodes(target_l, nodes):
+        # a leaf is ranked by its distance to q as the representatives without a tree, a node with children by the
+        # distance less its radius (see _dtw_radius): a heuristic priority to descend the best nodes first, not a lower
+        # bound of the distance to the members under it since DTW is not a metric, so it must not be used to prune
+        n_scored = 0
+        for r, r_radius, children in nodes:
+            if _is_expired(deadline):
+                break
+            if r not in scored:
+                scored[r] = sim_between_array(_fetch_data(r, data_normalized, window_stats), _q_data(target_l), pnorm)
+                n_scored += 1
+            if children is None:
+                ranked.append((scored[r], r))
+            priority = scored[r] if children is None else scored[r] - _dtw_radius(r_radius, target_l, pnorm)
+            heapq.heappush(cursor['rspace'][target_l], (priority, cursor['pushed'], (r, r_radius, children)))
+            cursor['pushed'] += 1
+        _trace_length(trace, target_l, 'reprs_scored', n_scored)
+
+    def _expand(target_l):
+        if target_l in trees:
+            expanded, n_expanded = expand_rtree(k, cursor['rspace'][target_l], cluster_dict[target_l],
+                                                lambda nodes: _score_nodes(target_l, nodes), prev_index)
+            candidates.extend(expanded)
+            _trace_length(trace, target_l, 'clusters_expanded', n_expanded)
+            return
+        n_reprs = len(cursor['rspace'][target_l])
+        candidates.extend(expand_rspace(k, cursor['rspace'][target_l], cluster_dict[target_l], prev_index))
+        _trace_length(trace, target_l, 'clusters_expanded', n_reprs - len(cursor['rspace'][target_l]))
+
+    def _search_lengths(target_l_list):
+        for target_l in target_l_list:
+            if target_l in trees:  # only the top of the tree is ranked, the nodes below as they are expanded
+                cursor['rspace'][target_l] = []
+                _score_nodes(target_l, trees[target_l])
+            else:
+                target_cluster = cluster_dict[target_l]
+                target_reprs = list(target_cluster.keys())
+                r_data = [_fetch_data(x, data_normalized, window_stats) for x in
+                          target_reprs]  # fetch data_original for the representatives
+                cursor['rspace'][target_l] = rank_rspace(_q_data(target_l), r_data, target_reprs, dt_index=pnorm,
+                                                         deadline=deadline)
+                ranked.extend(cursor['rspace'][target_l])
+                _trace_length(trace, target_l, 'reprs_scored', len(cursor['rspace'][target_l]))
+            _expand(target_l)
+            cursor['lens'].remove(target_l)
+
+    for target_l in cursor['rspace'].keys():  # carry on with the lengths searched already
+        _expand(target_l)
+    if is_first_round and plan is not None:  # the driver knows which lengths are needed to reach ke
+        _search_lengths([x for x in plan['lens'] if x in cluster_dict])
+        cursor['radius'] = plan['radius']
+    else:
+        while len(cursor['lens']) > 0 and len(candidates) < ke and not _is_expired(deadline):
+            # the specific sized sequences from which the candidates will be extracted, depending on the query length
+            # and the radius
+            _search_lengths(get_trgt_len_within_r(l_list=cursor['lens'], q_len=len(q.data), radius=cursor['radius']))
+            cursor['radius'] += 1  # ready to search the next length
+
+    candidates = _filter_candidates(candidates, q, exclude_same_id, id_filter, filter_mode)
+    # fetch data_original for the candidates
+    c_data = [_fetch_data(x, data_normalized, window_stats) for x in candidates]
+    for cd, c in zip(c_data, candidates):
+        if _is_expired(deadline):
+            break
+        heapq.heappush(cursor['pool'], (sim_between_array(cd, _q_data(len(c)), pnorm), c))
+        if trace is not None:
+            trace['candidates_scored'] += 1
+    cursor['timed_out'] = _is_expired(deadline)
+    cursor['trace'] = trace
+    if cursor['timed_out']:  # the members may not have been compared yet, give the representatives their place
+        pooled = set(x[1] for x in cursor['pool'])
+        r_dist = dict((r, d) for d, r in ranked)
+        for r in _filter_candidates(list(r_dist.keys()), q, exclude_same_id, id_filter, filter_mode):
+            if r not in pooled and (prev_index is None or not prev_index.is_overlapping(r)):
+                heapq.heappush(cursor['pool'], (r_dist[r], r))
+    # note that we are using k here
+    return [([heapq.heappop(cursor['pool']) for _ in range(min(k, len(cursor['pool'])))], cursor)]
+
+
+def _query_partition_batch(cluster, batch: list):
+    """
+    _query_partition of several queries on the same partition
+    :param batch: list of (query index, keyword arguments of _query_partition but cluster)
+    :return: a list of (query index, retrieved matches, cursor)
+    """
+    cluster = list(cluster)
+    return [(j,) + x for j, kwargs in batch for x in _query_partition(cluster, **kwargs)]
 
+
+def _query_partition_lb_opt(cluster_dict, q, k: int, ke: int, data_normalized, pnorm: int, lb_opt, exclude_same_id,
+                            radius: int, st: float, id_filter, filter_mode, window_stats=None, trace: dict = None):
+    """
+    _query_partition with the representatives pruned by lower bounds, see bsf_search_rspace
+    :param trace: the trace of _query_partition to fill, None not to trace
+    """
+    q_length = len(q.data)
+    candidates = []
     while len(cluster_dict) > 0 and len(candidates) < ke:
         available_lens = list(cluster_dict.keys())
-        # the specific sized sequences from which the candidates will be extracted, depending on the query length and
-        # the radius
         target_l_list = get_trgt_len_within_r(l_list=available_lens, q_len=q_length, radius=radius)
-        # print('Num Candidate = ' + str(len(candidates)) + ' cluster key: ' + str(list(cluster_dict.keys())) + '
-        # targetlenlist: ' + str(target_l_list))
         for target_l in target_l_list:
-            # print('searching')
             target_cluster = cluster_dict[target_l]
             target_reprs = target_cluster.keys()
-            r_data = [x.fetch_data(data_normalized) for x in
+            r_data = [_fetch_data(x, data_normalized, window_stats) for x in
                       target_reprs]  # fetch data_original for the representatives
-
-            # start = time.time()
-            # this_candidates = get_sequences_represented(
-            #     bsf_search_rspace(q, k, r_list=target_reprs, cluster=target_cluster, st=st),
-            #     cluster=target_cluster)
-            # duration_opt = time.time() - start
-            # start = time.time()
-            # this_candidates = naive_search_rspace(q, k, r_list=target_reprs, cluster=target_cluster)
-            # duration_nonopt = time.time() - start
-
-            if lb_opt:
-                this_candidates = \
-                    bsf_search_rspace(q, k, r_data, r_list=target_reprs, cluster=target_cluster, st=st, dt_index=pnorm)
-            else:
-                this_candidates = \
-                    naive_search_rspace(q, k, r_data, r_list=target_reprs, cluster=target_cluster, dt_index=pnorm, overlap=overlap, prev_matches=prev_matches)
-            candidates += this_candidates
+            expanded, counts = counted(bsf_search_rspace, q, k, r_data, r_list=target_reprs, cluster=target_cluster,
+                                       st=st, dt_index=pnorm)
+            candidates += expanded
+            _trace_length(trace, target_l, 'reprs_scored', counts.get(DIST, 0))
+            # every cluster holds its representative
+            _trace_length(trace, target_l, 'clusters_expanded', len(set(expanded) & set(target_cluster.keys())))
             cluster_dict.pop(target_l)
         radius += 1  # ready to search the next length
 
+    candidates = _filter_candidates(candidates, q, exclude_same_id, id_filter, filter_mode)
+    if len(candidates) == 0:
+        return []
+
+    # fetch data_original for the candidates
+    c_data = [_fetch_data(x, data_normalized, window_stats) for x in candidates]
+    if trace is not None:
+        trace['candidates_scored'] = len(candidates)
+    if lb_opt == 'bsf':
+        return bsf_search(q, k, c_data, candidates, dt_index=pnorm)
+    else:
+        return naive_search(q, k, c_data, candidates, dt_index=pnorm)
+
+
+def _trace_length(trace: dict, seq_len: int, key: str, n: int):
+    if trace is not None:
+        length_trace = trace['lengths'].setdefault(seq_len, {'reprs_scored': 0, 'clusters_expanded': 0})
+        length_trace[key] += n
+
+
+def _filter_candidates(candidates, q, exclude_same_id, id_filter, filter_mode):
     # process exclude same id
     candidates = [x for x in candidates if x.seq_id != q.seq_id] if exclude_same_id else candidates
     if id_filter:  # filter by seq id
@@ -191,17 +425,70 @@ def _query_partition(cluster, q, k: int, ke: int, data_normalized, pnorm: int,
             candidates = [x for x in candidates if (check_id_any(x.seq_id, id_filter))]
         if filter_mode == 'all':
             candidates = [x for x in candidates if (check_id_all(x.seq_id, id_filter))]
-    if len(candidates) == 0:
-        return []
+    return candidates
 
-    # fetch data_original for the candidates
-    c_data = [x.fetch_data(data_normalized) for x in candidates]
-    # print('# Sequences in the candidate list:: ' + str(len(candidates)))
 
-    if lb_opt == 'bsf':
-        return bsf_search(q, k, c_data, candidates, dt_index=pnorm)
-    else:
-        return naive_search(q, k, c_data, candidates, dt_index=pnorm)
+def _range_query_partition(cluster, q, eps: float, data_normalized, pnorm, loi, exact_dist: bool = False,
+                           window_stats=None):
+    """
+    find every subsequence within eps of q on the worker node, with the distance the clusters are built with.
+    The triangle inequality on the representative distance and the cluster radius decides for each cluster whether
+    it is included as a whole, excluded as a whole or scanned; the members of a scanned cluster go through the
+    cascade: triangle inequality on their distance to the representative, lb_kim on the endpoints, then the distance.
+
+    :param cluster: cluster being queried
+    :param q: Query sequence, z-normalized already if window_stats is given
+    :param eps: distance threshold, inclusive
+    :param loi: (start, end) lengths to search, q is linearly resampled to the lengths other than its own
+    :param exact_dist: whether to compute the distance of the subsequences included without being compared,
+    otherwise their distance is None
+    :param window_stats: running sums of data_normalized, given when the database is built with
+    normalize='subsequence'
+
+    :return: a generator of (distance, Sequence)
+    """
+    q = unbroadcast(q)
+    data_normalized = unbroadcast(data_normalized)
+    window_stats = unbroadcast(window_stats)
+
+    cluster_dict = dict(list(reduce_by_key(lambda x, y: merge_dict([x, y]), cluster)))
+    for c_len, target_cluster in cluster_dict.items():
+        if not loi[0] <= c_len <= loi[1]:
+            continue
+        q_data = scale_query(q.get_data(), c_len, window_stats)
+        reprs = list(target_cluster.keys())
+        r_dists = dist_to_many(q_data, np.array([_fetch_data(r, data_normalized, window_stats) for r in reprs]), pnorm)
+        count(DIST, len(reprs))
+
+        for r, d_qr in zip(reprs, r_dists):
+            members = target_cluster[r]
+            radius = max(d for d, _ in members)
+            if d_qr - radius > eps:  # nothing in this cluster is close enough
+                continue
+            if d_qr + radius <= eps and not exact_dist:  # everything in this cluster is close enough
+                for _, s in members:
+                    yield None, s
+                continue
+
+            to_compare = []
+            for d_cr, s in members:
+                if abs(d_qr - d_cr) > eps:
+                    continue
+                if d_qr + d_cr <= eps and not exact_dist:
+                    yield None, s
+                else:
+                    to_compare.append(s)
+            if len(to_compare) == 0:
+                continue
+            c_data = np.array([_fetch_data(s, data_normalized, window_stats) for s in to_compare])
+            lb_mask = lb_endpoints_to_many(q_data, c_data, pnorm) <= eps
+            c_dists = dist_to_many(q_data, c_data[lb_mask], pnorm)
+            count(DIST, len(c_dists))
+            count(LB_PRUNED, len(to_compare) - len(c_dists))
+            count(LB_KIM_PRUNED, len(to_compare) - len(c_dists))
+            for d, s in zip(c_dists, [s for s, keep in zip(to_compare, lb_mask) if keep]):
+                if d <= eps:
+                    yield d, s
 
 
 def check_id_any(ids1: tuple, ids2: tuple):
@@ -222,21 +509,126 @@ def check_id_all(candidate_ids: tuple, filter_ids: tuple):
     """
     return set(filter_ids).issubset(set(candidate_ids))
 
-def naive_search_rspace(q, k, r_data, r_list, cluster, dt_index, overlap, prev_matches):
-    c_list = []
-    target_reprs = [(sim_between_array(rd, q.get_data(), dt_index), r) for rd, r in
-                    zip(r_data, r_list)]  # calculate DTW
+def scale_query(q_data, seq_len: int, window_stats=None):
+    """
+    uniform scaling of the query to seq_len, by linear interpolation
+    :param window_stats: given when the database is built with normalize='subsequence', the scaled query is then
+    z-normalized again
+    :return: the data of the query if it is seq_len long already, its scaling otherwise
+    """
+    q_data = np.asarray(q_data, dtype=np.float64)
+    if len(q_data) == seq_len:
+        return q_data
+    q_data = np.interp(np.linspace(0, 1, seq_len), np.linspace(0, 1, len(q_data)), q_data)
+    if window_stats is not None:  # resampling does not keep the query z-normalized
+        q_data = z_normalize_window(q_data, np.mean(q_data), np.std(q_data))
+    return q_data
+
+
+def rank_rspace(q_data, r_data, r_list, dt_index, deadline: float = None):
+    """
+    :param q_data: data of the query
+    :param deadline: time.time() after which the remaining representatives are left out
+    :return: heap of (DTW distance to q, representative)
+    """
+    target_reprs = []
+    for rd, r in zip(r_data, r_list):
+        if _is_expired(deadline):
+            break
+        target_reprs.append((sim_between_array(rd, q_data, dt_index), r))  # calculate DTW
     heapq.heapify(target_reprs)  # heap sort R-space
+    return target_reprs
+
+
+def _is_expired(deadline: float):
+    return deadline is not None and time.time() >= deadline
+
+
+def _is_exhausted(cursor: dict):
+    """
+    :return: whether the partition of the cursor has nothing left to search
+    """
+    return cursor is not None and 'lens' in cursor and len(cursor['lens']) == 0 and len(cursor['pool']) == 0 and \
+        all(len(x) == 0 for x in cursor['rspace'].values())
+
+
+def expand_rspace(k, target_reprs, cluster, prev_index=None):
+    """
+    pop the closest representatives from the heap target_reprs until they represent at least k sequences
+    :param prev_index: OverlapIndex of the previous matches, the sequences overlapping them are left out
+    """
+    c_list = []
     # get enough sequence from the clusters represented to query
     while len(target_reprs) > 0 and len(c_list) < k:
         this_repr = heapq.heappop(target_reprs)[
             1]  # take the second element for the first one is the DTW dist
         # filter by overlap
-        target_cluster = cluster[this_repr] if overlap == 1.0 else [c for c in cluster[this_repr] if not any(_isOverlap(c, pv_c[1], overlap) for pv_c in prev_matches)]
+        target_cluster = [c for _, c in cluster[this_repr]] if prev_index is None else \
+            [c for _, c in cluster[this_repr] if not prev_index.is_overlapping(c)]
         c_list += (target_cluster)
     return c_list
 
 
+def expand_rtree(k, target_nodes, cluster, score_nodes, prev_index=None):
+    """
+    expand_rspace through a tree of representatives, see brainex.classes.TreeCluster: pop the best nodes from the heap
+    target_nodes until the clusters of the representatives popped hold at least k sequences. A node with children is
+    replaced by its children, so only the representatives under the best nodes are ever compared with the query
+    :param target_nodes: heap of (distance to the query, less the radius for a node with children, tie breaker, node),
+    the order is a heuristic: every node is kept until it is popped
+    :param score_nodes: function pushing a list of nodes onto target_nodes
+    :return: (the sequences of the clusters expanded, the number of clusters expanded)
+    """
+    c_list = []
+    n_expanded = 0
+    while len(target_nodes) > 0 and len(c_list) < k:
+        r, _, children = heapq.heappop(target_nodes)[2]
+        if children is not None:
+            score_nodes(children)
+            continue
+        c_list += [c for _, c in cluster[r]] if prev_index is None else \
+            [c for _, c in cluster[r] if not prev_index.is_overlapping(c)]
+        n_expanded += 1
+    return c_list, n_expanded
+
+
+def _dtw_radius(radius: float, seq_len: int, pnorm):
+    """
+    :param radius: radius of a node of a tree of representatives, in the distance the clusters are built with
+    :return: the radius on the scale of sim_between_array, as the distance between the representative and a member
+    at the radius would be along the diagonal warping path: the pointwise distances sum to at most seq_len * radius.
+    DTW is not a metric, so the distance to q less this is only a heuristic priority in expand_rtree, not a lower
+    bound: nothing may be pruned on it
+    """
+    if pnorm == 2:
+        return np.sqrt(radius / 2)
+    elif pnorm == 1:
+        return radius / 2
+    return seq_len * radius
+
+
+def _repr_trees(cluster) -> dict:
+    """
+    :param cluster: list of (seq_len, cluster) of a partition
+    :return: seq_len -> the top nodes of the trees of the representatives of that length, for the lengths with a tree.
+    The representatives of a cluster without one are leaves at the top
+    """
+    tops, with_tree = dict(), set()
+    for seq_len, c in cluster:
+        tree = getattr(c, 'tree', None)
+        if tree is not None:
+            with_tree.add(seq_len)
+        else:
+            tree = [(r, max(d for d, _ in members), None) for r, members in c.items()]
+        tops.setdefault(seq_len, []).extend(tree)
+    return dict((seq_len, tops[seq_len]) for seq_len in with_tree)
+
+
+def _pruned(bound: str):
+    count(LB_PRUNED)
+    count(bound)
+
+
 def naive_search(q: Sequence, k: int, c_data, candidates: list, dt_index: int):
     query_result = []
     c_dist_list = [(sim_between_array(cd, q.get_data(), dt_index), c) for cd, c in zip(c_data, candidates)]
@@ -253,7 +645,6 @@ def naive_search(q: Sequence, k: int, c_data, candidates: list, dt_index: int):
 
 def bsf_search(q, k, c_data, candidates, dt_index: int):
     # use ranked heap
-    # prune_count = 0
     query_result = list()
     # print('Num seq in the querying cluster: ' + str(len(querying_cluster)))
     for cd, c in zip(c_data, candidates):
@@ -264,7 +655,7 @@ def bsf_search(q, k, c_data, candidates, dt_index: int):
         else:  # len(dist_heap) == k or >= k
             # if the new seq is better than the heap head
             if -lb_kim_sequence(cd, q.data) < query_result[0][0]:
-                # prune_count += 1
+                _pruned(LB_KIM_PRUNED)
                 continue
             # interpolate for keogh calculation
             if len(c) != len(q):
@@ -273,17 +664,16 @@ def bsf_search(q, k, c_data, candidates, dt_index: int):
             else:
                 c_interp_data = cd
             if -lb_keogh_sequence(c_interp_data, q.data) < query_result[0][0]:
-                # prune_count += 1
+                _pruned(LB_KEOGH_PRUNED)
                 continue
             if -lb_keogh_sequence(q.data, c_interp_data) < query_result[0][0]:
-                # prune_count += 1
+                _pruned(LB_KEOGH_REV_PRUNED)
                 continue
             dist = -sim_between_array(q.get_data(), cd, dt_index, use_fast=True)
             if dist > query_result[0][0]:  # first index denotes the top of the heap, second gets the dist
                 heapq.heappop(query_result)
                 heapq.heappush(query_result, (dist, c))
     if (len(query_result)) >= k:
-        # print(str(prune_count) + ' of ' + str(len(candidates)) + ' candidate(s) pruned')
         return [(-x[0], x[1]) for x in query_result]
 
 
@@ -297,7 +687,6 @@ def bsf_search_rspace(q, ke, r_data, r_list, cluster, st, dt_index: int):
     :return:
     """
     # use ranked heap
-    # prune_count = 0
     result_list = list()
     # print(r_list)
     for rd, r in zip(r_data, r_list):
@@ -309,7 +698,7 @@ def bsf_search_rspace(q, ke, r_data, r_list, cluster, st, dt_index: int):
         else:  # len(dist_heap) == k or >= k
             # a = lb_kim_sequence(r.data, q.data)
             if lb_kim_sequence(rd, q.data) > st:
-                # prune_count += 1
+                _pruned(LB_KIM_PRUNED)
                 continue
             # interpolate for keogh calculation
             if len(r) != len(q):
@@ -319,17 +708,16 @@ def bsf_search_rspace(q, ke, r_data, r_list, cluster, st, dt_index: int):
                 r_interp_data = rd
             # b = lb_keogh_sequence(candidate_interp_data, q.data)
             if lb_keogh_sequence(r_interp_data, q.data) > st:
-                # prune_count += 1
+                _pruned(LB_KEOGH_PRUNED)
                 continue
             # c = lb_keogh_sequence(q.data, candidate_interp_data)
             if lb_keogh_sequence(q.data, r_interp_data) > st:
-                # prune_count += 1
+                _pruned(LB_KEOGH_REV_PRUNED)
                 continue
             dist = sim_between_array(q.get_data(), rd, dt_index, use_fast=False)
             if dist < result_list[0][0]:  # first index denotes the top of the heap, second gets the dist
                 heapq.heappop(result_list)
                 heapq.heappush(result_list, (dist, r))
-    # print(str(prune_count) + ' of ' + str(len(r_list)) + ' representative(s) pruned')
     return get_sequences_represented([r[1] for r in result_list], cluster)  # only return the representatives
 
 
@@ -0,0 +1,298 @@
+"""
+local query server: the databases are loaded once and their backend (Pool, ThreadPool or SparkContext) stays up, so that
+a request only pays for the query itself. Requests are pickled over multiprocessing.connection, a client keeps its
+connections open between requests.
+
+Since a request is unpickled, whoever holds the authkey can run code in the server: the key is taken from the
+BRAINEX_AUTHKEY environment variable, or drawn at random when the server starts and written to a file only its user
+can read. Clients may only load the databases under the root directory given to the server, and cannot save.
+
+    python -m brainex.server name=path [name=path ...] [--port 6000] [--workers n] [--backend thread] [--root dir]
+        [--authkey-file path]
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import threading
+from multiprocessing.connection import Listener, Client
+
+DEFAULT_ADDRESS = ('localhost', 6000)
+AUTHKEY_ENV = 'BRAINEX_AUTHKEY'
+DEFAULT_AUTHKEY_FILE = os.path.join('~', '.brainex_authkey')
+
+# the engine methods a client may call
+SERVED_METHODS = {'build', 'query', 'query_brute_force', 'range_query', 'query_on_batch', 'query_bf_on_batch',
+                  'similarity_join', 'predice_label_knn', 'motif', 'discords', 'motif_matrix_profile',
+                  'discord_matrix_profile', 'get_random_seq_of_len', 'get_num_subsequences', 'get_num_clusters',
+                  'get_length_directory'}
+
+
+class QueryServer:
+    """
+    serves the databases it holds over a local socket, one thread per connection. The requests on the same database
+    run one at a time.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey: bytes = None, num_worker: int = None,
+                 backend: str = None, root: str = None):
+        """
+        :param authkey: key the clients must give, defaults to BRAINEX_AUTHKEY, or to a random one if it is not set
+        :param num_worker: number of workers of the databases loaded by the server, defaults to the number of cores
+        :param backend: backend of the databases loaded by the server, see brainex.utils.gxe_utils.from_db
+        :param root: directory the clients may load databases from, their paths are relative to it. Clients cannot
+        load any database if it is None
+        """
+        self.address = address
+        self.authkey = authkey or _env_authkey() or random_authkey()
+        self.root = None if root is None else os.path.realpath(root)
+        self.num_worker = multiprocessing.cpu_count() if num_worker is None else num_worker
+        self.backend = backend
+        self._dbs = dict()  # name -> (engine, lock)
+        self._dbs_lock = threading.Lock()
+        self._listener = None
+        self._stopped = threading.Event()
+
+    def add(self, name: str, db):
+        """
+        serve a database already built or loaded, under name. The server stops it on shutdown
+        """
+        with self._dbs_lock:
+            if name in self._dbs:
+                raise Exception('QueryServer: a database is already served under ' + name)
+            self._dbs[name] = (db, threading.Lock())
+
+    def load(self, name: str, path: str, **kwargs):
+        """
+        load a saved database with brainex.utils.gxe_utils.from_db and serve it under name
+        """
+        from brainex.utils.gxe_utils import from_db
+        kwargs.setdefault('backend', self.backend)
+        self.add(name, from_db(path, num_worker=kwargs.pop('num_worker', self.num_worker), **kwargs))
+
+    def unload(self, name: str):
+        with self._dbs_lock:
+            db, lock = self._dbs.pop(name)
+        with lock:
+            db.stop()
+
+    def names(self):
+        return list(self._dbs.keys())
+
+    def _client_path(self, path: str) -> str:
+        """
+        :return: path of a database a client asks for, under root
+        """
+        if self.root is None:
+            raise Exception('QueryServer: the server has no root directory, clients cannot load databases')
+        rtn = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, rtn]) != self.root:
+            raise Exception('QueryServer: path is outside the root directory of the server: ' + str(path))
+        return rtn
+
+    def handle(self, request):
+        """
+        :param request: (name of the database, engine method, args, kwargs), or (None, 'load' | 'unload' | 'names',
+        args, kwargs) for the server itself
+        :return: the result of the method, generators are given as lists
+        """
+        name, method, args, kwargs = request
+        if name is None:
+            if method not in ('load', 'unload', 'names'):
+                raise Exception('QueryServer: unknown server method ' + str(method))
+            if method == 'load':
+                args = (args[0], self._client_path(args[1])) + tuple(args[2:])
+            return getattr(self, method)(*args, **kwargs)
+        if method not in SERVED_METHODS:
+            raise Exception('QueryServer: method is not served: ' + str(method))
+        try:
+            db, lock = self._dbs[name]
+        except KeyError:
+            raise Exception('QueryServer: no database is served under ' + str(name))
+        with lock:
+            rtn = getattr(db, method)(*args, **kwargs)
+            return list(rtn) if method == 'range_query' else rtn
+
+    def _serve_connection(self, conn):
+        with conn:
+            while not self._stopped.is_set():
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):  # the client closed the connection
+                    return
+                try:
+                    response = ('ok', self.handle(request))
+                except Exception as e:
+                    response = ('error', '%s: %s' % (type(e).__name__, e))
+                conn.send(response)
+
+    def _bind(self):
+        if self._listener is None:
+            self._listener = Listener(self.address, authkey=self.authkey)
+            self.address = self._listener.address  # the port is chosen by the system if it was 0
+
+    def serve_forever(self):
+        self._bind()
+        with self._listener:
+            while True:
+                try:
+                    conn = self._listener.accept()
+                except (OSError, EOFError, multiprocessing.AuthenticationError):  # failed handshake, wrong key
+                    continue
+                if self._stopped.is_set():
+                    conn.close()
+                    return
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def start(self):
+        """
+        serve_forever in a background thread
+        :return: the address the server listens on
+        """
+        self._bind()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.address
+
+    def shutdown(self):
+        """
+        stop accepting connections and stop every database served
+        """
+        self._stopped.set()
+        try:  # wake up the accept of serve_forever
+            Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+        for name in self.names():
+            self.unload(name)
+
+
+class QueryClient:
+    """
+    client of a QueryServer. Up to pool_size connections are opened as needed and kept for the next requests, so
+    several threads can have requests running at the same time.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey: bytes = None, pool_size: int = 4):
+        """
+        :param authkey: key of the server, defaults to BRAINEX_AUTHKEY
+        """
+        self.address = address
+        self.authkey = authkey or _env_authkey()
+        if not self.authkey:
+            raise Exception('QueryClient: no authkey given and ' + AUTHKEY_ENV + ' is not set')
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                return Client(self.address, authkey=self.authkey)
+            except Exception:
+                self._slots.release()
+                raise
+
+    def _release(self, conn, reuse: bool):
+        if reuse:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def call(self, name, method: str, *args, **kwargs):
+        """
+        call method of the database served under name, with args and kwargs
+        """
+        conn = self._acquire()
+        try:
+            conn.send((name, method, args, kwargs))
+            status, result = conn.recv()
+        except BaseException:  # the connection is in an unknown state
+            self._release(conn, reuse=False)
+            raise
+        self._release(conn, reuse=True)
+        if status == 'error':
+            raise Exception('QueryClient: ' + result)
+        return result
+
+    def load(self, name: str, path: str, **kwargs):
+        """
+        :param path: path of the database, relative to the root directory of the server
+        """
+        return self.call(None, 'load', name, path, **kwargs)
+
+    def unload(self, name: str):
+        return self.call(None, 'unload', name)
+
+    def names(self):
+        return self.call(None, 'names')
+
+    def build(self, name: str, st: float, **kwargs):
+        return self.call(name, 'build', st, **kwargs)
+
+    def query(self, name: str, query, best_k: int, **kwargs):
+        return self.call(name, 'query', query, best_k, **kwargs)
+
+    def query_brute_force(self, name: str, query, best_k: int, **kwargs):
+        return self.call(name, 'query_brute_force', query, best_k, **kwargs)
+
+    def range_query(self, name: str, query, eps: float, **kwargs):
+        return self.call(name, 'range_query', query, eps, **kwargs)
+
+    def predict_label_knn(self, name: str, query, k: int, label_index: int):
+        return self.call(name, 'predice_label_knn', query, k, label_index)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _env_authkey():
+    key = os.environ.get(AUTHKEY_ENV)
+    return key.encode() if key else None
+
+
+def random_authkey() -> bytes:
+    return os.urandom(32).hex().encode()
+
+
+def write_authkey(authkey: bytes, path: str):
+    """
+    write authkey to path, readable and writable by its owner only
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        os.fchmod(f.fileno(), 0o600)  # the file may have existed with other permissions
+        f.write(authkey)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve saved brainex databases over a local socket')
+    parser.add_argument('dbs', nargs='*', help='name=path of the databases to load, more can be loaded by clients')
+    parser.add_argument('--host', default=DEFAULT_ADDRESS[0])
+    parser.add_argument('--port', type=int, default=DEFAULT_ADDRESS[1])
+    parser.add_argument('--authkey-file', default=DEFAULT_AUTHKEY_FILE,
+                        help='where the random authkey is written if ' + AUTHKEY_ENV + ' is not set')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--backend', default=None, choices=['multiprocess', 'thread'])
+    parser.add_argument('--root', default=None, help='directory clients may load databases from')
+    args = parser.parse_args()
+    server = QueryServer((args.host, args.port), num_worker=args.workers, backend=args.backend, root=args.root)
+    if not _env_authkey():
+        write_authkey(server.authkey, os.path.expanduser(args.authkey_file))
+        print('authkey written to ' + args.authkey_file + ', give it to the clients in ' + AUTHKEY_ENV)
+    for db in args.dbs:
+        db_name, db_path = db.split('=', 1)
+        server.load(db_name, db_path)
+    print('serving ' + ', '.join(server.names()) + ' on %s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
@@ -1,20 +1,52 @@
 import multiprocessing
+import multiprocessing.pool
 
 from brainex.misc import pr_red
-from brainex.utils.spark_utils import _create_sc, _pr_spark_conf
 
+BACKENDS = ('multiprocess', 'spark', 'thread')
 
-def _multiprocess_backend(use_spark, **kwargs):
+
+def _spark_backend():
+    """
+    the Spark backend brainex.utils.spark_utils, imported on first use so that pyspark is only loaded by the engines
+    using Spark
+    """
+    from brainex.utils import spark_utils
+    return spark_utils
+
+
+def _backend_name(use_spark, backend: str = None):
+    """
+    :param backend: 'multiprocess', 'spark' or 'thread', overrides use_spark if given
+    """
+    backend = backend if backend is not None else 'spark' if use_spark else 'multiprocess'
+    try:
+        assert backend in BACKENDS
+    except AssertionError:
+        raise Exception('_backend_name: backend must be one of ' + str(BACKENDS) + ', given ' + str(backend))
+    return backend
+
+
+def _multiprocess_backend(use_spark, backend: str = None, **kwargs):
     """
     num_worker:
     driver_mem:
     max_result_mem:
+    :param backend: see _backend_name. The 'thread' backend is a pool of threads with the same interface as the
+    multiprocess one: the data and the clusters are shared instead of being sent to the workers, at the cost of the
+    work that holds the GIL running one thread at a time
     :return None if not using spark
     """
-    if use_spark:
+    backend = _backend_name(use_spark, backend)
+    if backend == 'spark':
         pr_red('Genex Engine: Using PySpark Backend')
-        mp_context = _create_sc(num_cores=kwargs['num_worker'], driver_mem=kwargs['driver_mem'], max_result_mem=kwargs['max_result_mem'])
-        _pr_spark_conf(mp_context)
+        spark_utils = _spark_backend()
+        mp_context = spark_utils._create_sc(num_cores=kwargs['num_worker'], driver_mem=kwargs['driver_mem'],
+                                            max_result_mem=kwargs['max_result_mem'])
+        spark_utils._pr_spark_conf(mp_context)
+    elif backend == 'thread':
+        pr_red('Genex Engine: Using Python Native Threads')
+        mp_context = multiprocessing.pool.ThreadPool(kwargs['num_worker'])
     else:
         pr_red('Genex Engine: Using Python Native Multiprocessing')
         mp_context = multiprocessing.Pool(kwargs['num_worker'], maxtasksperchild=1)
@@ -10,13 +10,14 @@ import multiprocessing
 
 from brainex import GenexEngine
 from brainex.database.BrainexEngine import BrainexEngine
+from brainex.database.genexengine import CLUSTER_FORMAT
 from brainex.misc import allUnique
 from brainex.utils.utils import _df_to_list, genex_normalize
-from brainex.utils.context_utils import _multiprocess_backend
+from brainex.utils.context_utils import _multiprocess_backend, _backend_name
 
 
 def load(file_or_path: str, feature_num: int = None, num_worker: int = None, use_spark: bool = False, header=0,
-         driver_mem: int = 16, max_result_mem: int = 16, _rows_to_consider: int = None):
+         driver_mem: int = 16, max_result_mem: int = 16, _rows_to_consider: int = None, backend: str = None):
     db = None
     if num_worker is None:  # the default number of workers is the number of logical cores in the host system
         num_worker = multiprocessing.cpu_count()
@@ -29,14 +30,14 @@ def load(file_or_path: str, feature_num: int = None, num_worker: int = None, use
         else:
             db = from_csv(data=file_or_path, feature_num=feature_num,
                           num_worker=num_worker, use_spark=use_spark, header=header, driver_mem=driver_mem,
-                          max_result_mem=max_result_mem, _rows_to_consider=_rows_to_consider)
+                          max_result_mem=max_result_mem, _rows_to_consider=_rows_to_consider, backend=backend)
 
     elif os.path.isdir(file_or_path):
         if not isinstance(num_worker, int):
             raise TypeError('Please provide a integer worker number.')
         else:
             db = from_db(path=file_or_path, num_worker=num_worker,
-                         driver_mem=driver_mem, max_result_mem=max_result_mem)
+                         driver_mem=driver_mem, max_result_mem=max_result_mem, backend=backend)
 
     else:
         raise ValueError('Not a valid file name or directory path, please check it again.')
@@ -53,7 +54,8 @@ def from_csv(data, feature_num: int,
              _rows_to_consider: int = None,
              _memory_opt: str = None,
              _is_z_normalize=False,
-             _seed=42):
+             _seed=42,
+             backend: str = None):
     """
     build a genex_database object from given csv,
     Note: if time series are of different length, shorter sequences will be post padded to the length
@@ -67,6 +69,8 @@ def from_csv(data, feature_num: int,
     :param driver_mem:
     :param max_result_mem:
     :param use_spark:
+    :param backend: 'multiprocess', 'spark' or 'thread', overrides use_spark if given. See
+    brainex.utils.context_utils._multiprocess_backend
     :param num_worker:
     :param data:
     :param feature_num:
@@ -124,11 +128,12 @@ def from_csv(data, feature_num: int,
             raise Exception('_rows_to_consider must be either a list or an integer')
 
     data_norm_list, global_max, global_min = genex_normalize(data_list, z_normalization=_is_z_normalize)
-    mp_context = _multiprocess_backend(use_spark, num_worker=num_worker, driver_mem=driver_mem,
+    backend = _backend_name(use_spark, backend)
+    mp_context = _multiprocess_backend(use_spark, backend, num_worker=num_worker, driver_mem=driver_mem,
                                        max_result_mem=max_result_mem)
     return BrainexEngine(data_raw=df, data_original=data_list, data_normalized=data_norm_list, global_max=global_max,
                          global_min=global_min, has_uuid=add_uuid,
-                         mp_context=mp_context, backend='multiprocess' if not use_spark else 'spark',
+                         mp_context=mp_context, backend=backend,
                          seq_dim=_ts_dim)
 
 
@@ -140,10 +145,13 @@ def need_uuid(df, feature_num):
 def from_db(path: str,
             num_worker: int,
             driver_mem: int = 4, max_result_mem: int = 4,
+            backend: str = None
             ):
     """
     returns a previously saved gxe object from its saved path
 
+    :param backend: 'multiprocess' or 'thread' to switch between the two backends that store the clusters the same
+    way, the saved backend is used if None
     :param max_result_mem:
     :param driver_mem:
     :param use_spark:
@@ -166,18 +174,33 @@ def from_db(path: str,
     # cast the type to np type so that they can be operated on list
     conf['global_max'] = np.int64(conf['global_max'])
     conf['global_min'] = np.int64(conf['global_min'])
+    if backend is not None:
+        try:
+            assert not is_conf_using_spark(conf) and _backend_name(False, backend) != 'spark'
+        except AssertionError:
+            raise Exception('from_db: the backend of a database can only be switched between multiprocess and thread, '
+                            'saved: ' + str(conf['backend']) + ', given: ' + str(backend))
+        conf['backend'] = backend
+
+    build_conf = None
+    if os.path.exists(os.path.join(path, 'clusters.gxe')):
+        build_conf = json.load(open(os.path.join(path, 'build_conf.json'), 'rb'))
+        if build_conf.get('cluster_format', 1) != CLUSTER_FORMAT:
+            raise Exception('from_db: the clusters of ' + path + ' were saved in format ' +
+                            str(build_conf.get('cluster_format', 1)) + ', this version reads format ' +
+                            str(CLUSTER_FORMAT) + '. Rebuild the database from its data and save it again')
 
-    mp_context = _multiprocess_backend(is_conf_using_spark(conf), num_worker=num_worker, driver_mem=driver_mem,
-                                       max_result_mem=max_result_mem)
+    mp_context = _multiprocess_backend(is_conf_using_spark(conf), conf['backend'], num_worker=num_worker,
+                                       driver_mem=driver_mem, max_result_mem=max_result_mem)
     init_params = {'data_raw': data_raw, 'data_original': data, 'data_normalized': data_normalized,
                    'mp_context': mp_context, 'conf': conf}
     engine: GenexEngine = GenexEngine(**init_params)
 
-    if os.path.exists(os.path.join(path, 'clusters.gxe')):
+    if build_conf is not None:
         engine.load_cluster(path)
         engine.set_cluster_meta_dict(pickle.load(open(os.path.join(path, 'cluster_meta_dict.gxe'), 'rb')))
-        build_conf = json.load(open(os.path.join(path, 'build_conf.json'), 'rb'))
         engine.set_build_conf(build_conf)
+        engine._set_window_stats()
         if engine.is_using_spark():
             engine._data_normalized_bc = engine.mp_context.broadcast(engine.data_normalized)
     return engine
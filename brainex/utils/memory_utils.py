@@ -0,0 +1,144 @@
+"""
+estimate of the memory a build takes, made before the build from the lengths of the time series, and the memory budget
+of build.
+
+A build holds every subsequence of the lengths of interest twice: once as a member of its cluster, as a (distance,
+Sequence) pair, and once in the flat list of subsequences that query_brute_force scans. Their number grows with the
+square of the length of the time series, the data itself is small in comparison. Every coarser level of st_levels
+holds every subsequence again in a new (distance, member) pair, the Sequence being shared with the finer levels. The
+trees of repr_fanout, and those of the levels of st_levels, hold a leaf per representative, at most one per
+subsequence, and fewer nodes above them; the coarser levels having few representatives, all the trees are counted as
+two nodes per subsequence.
+"""
+import functools
+import tracemalloc
+
+from brainex.classes.Sequence import Sequence
+from brainex.utils.metrics_utils import pickled_size
+
+SIZE_UNITS = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_size(size) -> int:
+    """
+    :param size: number of bytes, or a string of a number and a unit K, M, G or T, as in '16G' or '512M'
+    :return: the number of bytes
+    """
+    if isinstance(size, str):
+        size = size.strip().upper().rstrip('B')
+        try:
+            if size[-1:] in SIZE_UNITS:
+                return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+            return int(float(size))
+        except ValueError:
+            raise Exception('parse_size: memory size must be a number of bytes or a string like 16G, given ' + size)
+    return int(size)
+
+
+def num_subsequences(data, start: int, end: int, length_step: int = 1) -> int:
+    """
+    :param data: list of (id, data) as data_normalized
+    :return: the number of subsequences of the lengths start, start + length_step, ... up to end
+    """
+    rtn = 0
+    for _, ts in data:
+        max_len = min(end, len(ts))
+        if max_len >= start:
+            num_lens = (max_len - start) // length_step + 1
+            last = start + (num_lens - 1) * length_step
+            # len(ts) - seq_len + 1 subsequences of every length, summed over the lengths
+            rtn += num_lens * (len(ts) + 1) - (start + last) * num_lens // 2
+    return rtn
+
+
+@functools.lru_cache()
+def _subsequence_bytes() -> (int, int):
+    """
+    :return: (bytes of a cluster member, bytes of a subsequence in the flat list), measured by allocating a few. The
+    id is shared by all the subsequences of a time series and not counted
+    """
+    n = 1000
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        seqs = [Sequence(('id',), i + 2 ** 10, i + 2 ** 11) for i in range(n)]  # integers are not cached above 256
+        sequence, _ = tracemalloc.get_traced_memory()
+        members = [(float(i), seq) for i, seq in enumerate(seqs)]
+        member, _ = tracemalloc.get_traced_memory()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    del members
+    return (member - base) // n, (sequence - base) // n
+
+
+@functools.lru_cache()
+def pickled_subsequence_bytes() -> (int, int):
+    """
+    :return: (bytes of a cluster member, bytes of a subsequence) once pickled in a list of them, as the partitions are
+    sent to the workers. The id is shared by all the subsequences of a time series and not counted
+    """
+    n = 1000
+    seqs = [Sequence(('id',), i + 2 ** 10, i + 2 ** 11) for i in range(n)]
+    return pickled_size([(float(i), seq) for i, seq in enumerate(seqs)]) // n, pickled_size(seqs) // n
+
+
+def estimate_build(data, start: int, end: int, length_step: int = 1, normalize: str = None,
+                   keep_subsequences: bool = True, num_levels: int = 1, repr_fanout: int = None) -> dict:
+    """
+    :param data: list of (id, data) as data_normalized
+    :param normalize: the normalize of build, 'subsequence' sends the running sums of the time series along with them
+    :param keep_subsequences: whether the flat list of subsequences is kept in memory along with the clusters
+    :param num_levels: the number of clusterings built, the build st and those of st_levels
+    :param repr_fanout: the repr_fanout of build, the clusters have a tree of their representatives if given, as they
+    have with more than one level
+    :return: {'num_subsequences', 'num_lengths', 'data_bytes': the time series in memory, 'broadcast_bytes': what is
+    sent to every worker, 'cluster_bytes', 'level_bytes': the coarser levels, 'tree_bytes', 'subsequence_bytes',
+    'total_bytes': the sum of all}, all in bytes
+    """
+    n = num_subsequences(data, start, end, length_step)
+    member_bytes, sequence_bytes = _subsequence_bytes()
+    pair_bytes = member_bytes - sequence_bytes  # a pair or a node around a Sequence held elsewhere
+    data_bytes = sum(ts.nbytes for _, ts in data)
+    broadcast_bytes = pickled_size(data) + (2 * data_bytes if normalize == 'subsequence' else 0)
+    rtn = {'num_subsequences': n,
+           'num_lengths': len(range(start, end + 1, length_step)),
+           'data_bytes': data_bytes,
+           'broadcast_bytes': broadcast_bytes,
+           'cluster_bytes': n * member_bytes,
+           'level_bytes': (num_levels - 1) * n * pair_bytes,
+           'tree_bytes': 2 * n * pair_bytes if repr_fanout is not None or num_levels > 1 else 0,
+           'subsequence_bytes': n * sequence_bytes if keep_subsequences else 0}
+    rtn['total_bytes'] = data_bytes + broadcast_bytes + rtn['cluster_bytes'] + rtn['level_bytes'] + \
+        rtn['tree_bytes'] + rtn['subsequence_bytes']
+    return rtn
+
+
+def fit_budget(data, start: int, end: int, budget: int, normalize: str = None, adapt: bool = False,
+               length_step: int = 1, num_levels: int = 1, repr_fanout: int = None):
+    """
+    find how to build within budget: as asked if the estimate fits, otherwise, with adapt, without keeping the flat
+    list of subsequences and then with the smallest length step from length_step that fits
+    :return: (keep_subsequences, length_step, estimate of the build so made)
+    """
+    estimate = estimate_build(data, start, end, length_step, normalize, num_levels=num_levels,
+                              repr_fanout=repr_fanout)
+    if estimate['total_bytes'] <= budget:
+        return True, length_step, estimate
+    if adapt:
+        for length_step in range(length_step, max(length_step, end - start + 1) + 1):
+            lean = estimate_build(data, start, end, length_step, normalize, keep_subsequences=False,
+                                  num_levels=num_levels, repr_fanout=repr_fanout)
+            if lean['total_bytes'] <= budget:
+                return False, length_step, lean
+    raise Exception('build: the build is estimated to take %.1f MB, over the memory budget of %.1f MB: %d subsequences '
+                    'of %d lengths, %.1f MB of clusters, %.1f MB of coarser levels and trees, %.1f MB of '
+                    'subsequences and %.1f MB of data sent to the workers. Give a narrower loi, fewer st_levels, a '
+                    'larger memory_budget%s' % (
+                        estimate['total_bytes'] / 2 ** 20, budget / 2 ** 20, estimate['num_subsequences'],
+                        estimate['num_lengths'], estimate['cluster_bytes'] / 2 ** 20,
+                        (estimate['level_bytes'] + estimate['tree_bytes']) / 2 ** 20,
+                        estimate['subsequence_bytes'] / 2 ** 20, estimate['broadcast_bytes'] / 2 ** 20,
+                        '' if adapt else ' or over_budget=\'adapt\''))
@@ -0,0 +1,151 @@
+"""
+metrics of build and query: wall time of the phases, counters of the kernels, bytes sent to the workers and memory.
+
+The kernels count with count(name) into the counter of the task running on their thread, if any: a task opens one
+with counting() and returns it with its result, so the counts reach the driver on every backend.
+"""
+import collections
+import contextlib
+import os
+import pickle
+import sys
+import threading
+import time
+
+DIST = 'dist_calls'  # distances computed
+DIST_DERIVED = 'dist_derived'  # distances derived from the distance between longer subsequences, not computed
+LB_PRUNED = 'lb_pruned'  # subsequences or representatives left out by a lower bound before their distance
+# the same by bound: lb_kim, lb_keogh with the envelope around the query, lb_keogh with the envelope around the other
+LB_KIM_PRUNED = 'lb_kim_pruned'
+LB_KEOGH_PRUNED = 'lb_keogh_pruned'
+LB_KEOGH_REV_PRUNED = 'lb_keogh_rev_pruned'
+
+_local = threading.local()
+
+
+def count(name: str, n: int = 1):
+    counter = getattr(_local, 'counter', None)
+    if counter is not None:
+        counter[name] += n
+
+
+@contextlib.contextmanager
+def counting():
+    """
+    count the calls to count made on this thread in a new Counter, nested counting add up to the enclosing one
+    """
+    enclosing = getattr(_local, 'counter', None)
+    _local.counter = collections.Counter()
+    try:
+        yield _local.counter
+    finally:
+        if enclosing is not None:
+            enclosing.update(_local.counter)
+        _local.counter = enclosing
+
+
+def counted(func, *args, **kwargs):
+    """
+    :return: (func(*args, **kwargs), dict of the counts made by func)
+    """
+    with counting() as counter:
+        rtn = func(*args, **kwargs)
+    return rtn, dict(counter)
+
+
+def add_counts(metrics: dict, counts: dict):
+    if metrics is None or not counts:
+        return
+    counters = metrics.setdefault('counters', dict())
+    for name, n in counts.items():
+        counters[name] = counters.get(name, 0) + n
+
+
+@contextlib.contextmanager
+def timed(metrics: dict, phase: str):
+    """
+    add the wall time of the block to metrics['phases'][phase], in seconds. Does nothing if metrics is None
+    """
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            phases = metrics.setdefault('phases', dict())
+            phases[phase] = phases.get(phase, 0.) + time.perf_counter() - t
+
+
+def add_bytes(metrics: dict, n: int):
+    if metrics is not None:
+        metrics['bytes_shipped'] = metrics.get('bytes_shipped', 0) + n
+
+
+def shipped_size(metrics: dict, name: str, obj) -> int:
+    """
+    :return: pickled_size of obj, sent along with every task of a build as the data, measured once per build and kept
+    in metrics['object_bytes'][name]
+    """
+    sizes = metrics.setdefault('object_bytes', dict())
+    if name not in sizes:
+        sizes[name] = pickled_size(obj)
+    return sizes[name]
+
+
+def pickled_size(obj) -> int:
+    """
+    :return: the number of bytes obj takes once pickled, as it is sent to a worker process
+    """
+    return len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def peak_rss(pid: int = None):
+    """
+    :return: the peak resident set size of the process in bytes since it started, None if it cannot be read
+    """
+    try:
+        with open('/proc/%d/status' % (os.getpid() if pid is None else pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return _max_rss(who='self') if pid is None else None
+
+
+def children_peak_rss(pids=()):
+    """
+    :param pids: the child processes alive
+    :return: the largest peak resident set size of the child processes, alive or terminated, in bytes
+    """
+    return max([_max_rss(who='children') or 0] + [rss for rss in map(peak_rss, pids) if rss is not None])
+
+
+def _max_rss(who: str):
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024  # in bytes on macOS and in kilobytes elsewhere
+
+
+def length_counts(cluster_meta_dict: dict) -> dict:
+    """
+    :return: seq_len -> {'subsequences': number of subsequences, 'clusters': number of clusters}
+    """
+    return dict((seq_len, {'subsequences': sum(reprs.values()), 'clusters': len(reprs)})
+                for seq_len, reprs in cluster_meta_dict.items())
+
+
+def format_report(metrics: dict) -> str:
+    """
+    :return: the phases, counters and memory of metrics as a few lines of text
+    """
+    lines = ['%-16s %.3fs' % (phase, t) for phase, t in metrics.get('phases', dict()).items()]
+    lines += ['%-16s %d' % (name, n) for name, n in metrics.get('counters', dict()).items()]
+    if 'bytes_shipped' in metrics:
+        lines.append('%-16s %.1f MB' % ('bytes_shipped', metrics['bytes_shipped'] / 2 ** 20))
+    for name, rss in metrics.get('peak_rss', dict()).items():
+        if rss is not None:
+            lines.append('%-16s %.1f MB' % ('peak_rss ' + name, rss / 2 ** 20))
+    return '\n'.join(lines)
@@ -1,10 +1,27 @@
 import math
 import multiprocessing
+import multiprocessing.pool
 
-from brainex.op.cluster_op import _build_clusters, _cluster_to_meta, _cluster_reduce_func, _build_clusters_dynamic
-from brainex.op.query_op import _get_dist_sequence, _query_partition
-from brainex.utils.utils import flatten
-from brainex.utils.process_utils import _grouper, _group_time_series, reduce_by_key, get_second
+from brainex.op.cluster_op import _build_clusters, _cluster_to_meta, _cluster_reduce_func, _build_clusters_dynamic, \
+    _cluster_levels, _build_repr_trees
+from brainex.op.discord_op import _discords_of_length, _merge_discords
+from brainex.op.join_op import _join_length
+from brainex.op.matrix_profile_op import _mp_series_top_k, _merge_top_k
+from brainex.op.query_op import _get_dist_sequence, _query_partition, _range_query_partition, \
+    _query_bf_partition, _query_partition_batch, _query_bf_partition_batch
+from brainex.utils.utils import flatten, _partition_length_directory
+from brainex.utils.metrics_utils import timed, counted, add_counts, add_bytes, pickled_size, shipped_size
+from brainex.utils.memory_utils import pickled_subsequence_bytes
+from brainex.utils.process_utils import _grouper, reduce_by_key, get_second, \
+    length_range_partition, dss_plan, dss_planned
+
+
+def _chunksize(p: multiprocessing.pool, num_tasks):
+    """
+    the default chunksize of the pool, computed from its configured number of workers: the pool itself divides by the
+    number of live workers, that can be momentarily zero while it replaces them (maxtasksperchild=1)
+    """
+    return max(1, math.ceil(num_tasks / (p._processes * 4)))
 
 
 def _partitioner(data, slice_num):
@@ -12,22 +29,31 @@ def _partitioner(data, slice_num):
     return _grouper(_slice_size, data)
 
 
-def __partition_and_group(data, slice_num, start, end, p: multiprocessing.pool, shuffle=True):
-    data_partition = _partitioner(data, p._processes)
-    group_arg_partition = [(x, start, end) for x in data_partition]
-
-    # Linear partitioning for debugging
-    # group_partition = []
-    # for arg in group_arg_partition:
-    #     group_partition.append(_group_time_series(*arg))
-
-    group_partition = p.starmap(_group_time_series, group_arg_partition)
-    return group_partition
+def __dss_group(data, start, end, p: multiprocessing.pool, metrics: dict = None, length_step=1):
+    """
+    group the subsequences of data on the workers with a load-balanced slicing, see
+    brainex.utils.process_utils.dss_plan
+    """
+    group_arg_partition = [(x, data, start, end, length_step)
+                           for x in dss_plan(data, start, end, p._processes, length_step=length_step)]
+    if metrics is not None and not isinstance(p, multiprocessing.pool.ThreadPool):
+        add_bytes(metrics, sum(pickled_size(x[0]) for x in group_arg_partition) +
+                  len(group_arg_partition) * shipped_size(metrics, 'data', data))
+    return p.starmap(dss_planned, group_arg_partition, chunksize=1)
 
 
-def _cluster_multi_process(p: multiprocessing.pool, data_normalized, start, end, st, dist_func, pnorm, verbose, _use_dynamic):
+def _cluster_multi_process(p: multiprocessing.pool, data_normalized, start, end, st, dist_func, pnorm, verbose, _use_dynamic,
+                           window_stats=None, metrics: dict = None, length_step=1, keep_subsequences=True):
+    """
+    :param metrics: dict the phases, the counts and the bytes sent to the workers are added to, see
+    brainex.utils.metrics_utils
+    :param length_step: only every length_step-th length from start is clustered
+    :param keep_subsequences: whether to give the flat list of subsequences, None otherwise, see
+    _subsequences_of_clusters
+    """
     # if len(data_normalized) < p._processe:  # group the time series first if # time series < # worker
-    group_partition = __partition_and_group(data_normalized, p._processes, start, end, p)
+    with timed(metrics, 'grouping'):
+        group_partition = __dss_group(data_normalized, start, end, p, metrics, length_step)
     cluster_arg_partition = [(x, st, dist_func, data_normalized, verbose) for x in group_partition]
     """
     # cluster_arg_partition = [x + (pnorm,) for x in cluster_arg_partition]
@@ -38,41 +64,171 @@ def _cluster_multi_process(p: multiprocessing.pool, data_normalized, start, end,
 
     """
     if _use_dynamic:
-        cluster_arg_partition = [x + (pnorm,) for x in cluster_arg_partition]
-
-        cluster_partition = []
-        for arg in cluster_arg_partition:
-            cluster_partition.append(_build_clusters_dynamic(*arg))
-
-        cluster_partition = p.starmap(_build_clusters_dynamic, cluster_arg_partition)
+        build_func, cluster_arg_partition = _build_clusters_dynamic, [x + (pnorm,) for x in cluster_arg_partition]
     else:
         # cluster_partition = []
         # for arg in cluster_arg_partition:
         #     cluster_partition.append(_build_clusters(*arg))
-        cluster_partition = p.starmap(_build_clusters, cluster_arg_partition)
-    cluster_meta_dict = _cluster_to_meta_mp(cluster_partition, p)
+        build_func, cluster_arg_partition = _build_clusters, [x + (window_stats,) for x in cluster_arg_partition]
+    _add_bytes_shipped(metrics, p, group_partition, _group_bytes, data_normalized, window_stats)
+    with timed(metrics, 'clustering'):
+        counted_partition = p.starmap(counted, [(build_func,) + x for x in cluster_arg_partition], chunksize=1)
+    cluster_partition = [x for x, _ in counted_partition]
+    for _, counts in counted_partition:
+        add_counts(metrics, counts)
+    with timed(metrics, 'meta_reduction'):
+        cluster_meta_dict = _cluster_to_meta_mp(cluster_partition, p)
 
-    subsequences = flatten(p.map(get_second, flatten(group_partition)))
+    if not keep_subsequences:
+        return None, cluster_partition, cluster_meta_dict
+    with timed(metrics, 'grouping'):
+        groups = flatten(group_partition)
+        subsequences = flatten(p.map(get_second, groups, chunksize=_chunksize(p, len(groups))))
     return subsequences, cluster_partition, cluster_meta_dict
 
 
+def _cluster_levels_mp(p: multiprocessing.pool, cluster_partition: list, st_levels: list, dist_func, data_normalized,
+                       pnorm, window_stats=None, metrics: dict = None, repr_fanout: int = None):
+    """
+    the levels of a multi-threshold build, one task per partition, see brainex.op.cluster_op._cluster_levels
+    :return: the partitions of (length, similarity threshold -> cluster), in the order of cluster_partition
+    """
+    level_args = [(c, st_levels, dist_func, data_normalized, pnorm, window_stats, repr_fanout)
+                  for c in cluster_partition]
+    return _map_partitions_counted(p, _cluster_levels, level_args, data_normalized, window_stats, metrics)
+
+
+def _repr_trees_mp(p: multiprocessing.pool, cluster_partition: list, st: float, repr_fanout: int, dist_func,
+                   data_normalized, window_stats=None, metrics: dict = None):
+    """
+    the trees of the representatives, one task per partition, see brainex.op.cluster_op._build_repr_trees
+    :return: the partitions of (length, TreeCluster), in the order of cluster_partition
+    """
+    tree_args = [(c, st, repr_fanout, dist_func, data_normalized, window_stats) for c in cluster_partition]
+    return _map_partitions_counted(p, _build_repr_trees, tree_args, data_normalized, window_stats, metrics)
+
+
+def _map_partitions_counted(p: multiprocessing.pool, func, partition_args: list, data_normalized, window_stats,
+                            metrics: dict = None):
+    """
+    func on the arguments of every partition, the first being the clusters of the partition, with its counts and the
+    bytes sent to the workers added to metrics
+    """
+    _add_bytes_shipped(metrics, p, [x[0] for x in partition_args], _cluster_bytes, data_normalized, window_stats)
+    counted_partition = p.starmap(counted, [(func,) + x for x in partition_args], chunksize=1)
+    for _, counts in counted_partition:
+        add_counts(metrics, counts)
+    return [x for x, _ in counted_partition]
+
+
+def _add_bytes_shipped(metrics: dict, p: multiprocessing.pool, partitions: list, partition_bytes, data_normalized,
+                       window_stats):
+    """
+    add to metrics the bytes sent to the worker processes by one task per partition: the partition, estimated by
+    partition_bytes from its number of subsequences rather than pickled, and the data sent along with every task
+    """
+    if metrics is None or isinstance(p, multiprocessing.pool.ThreadPool):
+        return
+    add_bytes(metrics, sum(partition_bytes(x) for x in partitions) + len(partitions) * (
+            shipped_size(metrics, 'data', data_normalized) + shipped_size(metrics, 'window_stats', window_stats)))
+
+
+def _group_bytes(groups: list) -> int:
+    return pickled_subsequence_bytes()[1] * sum(len(seqs) for _, seqs in groups)
+
+
+def _cluster_bytes(clusters: list) -> int:
+    return pickled_subsequence_bytes()[0] * sum(len(members) for _, c in clusters for members in c.values())
+
+
+def _subsequences_of_clusters(cluster_partition: list):
+    """
+    :return: the flat list of subsequences, as the members of the clusters
+    """
+    return [seq for _, clusters in flatten(cluster_partition) for members in clusters.values() for _, seq in members]
+
+
 def _cluster_to_meta_mp(cluster_partition: list, p: multiprocessing.pool):
     clusters = flatten(cluster_partition)
-    temp = p.map(_cluster_to_meta, clusters)
+    temp = p.map(_cluster_to_meta, clusters, chunksize=_chunksize(p, len(clusters)))
     return dict(reduce_by_key(_cluster_reduce_func, temp))
 
 
-def _query_bf_mp(query, p: multiprocessing.pool, subsequences: list, dt_index, paa, data_list):
+def _partition_by_length_mp(cluster_partition: list, bounds: list):
+    """
+    regroup the clusters so that every partition holds one range of lengths, see
+    brainex.utils.process_utils.length_range_bounds
+    """
+    rtn = [[] for _ in range(len(bounds) + 1)]
+    for x in flatten(cluster_partition):
+        rtn[length_range_partition(x[0], bounds)].append(x)
+    return rtn
+
+
+def _partition_length_directory_mp(cluster_partition: list):
+    return dict([(i, _partition_length_directory(c)) for i, c in enumerate(cluster_partition)])
+
+
+def _matrix_profile_top_k_mp(p: multiprocessing.pool, data_normalized, lengths, k, overlap, exclusion, discord):
+    """
+    matrix profile motif/discord search, one task per time series
+    """
+    ts_partition = _partitioner(list(range(len(data_normalized))), p._processes)
+    mp_arg = [(x, data_normalized, lengths, k, overlap, exclusion, discord) for x in ts_partition]
+    return _merge_top_k(p.starmap(_mp_series_top_k, mp_arg, chunksize=1), k, discord)
+
+
+def _discords_mp(p: multiprocessing.pool, clusters, start, end, k, overlap, data_normalized, pnorm, window_stats=None):
+    """
+    cluster based discord search, one task per length of interest
+    """
+    clusters_of_loi = [x for x in flatten(clusters) if start <= x[0] <= end]
+    mp_arg = [(seq_len, cluster, k, overlap, data_normalized, pnorm, window_stats) for seq_len, cluster in
+              reduce_by_key(_cluster_reduce_func, clusters_of_loi)]
+    return _merge_discords(p.starmap(_discords_of_length, mp_arg, chunksize=1), k, overlap)
+
+
+def _join_mp(p: multiprocessing.pool, clusters_a, clusters_b, start, end, eps, data_a, data_b, pnorm, scale_b,
+             window_stats_a=None, window_stats_b=None, self_join=False):
+    """
+    similarity join of two cluster partitions, one task per length of interest present on both sides
+    """
+    len_dict_a = dict(reduce_by_key(_cluster_reduce_func, [x for x in flatten(clusters_a) if start <= x[0] <= end]))
+    len_dict_b = dict(reduce_by_key(_cluster_reduce_func, [x for x in flatten(clusters_b) if start <= x[0] <= end]))
+    mp_arg = [(seq_len, cluster_a, len_dict_b[seq_len], eps, data_a, data_b, pnorm, scale_b, window_stats_a,
+               window_stats_b, self_join) for seq_len, cluster_a in len_dict_a.items() if seq_len in len_dict_b]
+    return flatten(p.starmap(_join_length, mp_arg, chunksize=1))
+
+
+def _query_bf_mp(query, p: multiprocessing.pool, subsequences: list, dt_index, paa, data_list, window_stats=None):
     if paa:
         raise Exception('multiprocess_utils: PAA algorithm is not currently supported for Pyhton native multiprocessing'
                         ', please use the Spark implementation')
-    dist_subsequences_arg = [(query, x, dt_index, paa, data_list) for x in subsequences]
-    dist_subsequences = p.starmap(_get_dist_sequence, dist_subsequences_arg)
+    dist_subsequences_arg = [(query, x, dt_index, data_list, window_stats) for x in subsequences]
+    dist_subsequences = p.starmap(_get_dist_sequence, dist_subsequences_arg,
+                                  chunksize=_chunksize(p, len(dist_subsequences_arg)))
     return dist_subsequences
 
 
-def _query_mp(p: multiprocessing.pool, clusters, **kwargs):
-    query_arg_partition = [[x] + list(kwargs.values()) for x in clusters]
+def _query_partition_indexed(args):
+    return [(args[0],) + x for x in _query_partition(args[1], **args[2])]
+
+
+def _query_mp(p: multiprocessing.pool, clusters, cursors, deadline=None, stream=False, plans=None, partitions=None,
+              **kwargs):
+    """
+    :param cursors: partition index -> cursor returned by the previous round, or None
+    :param deadline: see brainex.op.query_op._query_partition
+    :param plans: partition index -> plan of the partition, see brainex.op.query_op._query_partition
+    :param partitions: indices of the partitions to search, all of them if None
+    :param stream: whether to give the partitions as soon as they are searched, in no particular order
+    :return: iterable of (partition index, matches, cursor)
+    """
+    cursors = dict() if cursors is None else cursors
+    plans = dict() if plans is None else plans
+    partitions = range(len(clusters)) if partitions is None else partitions
+    query_arg_partition = [(i, clusters[i], dict(kwargs, cursor=cursors.get(i), deadline=deadline, plan=plans.get(i)))
+                           for i in partitions]
 
     # Linear query for debug purposes
     # candidates = []
@@ -80,7 +236,64 @@ def _query_mp(p: multiprocessing.pool, clusters, **kwargs):
     #     rtn = _query_partition(*qp)
     #     candidates.append(rtn)
 
-    candidates = flatten(p.starmap(_query_partition, query_arg_partition))
-    return candidates
+    # an explicit chunksize, the default one divides by the number of workers that can be momentarily zero while the
+    # pool replaces them (maxtasksperchild=1)
+    if stream:
+        return (x for rtn in p.imap_unordered(_query_partition_indexed, query_arg_partition, chunksize=1) for x in rtn)
+    return flatten(p.map(_query_partition_indexed, query_arg_partition, chunksize=1))
+
+
+def _query_partition_batch_indexed(args):
+    return [(args[0],) + x for x in _query_partition_batch(*args[1:])]
+
+
+def _query_batch_mp(p: multiprocessing.pool, clusters, batches: dict):
+    """
+    :param batches: partition index -> batch of the partition, see brainex.op.query_op._query_partition_batch
+    :return: list of (partition index, query index, matches, cursor)
+    """
+    query_arg_partition = [(i, clusters[i], batch) for i, batch in batches.items()]
+    return flatten(p.map(_query_partition_batch_indexed, query_arg_partition, chunksize=1))
+
+
+def _query_bf_batch_task(args):
+    return _query_bf_partition_batch(*args)
+
+
+def _query_bf_batch_mp(queries: list, p: multiprocessing.pool, subsequences: list, dt_index, data_list, k,
+                       window_stats=None):
+    """
+    :return: list of (query index, k best matches of a slice of the subsequences)
+    """
+    bf_args = [(queries, x, dt_index, data_list, k, window_stats) for x in _partitioner(subsequences, p._processes)]
+    return flatten(p.map(_query_bf_batch_task, bf_args, chunksize=1))
+
+
+def _query_bf_partition_task(args):
+    return _query_bf_partition(*args)
+
+
+def _query_bf_budget_mp(query, p: multiprocessing.pool, subsequences: list, dt_index, data_list, k, window_stats=None,
+                        deadline=None):
+    """
+    brute force query that gives the k best matches of every slice of subsequences as soon as the slice is searched
+    :return: generator of (k best matches of the slice, whether the slice was searched completely)
+    """
+    slices = _partitioner(subsequences, p._processes * 4)
+    bf_args = [(query, x, dt_index, data_list, k, window_stats, deadline) for x in slices]
+    return (x for rtn in p.imap_unordered(_query_bf_partition_task, bf_args, chunksize=1) for x in rtn)
+
+
+def _range_query_task(args):
+    return list(_range_query_partition(*args))
+
+
+def _range_query_mp(p: multiprocessing.pool, clusters, **kwargs):
+    """
+    generator of the range query results, the matches of a partition are given as soon as the partition is searched
+    """
+    query_arg_partition = [[x] + list(kwargs.values()) for x in clusters]
+    for matches in p.imap_unordered(_range_query_task, query_arg_partition, chunksize=1):
+        yield from matches
 
 # def _build_paa(p: multiprocessing.pool):
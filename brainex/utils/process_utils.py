@@ -1,3 +1,5 @@
+import bisect
+import heapq
 from operator import itemgetter
 
 import numpy as np
@@ -7,43 +9,71 @@ from brainex.classes.Sequence import Sequence
 from brainex.utils.utils import flatten
 
 
-def dss_multiple(begin_index_iter, ts_list, start, end, parallelism):
-    begin_index_iter = list(begin_index_iter)
-    merged_g = []
-    for ts_index, ts in enumerate(ts_list):
-        g = dss((begin_index_iter[0] + ts_index) % parallelism, ts, start, end, parallelism)
-        merged_g.append(g)
-
-    merged_g = merge_dicts(merged_g, merge_func=lambda x, y: x + y)
-    return list(merged_g.items())
+def _dss_start_cost(ts_len, ts_index, start, end, length_step=1):
+    """
+    :return: the cost of the subsequences starting at ts_index, their number times their length
+    """
+    max_len = min(end, ts_len - ts_index)
+    if max_len < start:
+        return 0
+    num_lens = (max_len - start) // length_step + 1
+    return (2 * start + (num_lens - 1) * length_step) * num_lens / 2
 
 
-def dss(begin_index, time_series, start, end, parallelism):
+def dss_plan(ts_list, start, end, parallelism, chunks_per_worker=8, length_step=1):
     """
-    used when a single time series is given
-    :param parallelism:
-    :param begin_index:
-    :param time_series:
-    :param start:
-    :param end:
+    load-balanced plan of Distributed Subsequence Slicing. The start indices of every time series are cut into
+    contiguous ranges costing about the same, the cost of a start index being the number of subsequences starting
+    there times their length, which decreases with the index. The ranges are then bin-packed on the workers by
+    decreasing cost, each going to the least loaded worker (longest processing time first).
+    :param ts_list: list of (id, data)
+    :param chunks_per_worker: number of ranges per worker the time series are cut into, the more ranges, the better
+    the balance
+    :param length_step: only every length_step-th length from start is grouped
+    :return: list of parallelism lists of (time series index, first start, last start + 1), see dss_planned
     """
+    costs = [[_dss_start_cost(len(ts[1]), i, start, end, length_step) for i in range(len(ts[1]))] for ts in ts_list]
+    chunk_cost = max(sum(sum(c) for c in costs) / (parallelism * chunks_per_worker), 1)
+
+    chunks = []  # (cost, time series index, first start, last start + 1)
+    for ts_index, ts_costs in enumerate(costs):
+        num_starts = len([c for c in ts_costs if c > 0])  # the last starts are too close to the end for any length
+        first, acc = 0, 0
+        for i in range(num_starts):
+            acc += ts_costs[i]
+            if acc >= chunk_cost:
+                chunks.append((acc, ts_index, first, i + 1))
+                first, acc = i + 1, 0
+        if acc > 0:
+            chunks.append((acc, ts_index, first, num_starts))
+    chunks.sort(key=lambda x: -x[0])
+
+    loads = [(0, w) for w in range(parallelism)]  # heap of (load, worker)
+    rtn = [[] for _ in range(parallelism)]
+    for cost, ts_index, first, last in chunks:
+        load, w = heapq.heappop(loads)
+        rtn[w].append((ts_index, first, last))
+        heapq.heappush(loads, (load + cost, w))
+    return rtn
 
-    ts_id = time_series[0]
-    ts_data = time_series[1]
 
+def dss_planned(tasks, ts_list, start, end, length_step=1):
+    """
+    group the subsequences of the start ranges given to one worker by dss_plan
+    :param tasks: iterable of (time series index, first start, last start + 1)
+    :param length_step: only every length_step-th length from start is grouped
+    :return: a list of (length, subsequences of that length)
+    """
     rtn = dict()
-
-    for ts_index in range(begin_index, len(ts_data), parallelism):  # step by distribution
-        max_len = min(end, len(ts_data) - ts_index)
-        for length in range(start - 1, min(end, len(ts_data) - ts_index)):  # get appropriate
-            seq_len = length + 1
-            if seq_len not in rtn.keys():
-                rtn[seq_len] = []
-            rtn[seq_len].append(Sequence(start=ts_index, end=ts_index + length, seq_id=ts_id))
-    return rtn
+    for ts_index, first, last in tasks:
+        ts_id, ts_data = ts_list[ts_index]
+        for ts_start in range(first, last):
+            for seq_len in range(start, min(end, len(ts_data) - ts_start) + 1, length_step):
+                rtn.setdefault(seq_len, []).append(Sequence(start=ts_start, end=ts_start + seq_len - 1, seq_id=ts_id))
+    return list(rtn.items())
 
 
-def _group_time_series(time_series, start, end):
+def _group_time_series(time_series, start, end, length_step=1):
     """
     This function groups the raw time series data_original into sub sequences of all possible length within the given grouping
     range
@@ -51,6 +81,7 @@ def _group_time_series(time_series, start, end):
     :param time_series: set of raw time series sequences
     :param start: starting index for grouping range
     :param end: end index for grouping range
+    :param length_step: only every length_step-th length from start is grouped
 
     :return: a list of lists containing groups of subsequences of different length indexed by the group length
     """
@@ -66,7 +97,7 @@ def _group_time_series(time_series, start, end):
         ts_id = ts[0]
         ts_data = ts[1]
         # we take min because min can be math.inf
-        for i in range(start - 1, min(end, len(ts_data))):
+        for i in range(start - 1, min(end, len(ts_data)), length_step):
             target_length = i + 1
             if target_length not in rtn.keys():
                 rtn[target_length] = []
@@ -106,6 +137,30 @@ def _slice_time_series(time_series, start, end):
     return rtn
 
 
+def length_range_bounds(length_counts: dict, num_partitions: int) -> list:
+    """
+    cut the lengths into num_partitions contiguous ranges holding about the same number of subsequences
+    :param length_counts: seq_len -> number of subsequences of that length
+    :return: sorted list of the first length of every range but the first one, see length_range_partition
+    """
+    lengths = sorted(length_counts.keys())
+    total = sum(length_counts.values())
+    bounds = []
+    acc = 0
+    for seq_len in lengths:
+        if acc >= total * (len(bounds) + 1) / num_partitions and len(bounds) < num_partitions - 1:
+            bounds.append(seq_len)
+        acc += length_counts[seq_len]
+    return bounds
+
+
+def length_range_partition(seq_len: int, bounds: list) -> int:
+    """
+    :return: the index of the length range of seq_len given the bounds from length_range_bounds
+    """
+    return bisect.bisect_right(bounds, seq_len)
+
+
 def _grouper(n, iterable):
     return [iterable[x:x + n] for x in range(0, len(iterable), n)]
 
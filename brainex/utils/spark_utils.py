@@ -1,13 +1,20 @@
-from pyspark import SparkContext, SparkConf
+from pyspark import SparkContext, SparkConf, StorageLevel
+from pyspark.accumulators import AccumulatorParam
 from pyspark.rdd import PipelinedRDD
 from tslearn.piecewise import PiecewiseAggregateApproximation
 
-from brainex.op.query_op import _get_dist_sequence, _get_dist_array, _get_dist_sequence_piecewise
-from brainex.op.cluster_op import _build_clusters, _cluster_to_meta, _cluster_reduce_func, _build_clusters_dynamic
+from brainex.op.query_op import _get_dist_sequence, _get_dist_array, _get_dist_sequence_piecewise, \
+    _query_bf_partition, _query_partition_batch, _query_bf_partition_batch
+from brainex.op.discord_op import _discords_of_length, _merge_discords
+from brainex.op.join_op import _join_length
+from brainex.op.matrix_profile_op import _mp_series_top_k, _merge_top_k
+from brainex.op.cluster_op import _build_clusters, _cluster_to_meta, _cluster_reduce_func, _build_clusters_dynamic, \
+    _cluster_levels, _build_repr_trees
 from brainex.misc import pr_red
-from brainex.utils.process_utils import _group_time_series, dss, dss_multiple
+from brainex.utils.metrics_utils import timed, counted, add_counts, add_bytes, shipped_size
+from brainex.utils.process_utils import _group_time_series, dss_plan, dss_planned, length_range_partition
 from brainex.utils.ts_utils import paa_compress, sax_compress
-from brainex.utils.utils import flatten
+from brainex.utils.utils import flatten, _partition_length_directory
 
 
 def _create_sc(num_cores: int, driver_mem: int, max_result_mem: int):
@@ -26,26 +33,50 @@ def _pr_spark_conf(sc: SparkContext):
     pr_red('Maximum Result Size: ' + sc.getConf().get("spark.driver.maxResultSize"))
 
 
+class _CountsParam(AccumulatorParam):
+    """
+    accumulator of the counts of brainex.utils.metrics_utils, as a dict of name -> count
+    """
+
+    def zero(self, value):
+        return dict()
+
+    def addInPlace(self, value1, value2):
+        for name, n in value2.items():
+            value1[name] = value1.get(name, 0) + n
+        return value1
+
+
+def _counted_partition(func, counts_acc, *args, **kwargs):
+    rtn, counts = counted(lambda: list(func(*args, **kwargs)))
+    counts_acc.add(counts)
+    return rtn
+
+
 def _cluster_with_spark(sc: SparkContext, data_normalized, data_normalized_bc,
-                        start, end, st, dist_func, pnorm, verbose, group_only, use_dss, _use_dynamic):
+                        start, end, st, dist_func, pnorm, verbose, group_only, use_dss, _use_dynamic,
+                        window_stats=None, metrics: dict = None, length_step=1, spill=False):
+    """
+    :param metrics: dict the phases, the counts and the bytes sent to the workers are added to, see
+    brainex.utils.metrics_utils. Spark evaluates lazily, the groups are then counted at the end of the grouping phase
+    :param length_step: only every length_step-th length from start is clustered
+    :param spill: whether the subsequences are kept on disk and the clusters spill to disk when they do not fit in
+    memory, instead of being cached in memory
+    """
+    level = StorageLevel.MEMORY_AND_DISK if spill else StorageLevel.MEMORY_ONLY
     # validate and save the loi to gxdb class fields
     parallelism = sc.defaultParallelism
     # if False:
 
     if use_dss:
         print('_cluster_with_spark: Using Generalized DSS')
-        input = [i for i in range(parallelism)]  # creates parallelized slicing indices
+        # the start ranges of every partition
+        input = dss_plan(data_normalized, start, end, parallelism, length_step=length_step)
         input_rdd = sc.parallelize(input, numSlices=parallelism)
 
-        # a = []# debug
-        # input_partitions = input_rdd.glom().collect()  # debug
-        # for ip in input_partitions:# debug
-        #     a.append(dss_multiple(ip, data_normalized_bc.value, start, end, parallelism))# debug
-
         group_rdd = input_rdd.mapPartitions(
-            lambda x: dss_multiple(x, data_normalized_bc.value, start, end, parallelism),
-            preservesPartitioning=True).cache()
-        # b = group_rdd.collect()  # debug
+            lambda x: dss_planned(flatten(x), data_normalized_bc.value, start, end, length_step),
+            preservesPartitioning=True).persist(level)
     else:
         # distribute the data_original
         input_rdd = sc.parallelize(data_normalized, numSlices=parallelism)
@@ -53,9 +84,13 @@ def _cluster_with_spark(sc: SparkContext, data_normalized, data_normalized_bc,
         # Grouping the data_original
         # group = _group_time_series(input_rdd.glom().collect()[0], start, end)  # for debug purposes
         group_rdd = input_rdd.mapPartitions(
-            lambda x: _group_time_series(time_series=x, start=start, end=end), preservesPartitioning=True).cache()
+            lambda x: _group_time_series(time_series=x, start=start, end=end, length_step=length_step),
+            preservesPartitioning=True).persist(level)
 
-    subsequence_rdd = group_rdd.flatMap(lambda x: x[1]).cache()
+    subsequence_rdd = group_rdd.flatMap(lambda x: x[1]).persist(StorageLevel.DISK_ONLY if spill else level)
+    if metrics is not None:
+        with timed(metrics, 'grouping'):
+            group_rdd.count()
 
     # group_partition = group_rdd.glom().collect()  # for debug purposes
     # group = group_rdd.collect()  # for debug purposes
@@ -67,35 +102,167 @@ def _cluster_with_spark(sc: SparkContext, data_normalized, data_normalized_bc,
     #                           dist_func=dist_func, verbose=1)  # for debug purposes
     if group_only:
         return subsequence_rdd, None, None
+    counts_acc = sc.accumulator(dict(), _CountsParam())
     if _use_dynamic:
-        cluster_rdd = group_rdd.mapPartitions(lambda x: _build_clusters_dynamic(
-            groups=x, st=st, dist_func=dist_func, data_list=data_normalized, log_level=verbose)).cache()
+        cluster_rdd = group_rdd.mapPartitions(lambda x: _counted_partition(
+            _build_clusters_dynamic, counts_acc, groups=x, st=st, dist_func=dist_func, data_list=data_normalized,
+            log_level=verbose, pnorm=pnorm)).persist(level)
     else:
-        cluster_rdd = group_rdd.mapPartitions(lambda x: _build_clusters(
-            groups=x, st=st, dist_func=dist_func, data_list=data_normalized, log_level=verbose)).cache()
+        cluster_rdd = group_rdd.mapPartitions(lambda x: _counted_partition(
+            _build_clusters, counts_acc, groups=x, st=st, dist_func=dist_func, data_list=data_normalized,
+            log_level=verbose, window_stats=window_stats)).persist(level)
         # cluster_partition = cluster_rdd.glom().collect()  # for debug purposes
-    cluster_rdd.count()
+    with timed(metrics, 'clustering'):
+        cluster_rdd.count()
+    if metrics is not None:
+        add_counts(metrics, counts_acc.value)
+        # the data is broadcast once for the grouping and captured by the clustering closure of every partition
+        add_bytes(metrics, shipped_size(metrics, 'data', data_normalized) * (1 + group_rdd.getNumPartitions()) +
+                  shipped_size(metrics, 'window_stats', window_stats) * group_rdd.getNumPartitions())
 
     # Combining two dictionary using **kwargs concept
-    cluster_meta_dict = _cluster_to_meta_spark(cluster_rdd)
+    with timed(metrics, 'meta_reduction'):
+        cluster_meta_dict = _cluster_to_meta_spark(cluster_rdd)
     return subsequence_rdd, cluster_rdd, cluster_meta_dict
 
 
+def _cluster_levels_spark(sc: SparkContext, cluster_rdd, st_levels: list, dist_func, data_normalized, pnorm,
+                          window_stats=None, metrics: dict = None, repr_fanout: int = None):
+    """
+    the levels of a multi-threshold build, see brainex.op.cluster_op._cluster_levels. The partitions are kept, so a
+    level searched on its own has the partitions of the clusters
+    :return: RDD of (length, similarity threshold -> cluster)
+    """
+    counts_acc = sc.accumulator(dict(), _CountsParam())
+    level_rdd = cluster_rdd.mapPartitions(lambda x: _counted_partition(
+        _cluster_levels, counts_acc, clusters=x, st_levels=st_levels, dist_func=dist_func, data_list=data_normalized,
+        pnorm=pnorm, window_stats=window_stats, repr_fanout=repr_fanout), preservesPartitioning=True).cache()
+    return _materialized(level_rdd, counts_acc, data_normalized, window_stats, metrics)
+
+
+def _repr_trees_spark(sc: SparkContext, cluster_rdd, st: float, repr_fanout: int, dist_func, data_normalized,
+                      window_stats=None, metrics: dict = None):
+    """
+    the trees of the representatives, see brainex.op.cluster_op._build_repr_trees. The partitions are kept
+    :return: RDD of (length, TreeCluster)
+    """
+    counts_acc = sc.accumulator(dict(), _CountsParam())
+    tree_rdd = cluster_rdd.mapPartitions(lambda x: _counted_partition(
+        _build_repr_trees, counts_acc, clusters=x, st=st, repr_fanout=repr_fanout, dist_func=dist_func,
+        data_list=data_normalized, window_stats=window_stats), preservesPartitioning=True).cache()
+    return _materialized(tree_rdd, counts_acc, data_normalized, window_stats, metrics)
+
+
+def _materialized(rdd, counts_acc, data_normalized, window_stats, metrics: dict = None):
+    """
+    compute rdd, a map of the partitions of the clusters capturing the data, and add its counts and the bytes sent to
+    the workers to metrics
+    """
+    rdd.count()
+    if metrics is not None:
+        add_counts(metrics, counts_acc.value)
+        add_bytes(metrics, (shipped_size(metrics, 'data', data_normalized) +
+                            shipped_size(metrics, 'window_stats', window_stats)) * rdd.getNumPartitions())
+    return rdd
+
+
 def _cluster_to_meta_spark(cluster_rdd):
     return dict(cluster_rdd.
                 map(_cluster_to_meta).
                 reduceByKey(_cluster_reduce_func).collect())
 
 
-def _query_bf_spark(query, subsequence_rdd, dt_index, data_list):
+def _partition_by_length_spark(cluster_rdd, bounds: list):
+    """
+    co-locate the clusters so that every partition holds one range of lengths, see
+    brainex.utils.process_utils.length_range_bounds
+    """
+    rtn = cluster_rdd.partitionBy(len(bounds) + 1, partitionFunc=lambda x: length_range_partition(x, bounds)).cache()
+    rtn.count()
+    cluster_rdd.unpersist()
+    return rtn
+
+
+def _partition_length_directory_spark(cluster_rdd):
+    return dict(cluster_rdd.mapPartitionsWithIndex(lambda i, c: [(i, _partition_length_directory(c))]).collect())
+
+
+def _matrix_profile_top_k_spark(sc: SparkContext, data_normalized_bc, lengths, k, overlap, exclusion, discord):
+    """
+    matrix profile motif/discord search, the time series are split across the partitions
+    """
+    num_ts = len(data_normalized_bc.value)
+    input_rdd = sc.parallelize(list(range(num_ts)), numSlices=min(num_ts, sc.defaultParallelism))
+    result_rdd = input_rdd.mapPartitions(
+        lambda x: _mp_series_top_k(x, data_normalized_bc.value, lengths, k, overlap, exclusion, discord))
+    return _merge_top_k(result_rdd.collect(), k, discord)
+
+
+def _discords_spark(cluster_rdd, start, end, k, overlap, data_normalized_bc, pnorm, window_stats_bc=None):
+    """
+    cluster based discord search, the clusters of every length of interest are gathered to one task
+    """
+    result_rdd = cluster_rdd.filter(lambda x: start <= x[0] <= end). \
+        reduceByKey(_cluster_reduce_func). \
+        map(lambda x: _discords_of_length(x[0], x[1], k, overlap, data_normalized_bc.value, pnorm,
+                                          window_stats_bc.value if window_stats_bc else None))
+    return _merge_discords(result_rdd.collect(), k, overlap)
+
+
+def _join_spark(cluster_rdd_a, cluster_rdd_b, start, end, eps, data_a_bc, data_b_bc, pnorm, scale_b,
+                window_stats_a_bc=None, window_stats_b_bc=None, self_join=False):
+    """
+    similarity join of two cluster rdds, the clusters of both sides are joined by length
+    """
+    len_rdd_a = cluster_rdd_a.filter(lambda x: start <= x[0] <= end).reduceByKey(_cluster_reduce_func)
+    len_rdd_b = cluster_rdd_b.filter(lambda x: start <= x[0] <= end).reduceByKey(_cluster_reduce_func)
+    result_rdd = len_rdd_a.join(len_rdd_b).flatMap(
+        lambda x: _join_length(x[0], x[1][0], x[1][1], eps, data_a_bc.value, data_b_bc.value, pnorm, scale_b,
+                               window_stats_a_bc.value if window_stats_a_bc else None,
+                               window_stats_b_bc.value if window_stats_b_bc else None, self_join))
+    return result_rdd.collect()
+
+
+def _query_bf_spark(query, subsequence_rdd, dt_index, data_list, window_stats=None):
     pp_rdd = subsequence_rdd.map(
-        lambda x: _get_dist_sequence(query, x, dt_index=dt_index, data_list=data_list.value))
+        lambda x: _get_dist_sequence(query, x, dt_index=dt_index, data_list=data_list.value,
+                                     window_stats=window_stats.value if window_stats else None))
     candidate_list = pp_rdd.collect()
     # clear data stored in the candidate list
 
     return candidate_list
 
 
+def _query_bf_budget_spark(query, subsequence_rdd, dt_index, data_list, k, window_stats=None, deadline=None,
+                           stream=False):
+    """
+    brute force query that gives the k best matches of every partition
+    :param stream: whether to give the partitions one by one as they are searched
+    :return: iterable of (k best matches of the partition, whether the partition was searched completely)
+    """
+    result_rdd = subsequence_rdd.mapPartitions(
+        lambda x: _query_bf_partition(query, list(x), dt_index, data_list, k, window_stats, deadline))
+    return result_rdd.toLocalIterator(prefetchPartitions=True) if stream else result_rdd.collect()
+
+
+def _query_bf_batch_spark(queries, subsequence_rdd, dt_index, data_list, k, window_stats=None):
+    """
+    :return: list of (query index, k best matches of a partition of the subsequences)
+    """
+    return subsequence_rdd.mapPartitions(
+        lambda x: _query_bf_partition_batch(queries, list(x), dt_index, data_list, k, window_stats)).collect()
+
+
+def _query_batch_spark(sc: SparkContext, cluster_rdd, batches: dict):
+    """
+    :param batches: partition index -> batch of the partition, see brainex.op.query_op._query_partition_batch
+    :return: list of (partition index, query index, matches, cursor)
+    """
+    query_rdd = cluster_rdd.mapPartitionsWithIndex(
+        lambda i, c: [(i,) + x for x in _query_partition_batch(c, batches[i])] if i in batches else [])
+    return sc.runJob(query_rdd, lambda x: x, partitions=list(batches.keys()))
+
+
 def _query_piecewise_spark(query_data, subsequence_rdd: PipelinedRDD, dt_index, data_list, piecewise, n_segment):
     if piecewise == 'paa':
         query_com, fitter = paa_compress(a=query_data, paa_seg=n_segment)
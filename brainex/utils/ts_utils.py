@@ -1,11 +1,11 @@
 import math
 
 import numpy as np
-from tslearn import metrics
-from tslearn.piecewise import PiecewiseAggregateApproximation, SymbolicAggregateApproximation
 
 from brainex.classes.Sequence import Sequence
 
+Z_NORM_EPS = 1e-8  # windows with a smaller standard deviation are treated as flat
+
 
 def lb_keogh_sequence(seq_matching: Sequence, seq_enveloped: Sequence) -> float:
     """
@@ -18,6 +18,8 @@ def lb_keogh_sequence(seq_matching: Sequence, seq_enveloped: Sequence) -> float:
         assert len(seq_matching) == len(seq_enveloped)
     except AssertionError as ae:
         raise Exception('cluster.lb_keogh_sequence: two sequences must be of equal length to calculate lb_keogh')
+    from tslearn import metrics
+
     envelope_down, envelope_up = metrics.lb_envelope(seq_enveloped, radius=1)
     lb_k_sim = metrics.lb_keogh(seq_matching,
                                 envelope_candidate=(envelope_down, envelope_up))
@@ -37,8 +39,31 @@ def lb_kim_sequence(candidate_seq, query_sequence):
     return lb_kim_sim / 2.0  # normalize
 
 
-def paa_compress(a: np.ndarray, paa_seg, paa: PiecewiseAggregateApproximation = None):
+def dist_to_many(x: np.ndarray, mat: np.ndarray, pnorm):
+    """
+    the lock-step distance of brainex.database.genexengine.dt_func_dict between x and every row of mat
+    :param pnorm: 2 for eu, 1 for ma and math.inf for ch
+    """
+    d = np.abs(mat - x)
+    if pnorm == 2:
+        return np.sqrt(np.sum(np.square(d), axis=1) / len(x))
+    elif pnorm == 1:
+        return np.sum(d, axis=1) / len(x)
+    return np.max(d, axis=1)
+
+
+def lb_endpoints_to_many(x: np.ndarray, mat: np.ndarray, pnorm):
+    """
+    lb_kim of dist_to_many: the distance restricted to the first and last point, scaled the same way
+    """
+    return dist_to_many(x[[0, -1]], mat[:, [0, -1]], pnorm) * (math.sqrt(2 / len(x)) if pnorm == 2 else
+                                                               2 / len(x) if pnorm == 1 else 1.)
+
+
+def paa_compress(a: np.ndarray, paa_seg, paa: 'PiecewiseAggregateApproximation' = None):
     if not paa:
+        from tslearn.piecewise import PiecewiseAggregateApproximation
+
         paa = PiecewiseAggregateApproximation(min(len(a), paa_seg))
         compressed = paa.fit_transform(a.reshape(1, -1))
     else:
@@ -53,8 +78,10 @@ def paa_compress(a: np.ndarray, paa_seg, paa: PiecewiseAggregateApproximation =
     # return np.squeeze(compressed)
 
 
-def sax_compress(a: np.ndarray, sax_seg, sax: SymbolicAggregateApproximation = None):
+def sax_compress(a: np.ndarray, sax_seg, sax: 'SymbolicAggregateApproximation' = None):
     if not sax:
+        from tslearn.piecewise import SymbolicAggregateApproximation
+
         sax = SymbolicAggregateApproximation(n_segments=min(len(a), sax_seg), alphabet_size_avg=2 ** sax_seg)
         compressed = sax.fit_transform(np.expand_dims(a, axis=0))
     else:
@@ -63,3 +90,102 @@ def sax_compress(a: np.ndarray, sax_seg, sax: SymbolicAggregateApproximation = N
     # TODO do not squeeze all the dimension if the ts is multi-dimensional
     compressed = np.squeeze(compressed, axis=0)
     return compressed, sax
+
+
+def running_sums(data_list):
+    """
+    prefix sums of every time series and of its squares, so that the mean and standard deviation of any subsequence
+    can be derived in O(1) without touching the data points of the subsequence
+    :param data_list: list of (seq_id, data) pairs, for example GenexEngine.data_normalized
+    :return dict: seq_id -> (cumulative sum, cumulative squared sum), both prefixed with a zero
+    """
+    rtn = dict()
+    for seq_id, data in data_list:
+        data = np.asarray(data, dtype=np.float64)
+        rtn[seq_id] = (np.concatenate(([0.], np.cumsum(data))), np.concatenate(([0.], np.cumsum(np.square(data)))))
+    return rtn
+
+
+def window_mean_std(seq: Sequence, sums):
+    """
+    get the mean and standard deviation of a subsequence from the running sums of its time series
+    :param seq: the subsequence
+    :param sums: running sums as returned by running_sums
+    :return: (mean, standard deviation)
+    """
+    cs, cs2 = sums[seq.seq_id]
+    m = seq.end - seq.start + 1
+    mean = (cs[seq.end + 1] - cs[seq.start]) / m
+    var = (cs2[seq.end + 1] - cs2[seq.start]) / m - mean ** 2
+    return mean, math.sqrt(var) if var > 0. else 0.
+
+
+def sliding_mean_std(a: np.ndarray, m: int):
+    """
+    mean and standard deviation of every window of length m in a, computed from running sums
+    :param a: the time series
+    :param m: window length
+    :return: two arrays of length len(a) - m + 1
+    """
+    a = np.asarray(a, dtype=np.float64)
+    cs = np.concatenate(([0.], np.cumsum(a)))
+    cs2 = np.concatenate(([0.], np.cumsum(np.square(a))))
+    mean = (cs[m:] - cs[:-m]) / m
+    var = (cs2[m:] - cs2[:-m]) / m - np.square(mean)
+    return mean, np.sqrt(np.maximum(var, 0.))
+
+
+def z_normalize_window(a: np.ndarray, mean, std):
+    """
+    z-normalize a window with its precomputed statistics; a flat window is mapped to all zeros
+    """
+    if std < Z_NORM_EPS:
+        return np.zeros(len(a))
+    return (np.asarray(a) - mean) / std
+
+
+def eu_znorm(x: np.ndarray, y: np.ndarray, x_stat, y_stat):
+    """
+    eu_norm between the z-normalized x and y. The normalization is folded into the dot product
+    (||zx - zy||^2 = 2m(1 - corr(x, y))), so neither normalized window is materialized
+    :param x_stat: (mean, std) of x
+    :param y_stat: (mean, std) of y
+    """
+    x_flat, y_flat = x_stat[1] < Z_NORM_EPS, y_stat[1] < Z_NORM_EPS
+    if x_flat or y_flat:  # a flat window is all zeros once normalized, and every other window has a unit norm
+        return 0. if x_flat and y_flat else 1.
+    m = len(x)
+    corr = (np.dot(x, y) - m * x_stat[0] * y_stat[0]) / (m * x_stat[1] * y_stat[1])
+    return math.sqrt(max(2. * (1. - corr), 0.))
+
+
+def ma_znorm(x: np.ndarray, y: np.ndarray, x_stat, y_stat):
+    """
+    ma_norm between the z-normalized x and y
+    """
+    return np.sum(np.abs(_z_diff(x, y, x_stat, y_stat))) / len(x)
+
+
+def ch_znorm(x: np.ndarray, y: np.ndarray, x_stat, y_stat):
+    """
+    ch_norm between the z-normalized x and y
+    """
+    return np.max(np.abs(_z_diff(x, y, x_stat, y_stat)))
+
+
+def _z_diff(x, y, x_stat, y_stat):
+    """
+    zx - zy written as a single affine expression in x and y
+    """
+    x_scale = 1. / x_stat[1] if x_stat[1] >= Z_NORM_EPS else 0.
+    y_scale = 1. / y_stat[1] if y_stat[1] >= Z_NORM_EPS else 0.
+    return np.asarray(x) * x_scale - np.asarray(y) * y_scale + (y_stat[0] * y_scale - x_stat[0] * x_scale)
+
+
+def z_endpoints(a: np.ndarray, stat):
+    """
+    the first and last point of the z-normalized window, enough for lb_kim_sequence
+    """
+    if stat[1] < Z_NORM_EPS:
+        return 0., 0.
+    return (a[0] - stat[0]) / stat[1], (a[-1] - stat[0]) / stat[1]
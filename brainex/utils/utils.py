@@ -1,8 +1,9 @@
 import math
 from logging import warning
 
+import sys
+
 import numpy as np
-from sklearn.preprocessing import MinMaxScaler
 
 from brainex.classes.Sequence import Sequence
 from brainex.misc import prYellow
@@ -31,6 +32,8 @@ def normalize_sequence(seq: Sequence, max, min, z_normalize=True):
 
 
 def scale(ts_df, feature_num):
+    from sklearn.preprocessing import MinMaxScaler
+
     time_series = ts_df.iloc[:, feature_num:].values
     scaler = MinMaxScaler(feature_range=(0, 1))
     num_time_series = len(time_series)
@@ -79,9 +82,66 @@ def get_sequences_represented(reprs, cluster):
     """
 
     :param reprs: list of Sequences that are representatives
-    :param cluster: repr -> list of sequences represented, mapping from representativs to their clusters
+    :param cluster: repr -> list of (distance to repr, sequence represented), mapping from representativs to their
+    clusters
+    """
+    return [s for r in reprs for _, s in cluster[r]] if reprs is not None else list()
+
+
+def length_directory(cluster_meta_dict: dict) -> dict:
+    """
+    :param cluster_meta_dict: seq_len -> representative -> number of represented sequences
+    :return: seq_len -> (number of clusters, number of represented sequences)
+    """
+    return dict([(seq_len, (len(c), sum(c.values()))) for seq_len, c in cluster_meta_dict.items()])
+
+
+def _partition_length_directory(cluster) -> dict:
+    """
+    length_directory of the clusters of one partition
+    :param cluster: iterable of (seq_len, representative -> list of (distance, represented sequence))
+    """
+    rtn = dict()
+    for seq_len, c in cluster:
+        num_clusters, num_members = rtn.get(seq_len, (0, 0))
+        rtn[seq_len] = (num_clusters + len(c), num_members + sum(len(x) for x in c.values()))
+    return rtn
+
+
+def plan_query_lengths(partition_dirs: dict, q_len: int, radius: int, k: int, ke: int, loi=None) -> dict:
+    """
+    plan the lengths every partition searches in the first round of a query. The radius around the query length is
+    widened for all the partitions at once until the candidates they are expected to gather reach ke, a partition
+    gathers at least k candidates from each length it searches (see brainex.op.query_op.expand_rspace) if it has that
+    many. Compared to every partition widening the radius on its own, the partitions that lack the lengths close to
+    the query no longer search the lengths far from it.
+    :param partition_dirs: partition -> _partition_length_directory of the partition
+    :param loi: (start, end) the lengths of interest, or None
+    :return: partition -> {'lens': lengths to search, 'radius': radius to carry on from in the next rounds}
+    """
+    lengths = set(flatten([list(d.keys()) for d in partition_dirs.values()]))
+    if loi:
+        lengths = set([x for x in lengths if loi[0] <= x <= loi[1]])
+    plan = dict([(i, []) for i in partition_dirs.keys()])
+    num_expected = 0
+    while len(lengths) > 0 and num_expected < ke:
+        for target_l in sorted(get_trgt_len_within_r(l_list=lengths, q_len=q_len, radius=radius)):
+            for i, d in partition_dirs.items():
+                if target_l in d:
+                    plan[i].append(target_l)
+                    num_expected += min(d[target_l][1], k)
+            lengths.remove(target_l)
+        radius += 1
+    return dict([(i, {'lens': lens, 'radius': radius}) for i, lens in plan.items()])
+
+
+def unbroadcast(x):
+    """
+    :return: the value of x if it is a Spark broadcast variable, x otherwise. pyspark is not imported to check it, if it
+    is not loaded yet there is no broadcast variable
     """
-    return flatten([cluster[r] for r in reprs]) if reprs is not None else list()
+    broadcast = sys.modules.get('pyspark.broadcast')
+    return x.value if broadcast is not None and isinstance(x, broadcast.Broadcast) else x
 
 
 def flatten(l):
@@ -109,7 +169,40 @@ def _validate_gxdb_build_arguments(args: dict):
     except AssertionError as ae:
         raise Exception('Build check argument failed: build st must be between 0. and 1. and not '
                         'equal to 0. and 1.')
-    print(args)
+    if args.get('normalize') is not None:
+        try:
+            assert args['normalize'] == 'subsequence'
+        except AssertionError:
+            raise Exception('Build check argument failed: normalize must be None or \'subsequence\', given '
+                            + str(args['normalize']))
+        try:
+            assert not args.get('_use_dynamic')
+        except AssertionError:
+            raise Exception('Build check argument failed: _use_dynamic does not support normalize=\'subsequence\', '
+                            'trimming a z-normalized subsequence changes its normalization')
+    try:
+        assert isinstance(args.get('length_step', 1), int) and args.get('length_step', 1) >= 1
+    except AssertionError:
+        raise Exception('Build check argument failed: length_step must be an integer greater than 0, given '
+                        + str(args['length_step']))
+    if args.get('st_levels'):
+        try:
+            assert all(args['st'] < x < 1. for x in args['st_levels'])
+            assert len(set(args['st_levels'])) == len(args['st_levels'])
+        except (AssertionError, TypeError):
+            raise Exception('Build check argument failed: st_levels must be distinct similarity thresholds between the '
+                            'build st and 1., given ' + str(args['st_levels']))
+    if args.get('repr_fanout') is not None:
+        try:
+            assert isinstance(args['repr_fanout'], int) and args['repr_fanout'] >= 1
+        except AssertionError:
+            raise Exception('Build check argument failed: repr_fanout must be an integer greater than 0, given '
+                            + str(args['repr_fanout']))
+    try:
+        assert args.get('over_budget', 'raise') in ('raise', 'adapt')
+    except AssertionError:
+        raise Exception('Build check argument failed: over_budget must be \'raise\' or \'adapt\', given '
+                        + str(args['over_budget']))
 
     return
 
@@ -127,6 +220,16 @@ def _validate_gxe_query_arguments(args: dict):
             assert args['filter_mode'] in filter_modes
         except AssertionError:
             raise Exception('_validate_gxe_query_arguments: must provide a filter mode: "any" or "all"')
+    if args.get('length_policy', 'nearest') != 'nearest':
+        try:
+            assert args['length_policy'] == 'scale'
+        except AssertionError:
+            raise Exception('_validate_gxe_query_arguments: length_policy must be "nearest" or "scale", given '
+                            + str(args['length_policy']))
+        try:
+            assert not args.get('_lb_opt')
+        except AssertionError:
+            raise Exception('_validate_gxe_query_arguments: length_policy="scale" is not supported with _lb_opt')
 
 
 def _df_to_list(df, feature_num):
@@ -5,28 +5,15 @@ from brainex.misc import pr_red, fd_workaround
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
-USE_SPARK = True
-try:
-    print('Checking Spark backend')
-    import pyspark
-    sc = pyspark.SparkContext()
-except:
-    print('Either PySpark or Spark is not correclt installed. Skipping Spark packages.')
-    print('You can still use Spark in Genex if you install Spark later.')
-    USE_SPARK = False
-
+# Spark is an optional backend, it is only imported by the engines created with use_spark=True
 requires = ['Cython',
             'numpy',
             'scipy',
             'pandas',
+            'scikit-learn',
             'tslearn',
-            'pyspark',
-            ] if USE_SPARK else ['Cython',
-                                 'numpy',
-                                 'scipy',
-                                 'pandas',
-                                 'tslearn',
-                                 ]
+            ]
+extras = {'spark': ['pyspark']}
 
 setuptools.setup(
     name="brainex",  # Replace with your own username
@@ -44,6 +31,7 @@ setuptools.setup(
     ],
     python_requires='>=3.6',
     packages=setuptools.find_packages(),
-    install_requires=requires)
+    install_requires=requires,
+    extras_require=extras)
 
 fd_workaround()
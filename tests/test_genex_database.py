@@ -3,6 +3,7 @@ import os
 import pandas as pd
 import sys
 import random
+import numpy as np
 import pytest as pt
 from brainex.database import genexengine as gxdb
 from brainex.utils import gxe_utils as gutils
@@ -122,6 +123,29 @@ class TestGenex_database:
             os.removedirs(empty_dir_path)
         assert 'no such database' in str(ve.value)
 
+    def test_from_db_format(self):
+        import json
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        path = '../experiments/unittest/format_db'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=8)
+        test_db.build(st=0.1, loi=(20, 21))
+        test_db.save(path)
+        test_db.stop()
+        test_db = gutils.from_db(path, num_worker=self.num_cores)
+        assert test_db.build_conf['cluster_format'] == gxdb.CLUSTER_FORMAT
+        test_db.stop()
+
+        # saved before the members of the clusters had their distance
+        with open(os.path.join(path, 'build_conf.json')) as f:
+            build_conf = json.load(f)
+        del build_conf['cluster_format']
+        with open(os.path.join(path, 'build_conf.json'), 'w') as f:
+            json.dump(build_conf, f)
+        with pt.raises(Exception) as e:
+            gutils.from_db(path, num_worker=self.num_cores)
+        assert 'Rebuild' in str(e.value)
+
     def test_build(self):
         # Test case for the functionality of build method
         # After grouping
@@ -212,6 +236,415 @@ class TestGenex_database:
             gq_rlt = test_db.query(query_seq, best_k, overlap=2)
         assert 'overlap must be between 0. and 1. ' in str(e.value)
 
+    def test_build_subsequence_normalize(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=15)
+        with pt.raises(Exception) as e:
+            test_db.build(st=0.1, loi=(20, 24), normalize='series')
+        assert 'normalize must be None or' in str(e.value)
+
+        test_db.build(st=0.1, loi=(20, 24), normalize='subsequence')
+        query_seq = test_db.get_random_seq_of_len(sequence_len=22, seed=1)
+        gq_rlt = test_db.query(query_seq, best_k=3)
+        bf_rlt = test_db.query_brute_force(query_seq, best_k=3)
+        assert len(gq_rlt) == 3
+        assert gq_rlt[0][1] == query_seq  # the query matches itself once both are z-normalized
+        assert bf_rlt[0][0] == pt.approx(0., abs=1e-6)
+
+        # the folded kernel must agree with explicitly z-normalizing the windows
+        from brainex.classes.Sequence import Sequence
+        from brainex.utils.ts_utils import eu_znorm, running_sums, window_mean_std
+        sums = running_sums(test_db.data_normalized)
+        s1 = Sequence(test_db.data_normalized[0][0], 0, 19)
+        s2 = Sequence(test_db.data_normalized[1][0], 3, 22)
+        x, y = s1.fetch_data(test_db.data_normalized), s2.fetch_data(test_db.data_normalized)
+        zx, zy = (x - x.mean()) / x.std(), (y - y.mean()) / y.std()
+        expected = ((zx - zy) ** 2).sum() ** 0.5 / len(x) ** 0.5
+        assert eu_znorm(x, y, window_mean_std(s1, sums), window_mean_std(s2, sums)) == pt.approx(expected)
+
+
+    def test_discords(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12)
+        test_db.build(st=0.1, loi=(20, 22))
+        discords = test_db.discords(3, loi=(21, 21))
+        assert len(discords) == 3
+        assert [x[0] for x in discords] == sorted([x[0] for x in discords], reverse=True)
+
+        # the best discord must have the largest nearest neighbour distance of all the subsequences of its length
+        from brainex.classes.Sequence import Sequence
+        seqs = [Sequence(seq_id, i, i + 20) for seq_id, ts in test_db.data_normalized for i in range(len(ts) - 20)]
+        data = np.array([s.fetch_data(test_db.data_normalized) for s in seqs])
+        nn_dists = []
+        for s, d in zip(seqs, data):
+            dists = np.sqrt(np.sum(np.square(data - d), axis=1) / 21)
+            nn_dists.append(min(x for x, o in zip(dists, seqs)
+                                if not (o.seq_id == s.seq_id and o.start <= s.end and s.start <= o.end)))
+        assert discords[0][0] == pt.approx(max(nn_dists))
+
+
+    def test_range_query(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12)
+        test_db.build(st=0.1, loi=(20, 22))
+        query_seq = test_db.get_random_seq_of_len(sequence_len=21, seed=1)
+        query_data = query_seq.fetch_data(test_db.data_normalized)
+
+        from brainex.classes.Sequence import Sequence
+        seqs = [Sequence(seq_id, i, i + 20) for seq_id, ts in test_db.data_normalized for i in range(len(ts) - 20)]
+        dists = [np.sqrt(np.sum(np.square(s.fetch_data(test_db.data_normalized) - query_data)) / 21) for s in seqs]
+        for eps in [0.02, 0.05, 0.1]:
+            expected = set(s for s, d in zip(seqs, dists) if d <= eps)
+            matches = list(test_db.range_query(query_seq, eps, exact_dist=True))
+            assert set(s for _, s in matches) == expected
+            assert all(d <= eps for d, _ in matches)
+            assert set(s for _, s in test_db.range_query(query_seq, eps)) == expected
+
+    def test_partition_by_length(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12)
+        test_db.build(st=0.1, loi=(15, 24), partition_by_length=True)
+        partition_lens = [sorted(set(x[0] for x in c)) for c in test_db.clusters]
+        assert sorted(x for lens in partition_lens for x in lens) == list(range(15, 25))  # one partition per length
+
+        query_seq = test_db.get_random_seq_of_len(sequence_len=21, seed=1)
+        gq_rlt = test_db.query(query_seq, best_k=5)
+        assert len(gq_rlt) == 5
+        bf_rlt = test_db.query_brute_force(query_seq, best_k=5)
+        assert all(g[0] >= b[0] for g, b in zip(gq_rlt, bf_rlt))
+
+    def test_thread_backend(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        results = []
+        for backend in ['multiprocess', 'thread']:
+            test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                      _rows_to_consider=12, backend=backend)
+            assert test_db.conf['backend'] == backend
+            test_db.build(st=0.1, loi=(20, 22))
+            query_seq = test_db.get_random_seq_of_len(sequence_len=21, seed=1)
+            results.append(([x[0] for x in test_db.query(query_seq, best_k=5)],
+                            set(s for _, s in test_db.range_query(query_seq, 0.05))))
+            test_db.stop()
+        assert results[0][0] == pt.approx(results[1][0])
+        assert results[0][1] == results[1][1]
+
+    def test_aquery(self):
+        import asyncio
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12, backend='thread')
+        test_db.build(st=0.1, loi=(20, 22))
+        queries = [test_db.get_random_seq_of_len(sequence_len=21, seed=i) for i in range(4)]
+
+        async def _gather():
+            return await asyncio.gather(*[test_db.aquery(q, 5) for q in queries],
+                                        *[test_db.aquery_brute_force(q, 5) for q in queries])
+
+        results = asyncio.run(_gather())
+        for q, r, r_bf in zip(queries, results[:4], results[4:]):
+            assert [x[0] for x in r] == pt.approx([x[0] for x in test_db.query(q, best_k=5)])
+            assert [x[0] for x in r_bf] == pt.approx([x[0] for x in test_db.query_brute_force(q, best_k=5)])
+
+        batch_sizes = []
+        query_on_batch = test_db.query_on_batch
+
+        def _recorded(batch, best_k, **kwargs):
+            batch_sizes.append(len(batch))
+            return query_on_batch(batch, best_k, **kwargs)
+
+        test_db.query_on_batch = _recorded
+        batcher = test_db.get_query_batcher()
+        batcher.window = 0.05
+
+        async def _gather_queries():
+            return await asyncio.gather(*[test_db.aquery(q, 5) for q in queries])
+
+        for max_batch, max_in_flight, expected in [(32, 256, [4]),  # coalesced into one batch
+                                                   (3, 256, [3, 1]),  # flushed once max_batch are waiting
+                                                   (32, 2, [2, 2])]:  # the others wait for the first ones to be done
+            batch_sizes.clear()
+            batcher.max_batch, batcher.max_in_flight = max_batch, max_in_flight
+            results = asyncio.run(_gather_queries())
+            assert batch_sizes == expected
+            for q, r in zip(queries, results):
+                assert [x[0] for x in r] == pt.approx([x[0] for x in test_db.query(q, best_k=5)])
+        test_db.stop()
+
+    def test_query_server(self):
+        from brainex.server import QueryServer, QueryClient
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        db_path = '../experiments/unittest/query_server'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12, backend='thread')
+        test_db.build(st=0.1, loi=(20, 22))
+        query_seq = test_db.get_random_seq_of_len(sequence_len=21, seed=1)
+        expected = [x[0] for x in test_db.query(query_seq, best_k=5)]
+        test_db.save(db_path)
+        test_db.stop()
+
+        server = QueryServer(('localhost', 0), num_worker=self.num_cores, root='../experiments/unittest')
+        with pt.raises(Exception):  # the key of the server is needed
+            QueryClient(server.start(), authkey=b'brainex').names()
+        client = QueryClient(server.address, authkey=server.authkey, pool_size=2)
+        try:
+            for path in ['../query_server', os.path.abspath('../experiments')]:  # outside the root
+                with pt.raises(Exception):
+                    client.load('italy', path)
+            client.load('italy', 'query_server')
+            assert client.names() == ['italy']
+            for _ in range(3):  # the connection is reused
+                assert [x[0] for x in client.query('italy', query_seq, 5)] == pt.approx(expected)
+            assert client._idle.qsize() == 1
+            for method in ['stop', 'save']:
+                with pt.raises(Exception):
+                    client.call('italy', method, db_path)
+        finally:
+            client.close()
+            server.shutdown()
+
+    def test_metrics(self):
+        import json
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        metrics_path = '../experiments/unittest/metrics.json'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12)
+        test_db.build(st=0.1, loi=(20, 22))
+        build_metrics = test_db.get_metrics()['build']
+        assert set(build_metrics['phases'].keys()) == {'grouping', 'clustering', 'meta_reduction'}
+        assert sum(x['subsequences'] for x in build_metrics['lengths'].values()) == \
+            test_db.get_num_subsequences()
+        assert sum(x['clusters'] for x in build_metrics['lengths'].values()) == test_db.get_num_clusters()
+        assert build_metrics['counters']['dist_calls'] > 0
+        assert build_metrics['bytes_shipped'] > 0
+        assert build_metrics['peak_rss']['driver'] > 0
+
+        test_db.query(test_db.get_random_seq_of_len(sequence_len=21, seed=1), best_k=5)
+        query_metrics = test_db.get_metrics()['query']
+        assert query_metrics['rounds'] >= 1 and query_metrics['counters']['dist_calls'] > 0
+        os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+        test_db.export_metrics(metrics_path)
+        assert json.load(open(metrics_path))['query']['rounds'] == query_metrics['rounds']
+        test_db.stop()
+
+    def test_query_explain(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12)
+        test_db.build(st=0.1, loi=(20, 22))
+        query_seq = test_db.get_random_seq_of_len(sequence_len=21, seed=1)
+        result, trace = test_db.query(query_seq, best_k=5, overlap=0.0, explain=True)
+        assert [x[0] for x in result] == pt.approx([x[0] for x in test_db.query(query_seq, best_k=5, overlap=0.0)])
+        assert trace['rounds'] == max(p['round'] for p in trace['partitions'])
+        assert 21 in trace['lengths_visited']
+        assert sum(p['candidates_scored'] for p in trace['partitions']) <= trace['counters']['dist_calls']
+        for p in trace['partitions']:
+            assert p['time'] >= 0
+            assert all(x['reprs_scored'] >= 0 and x['clusters_expanded'] >= 0 for x in p['lengths'].values())
+        test_db.stop()
+
+    def test_memory_budget(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12)
+        estimate = test_db.estimate_build(loi=(18, 22))
+        with pt.raises(Exception) as e:
+            test_db.build(st=0.1, loi=(18, 22), memory_budget=estimate['total_bytes'] // 2)
+        assert 'over the memory budget' in str(e.value)
+
+        test_db.build(st=0.1, loi=(18, 22), memory_budget=estimate['total_bytes'])
+        assert test_db.get_num_subsequences() == estimate['num_subsequences']
+        levels = test_db.estimate_build(loi=(18, 22), st_levels=[0.2, 0.4], repr_fanout=4)
+        assert levels['level_bytes'] > 0 and levels['tree_bytes'] > 0
+        with pt.raises(Exception) as e:  # the coarser levels and the trees do not fit in the budget of st alone
+            test_db.build(st=0.1, loi=(18, 22), st_levels=[0.2, 0.4], repr_fanout=4,
+                          memory_budget=estimate['total_bytes'])
+        assert 'over the memory budget' in str(e.value)
+
+        test_db.build(st=0.1, loi=(18, 22), memory_budget=estimate['total_bytes'] // 2, over_budget='adapt')
+        step = test_db.build_conf['length_step']
+        assert not test_db.build_conf['keep_subsequences']
+        assert test_db.get_metrics()['build']['estimate']['total_bytes'] <= estimate['total_bytes'] // 2
+        assert set(test_db.get_length_directory().keys()) == set(range(18, 23, step))
+        assert test_db.get_num_subsequences() == len(test_db.get_subsequences()) == \
+            test_db.estimate_build(loi=(18, 22), length_step=step)['num_subsequences']
+        query_seq = test_db.get_random_seq_of_len(sequence_len=20, seed=1)
+        assert len(test_db.query_brute_force(query_seq, best_k=5, _use_cache=False)) == 5
+        test_db.stop()
+
+    def test_length_step(self):
+        from brainex.op.query_op import sim_between_array
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12)
+        test_db.build(st=0.1, loi=(18, 22), length_step=2)
+        assert sorted(test_db.get_length_directory().keys()) == [18, 20, 22]
+        assert test_db.get_num_subsequences() == \
+            test_db.estimate_build(loi=(18, 22), length_step=2)['num_subsequences']
+
+        query_seq = test_db.get_random_seq_of_len(sequence_len=21, seed=1)
+        for length_policy in ['nearest', 'scale']:
+            result, trace = test_db.query(query_seq, best_k=5, length_policy=length_policy, explain=True)
+            assert len(result) == 5
+            assert set(trace['lengths_visited']) <= {18, 20, 22}
+        # the scaled query is compared with subsequences of the same length
+        query_data = test_db.get_seq_data(query_seq)
+        for dist, seq in test_db.query(query_seq, best_k=5, length_policy='scale'):
+            scaled = np.interp(np.linspace(0, 1, len(seq)), np.linspace(0, 1, len(query_data)), query_data)
+            assert dist == pt.approx(sim_between_array(test_db.get_seq_data(seq), scaled, pnorm=2))
+        test_db.stop()
+
+    def test_build_dynamic(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12)
+        for dist_type in ['eu', 'ma', 'ch']:
+            test_db.build(st=0.1, loi=(16, 22), dist_type=dist_type, _use_dynamic=True)
+            assert test_db.get_metrics()['build']['counters']['dist_derived'] > 0
+            members = []
+            for seq_len, cluster in [x for c in test_db.clusters for x in c]:
+                for r, seqs in cluster.items():
+                    assert (0.0, r) in seqs
+                    for dist, seq in seqs:
+                        assert len(seq) == seq_len
+                        assert dist <= 0.05
+                        assert dist == pt.approx(gxdb.dt_func_dict[dist_type](test_db.get_seq_data(r),
+                                                                              test_db.get_seq_data(seq)))
+                    members += [seq for _, seq in seqs]
+            assert len(members) == len(set(members)) == test_db.estimate_build(loi=(16, 22))['num_subsequences']
+        test_db.stop()
+
+    def test_build_levels(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12)
+        with pt.raises(Exception):
+            test_db.build(st=0.1, loi=(20, 22), st_levels=[0.05])
+        test_db.build(st=0.05, loi=(20, 22), st_levels=[0.4, 0.1, 0.2])
+        assert test_db.build_conf['st_levels'] == [0.05, 0.1, 0.2, 0.4]
+        num_clusters = test_db.get_metrics()['build']['levels']
+        assert num_clusters[0.05] == test_db.get_num_clusters()
+        assert num_clusters[0.05] >= num_clusters[0.1] >= num_clusters[0.2] >= num_clusters[0.4]
+
+        num_subsequences = test_db.get_num_subsequences()
+        for seq_len, levels in [x for c in test_db.cluster_levels for x in c]:
+            for st_from, st_to, bound in [(0.05, 0.1, 0.075), (0.1, 0.2, 0.175), (0.2, 0.4, 0.375)]:
+                coarse = dict((seq, r) for r, seqs in levels[st_to].items() for _, seq in seqs)
+                for r, seqs in levels[st_from].items():  # every cluster is in one coarser cluster
+                    assert len(set(coarse[seq] for _, seq in seqs)) == 1
+                for r, seqs in levels[st_to].items():
+                    assert (0.0, r) in seqs
+                    for dist, seq in seqs:
+                        assert dist <= bound + 1e-9  # the sum of st / 2 up to st_to
+                        assert dist == pt.approx(gxdb.eu_norm(test_db.get_seq_data(r), test_db.get_seq_data(seq)))
+        def _leaves(nodes):
+            return [r for r, _, children in nodes if children is None] + \
+                   [r for _, _, children in nodes if children is not None for r in _leaves(children)]
+
+        for seq_len, levels in [x for c in test_db.cluster_levels for x in c]:  # the coarser levels filter the finest
+            leaves = _leaves(levels[0.05].tree)
+            assert len(leaves) == len(levels[0.05]) and set(leaves) == set(levels[0.05].keys())
+            assert set(r for r, _, _ in levels[0.05].tree) == set(levels[0.4].keys())
+        for st in [0.4, 0.1]:
+            clusters = [x for c in test_db._get_clusters(st) for x in c]
+            assert sum(len(seqs) for _, cluster in clusters for seqs in cluster.values()) == num_subsequences
+
+        q = test_db.get_random_seq_of_len(21, seed=1)
+        test_db.query(q, best_k=5)
+        fine = test_db.get_metrics()['query']['counters']['dist_calls']
+        assert len(test_db.query(q, best_k=5, st=0.3)) == 5  # searches the level of 0.2
+        assert test_db.get_metrics()['query']['counters']['dist_calls'] < fine
+        test_db.stop()
+
+    def test_repr_tree(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=24)
+        with pt.raises(Exception):
+            test_db.build(st=0.05, loi=(20, 21), repr_fanout=0)
+        q = test_db.get_random_seq_of_len(21, seed=1)
+        test_db.build(st=0.02, loi=(20, 21), dist_type='ma')
+        flat = test_db.query(q, best_k=5)
+        flat_dists = test_db.get_metrics()['query']['counters']['dist_calls']
+
+        test_db.build(st=0.02, loi=(20, 21), dist_type='ma', repr_fanout=4)
+        assert test_db.build_conf['repr_fanout'] == 4
+
+        def _leaves(nodes):
+            for r, radius, children in nodes:
+                if children is None:
+                    yield r, radius
+                else:
+                    for leaf_r, leaf_radius in _leaves(children):  # a node bounds the members under it
+                        assert leaf_radius + gxdb.ma_norm(test_db.get_seq_data(r), test_db.get_seq_data(leaf_r)) \
+                               <= radius + 1e-9
+                        yield leaf_r, leaf_radius
+
+        for seq_len, cluster in [x for c in test_db.clusters for x in c]:
+            leaves = dict(_leaves(cluster.tree))
+            assert set(leaves) == set(cluster.keys())
+            for r, seqs in cluster.items():
+                assert max(dist for dist, _ in seqs) <= leaves[r] + 1e-9
+        assert [d for d, _ in test_db.query(q, best_k=5)] == pt.approx([d for d, _ in flat])
+        assert test_db.get_metrics()['query']['counters']['dist_calls'] < flat_dists
+        test_db.stop()
+
+    def test_similarity_join(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        db_a = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                               _rows_to_consider=8)
+        db_b = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                               _rows_to_consider=12)
+        db_a.build(st=0.1, loi=(20, 21))
+        db_b.build(st=0.1, loi=(20, 21))
+
+        from brainex.classes.Sequence import Sequence
+
+        def _bf_join(data_a, data_b, eps, self_join):
+            rtn = set()
+            for m in [20, 21]:
+                seqs_a = [Sequence(i, s, s + m - 1) for i, ts in data_a for s in range(len(ts) - m + 1)]
+                seqs_b = [Sequence(i, s, s + m - 1) for i, ts in data_b for s in range(len(ts) - m + 1)]
+                mat_b = np.array([s.fetch_data(data_b) for s in seqs_b])
+                for a in seqs_a:
+                    dists = np.sqrt(np.sum(np.square(mat_b - a.fetch_data(data_a)), axis=1) / m)
+                    rtn.update((a, b) for d, b in zip(dists, seqs_b) if d <= eps and not (
+                            self_join and (a.seq_id == b.seq_id and a.start <= b.end and b.start <= a.end or
+                                           (a.seq_id, a.start) >= (b.seq_id, b.start))))
+            return rtn
+
+        self_joined = db_a.similarity_join(eps=0.05)
+        assert set((a, b) for _, a, b in self_joined) == _bf_join(db_a.data_normalized, db_a.data_normalized, 0.05,
+                                                                  True)
+        assert [x[0] for x in self_joined] == sorted(x[0] for x in self_joined)
+
+        joined = db_a.similarity_join(db_b)
+        data_b = [(i, db_a.normalize(db_b.inverse_normalize(ts))) for i, ts in db_b.data_normalized]
+        assert set((a, b) for _, a, b in joined) == _bf_join(db_a.data_normalized, data_b, 0.1, False)
+
+
+    def test_query_time_budget(self):
+        data_file = '../brainex/experiments/data/ItalyPower.csv'
+        test_db = gutils.from_csv(data_file, feature_num=0, num_worker=self.num_cores, use_spark=False,
+                                  _rows_to_consider=12)
+        test_db.build(st=0.1, loi=(20, 22))
+        query_seq = test_db.get_random_seq_of_len(sequence_len=21, seed=1)
+
+        progress = []
+        gq_rlt, is_final = test_db.query(query_seq, best_k=5, overlap=0.5, time_budget_ms=1e6, callback=progress.append)
+        assert is_final
+        assert [x[1] for x in gq_rlt] == [x[1] for x in test_db.query(query_seq, best_k=5, overlap=0.5)]
+        assert [x[1] for x in progress[-1]] == [x[1] for x in gq_rlt]
+        assert test_db.query(query_seq, best_k=5, time_budget_ms=0)[1] is False
+
+        bf_rlt, is_final = test_db.query_brute_force(query_seq, best_k=5, _use_cache=False, time_budget_ms=1e6)
+        assert is_final
+        assert [x[0] for x in bf_rlt] == pt.approx([x[0] for x in test_db.query_brute_force(query_seq, best_k=5)])
+        assert test_db.query_brute_force(query_seq, best_k=5, _use_cache=False, time_budget_ms=0)[1] is False
+
 
 def _check_unique(x: list):
     seen = set()
@@ -0,0 +1,145 @@
+import math
+
+import numpy as np
+import pytest as pt
+
+from brainex.benchmarks.import_time import import_profile
+from brainex.benchmarks.ucr import compare
+from brainex.classes.OverlapIndex import OverlapIndex
+from brainex.classes.Sequence import Sequence
+from brainex.database.genexengine import dt_func_dict, dt_pnorm_dict
+from brainex.op.cluster_op import pairwise_dist, _trimmed_dist_mt
+from brainex.op.matrix_profile_op import stomp, _mp_series_top_k, _merge_top_k
+from brainex.utils.process_utils import dss_plan, dss_planned, _group_time_series
+from brainex.utils.utils import _isOverlap, plan_query_lengths
+
+
+def _z_norm(x):
+    return np.zeros(len(x)) if x.std() < 1e-8 else (x - x.mean()) / x.std()
+
+
+def _bf_profile(a, b, m, exclusion=None):
+    profile = []
+    for i in range(len(a) - m + 1):
+        dists = [np.linalg.norm(_z_norm(a[i:i + m]) - _z_norm(b[j:j + m])) / math.sqrt(m)
+                 for j in range(len(b) - m + 1) if exclusion is None or abs(i - j) >= exclusion]
+        profile.append(min(dists))
+    return profile
+
+
+class TestMatrixProfile:
+
+    def test_stomp(self):
+        rng = np.random.RandomState(42)
+        a, b = rng.rand(40), rng.rand(30)
+        assert np.allclose(stomp(a, b, 8)[0], _bf_profile(a, b, 8))
+        assert np.allclose(stomp(a, a, 8, exclusion=2)[0], _bf_profile(a, a, 8, exclusion=2))
+
+        # flat windows are all zeros once z-normalized
+        a = np.array([1., 1, 1, 1, 2, 3, 1, 1, 1, 1, 5, 2, 2, 2, 2])
+        b = np.array([3., 3, 3, 3, 1, 2, 0, 4, 4, 4, 4])
+        assert np.allclose(stomp(a, b, 4)[0], _bf_profile(a, b, 4))
+
+    def test_motif_discord(self):
+        rng = np.random.RandomState(42)
+        data = [(('ts' + str(i),), rng.rand(30)) for i in range(5)]
+        pattern = np.sin(np.linspace(0, 3, 10))
+        data[1][1][5:15] = pattern
+        data[3][1][12:22] = pattern * 2 + 1  # the same shape on another scale
+
+        motifs = _merge_top_k([_mp_series_top_k(range(5), data, [10], 2, 0.5, 0.25, discord=False)], 2, False)
+        assert motifs[0][0] == pt.approx(0., abs=1e-6)
+        assert {(motifs[0][1].seq_id, motifs[0][1].start), (motifs[0][2].seq_id, motifs[0][2].start)} == \
+               {(('ts1',), 5), (('ts3',), 12)}
+        assert len(motifs) == 2 and motifs[1][1] not in (motifs[0][1], motifs[0][2])  # mirrored pair dropped
+
+        discords = _merge_top_k([_mp_series_top_k(range(5), data, [10], 3, 0.5, 0.25, discord=True)], 3, True)
+        assert [x[0] for x in discords] == sorted([x[0] for x in discords], reverse=True)
+
+
+class TestOverlapIndex:
+
+    def test_is_overlapping(self):
+        rng = np.random.RandomState(42)
+
+        def _random_seq():
+            start = rng.randint(0, 100)
+            length = rng.randint(0, 20) if rng.rand() < 0.9 else rng.randint(20, 80)  # a few long ones
+            return Sequence(('ts' + str(rng.randint(3)),), start, start + length)
+
+        for overlap in [0.0, 0.1, 0.3, 0.5, 0.9, 1.0]:
+            added, index = [], OverlapIndex(overlap)
+            for _ in range(200):
+                seq = _random_seq()
+                assert index.is_overlapping(seq) == any(_isOverlap(seq, s, overlap) for s in added)
+                if rng.rand() < 0.3:
+                    added.append(seq)
+                    index.add(seq)
+            assert len(index) == len(added)
+
+
+class TestPlanQueryLengths:
+
+    def test_plan(self):
+        # partition -> seq_len -> (number of clusters, number of sequences)
+        dirs = {0: {10: (1, 2), 12: (2, 5)}, 1: {9: (1, 1), 15: (3, 9)}}
+        plan = plan_query_lengths(dirs, q_len=10, radius=1, k=2, ke=3)
+        assert plan[0]['lens'] == [10] and plan[1]['lens'] == [9]  # 2 + 1 expected candidates
+        assert plan[0]['radius'] == plan[1]['radius'] == 2
+        plan = plan_query_lengths(dirs, q_len=10, radius=0, k=2, ke=4)
+        assert plan[0]['lens'] == [10, 12] and plan[1]['lens'] == [9]  # 3 then 5 expected candidates
+        assert plan[0]['radius'] == plan[1]['radius'] == 3
+        plan = plan_query_lengths(dirs, q_len=10, radius=0, k=2, ke=4, loi=(10, 15))
+        assert plan[0]['lens'] == [10, 12] and plan[1]['lens'] == []
+
+
+class TestDssPlan:
+
+    def test_dss_plan(self):
+        rng = np.random.RandomState(0)
+        ts_list = [(('ts' + str(i),), rng.rand(1000 if i == 0 else rng.randint(5, 60))) for i in range(20)]
+        for start, end, parallelism in [(2, 50, 4), (10, 1000, 16), (1, 3, 3)]:
+            groups = [dss_planned(x, ts_list, start, end) for x in dss_plan(ts_list, start, end, parallelism)]
+            assert len(groups) == parallelism
+            planned = sorted((s.seq_id, s.start, s.end) for g in groups for _, seqs in g for s in seqs)
+            assert planned == sorted((s.seq_id, s.start, s.end)
+                                     for _, seqs in _group_time_series(ts_list, start, end) for s in seqs)
+            costs = [sum(seq_len * len(seqs) for seq_len, seqs in g) for g in groups]
+            assert max(costs) < 1.2 * sum(costs) / parallelism
+
+
+class TestPairwiseDist:
+
+    def test_pairwise_dist(self):
+        rng = np.random.RandomState(0)
+        a, b = rng.randn(5, 12), rng.randn(7, 12)
+        for dist_type in ['eu', 'ma', 'ch']:
+            expected = [[dt_func_dict[dist_type](x, y) for y in b] for x in a]
+            assert pairwise_dist(a, b, dt_pnorm_dict[dist_type]) == pt.approx(np.array(expected))
+
+    def test_trimmed_dist_mt(self):
+        rng = np.random.RandomState(0)
+        a = rng.randn(6, 12)
+        for dist_type in ['eu', 'ma', 'ch']:
+            pnorm = dt_pnorm_dict[dist_type]
+            for trimmed, kept in [(a[:, :2], a[:, 2:]), (a[:, -1:], a[:, :-1])]:
+                derived = _trimmed_dist_mt(pairwise_dist(a, a, pnorm), 12, trimmed, list(kept), pnorm)
+                assert derived == pt.approx(pairwise_dist(kept, kept, pnorm))
+
+
+class TestImport:
+
+    def test_lazy_dependencies(self):
+        _, loaded = import_profile('brainex')
+        assert not set(loaded) & {'pyspark', 'tslearn', 'sklearn', 'scipy'}
+
+
+class TestBenchmarkCompare:
+
+    def test_compare(self):
+        baseline = {'results': {'a/thread/default': {'build_time': 1.0, 'query_p50': 1.0, 'recall': 0.8},
+                                'b/thread/default': {'build_time': 1.0}}}
+        results = {'results': {'a/thread/default': {'build_time': 2.0, 'query_p50': 1.05, 'recall': 1.0},
+                               'b/thread/default': {'error': 'unavailable'}}}
+        changes = dict(((c['run'], c['metric']), c['regression']) for c in compare(results, baseline, 0.1))
+        assert changes == {('a/thread/default', 'build_time'): True, ('a/thread/default', 'recall'): False}